@@ -0,0 +1,106 @@
+"""
+Benchmark of the snapshot assembly of the BFS loaders
+(dataprep/backward_facing_step.py) against the previous per-snapshot loop,
+on a synthetic single-case VTK file:
+    python benchmark_snapshots.py [--snaps 3000 --nx 120 --ny 100]
+"""
+from __future__ import absolute_import, division, print_function, annotations
+from typing import Optional
+import os,time
+import argparse
+import tempfile
+import numpy as np
+import pyvista as pv 
+
+import torch 
+
+import dataprep.backward_facing_step as bfs
+
+
+def _assemble_snapshots_loop(
+        data_full_temp : np.ndarray,
+        time_skip : int,
+        scaling : list,
+        features_to_keep : list,
+        node_perm : Optional[np.ndarray] = None) -> torch.Tensor:
+    """
+    Snapshot assembly of _read_cell_data before it was vectorized (copy of
+    the VTK array, per-snapshot reshape loop, float64 scaling, then the
+    feature selection), the baseline of benchmark.
+    """
+    data_full_temp = np.array(data_full_temp)[:, :, ::time_skip]
+    n_cells, n_features, n_snaps = data_full_temp.shape
+    if node_perm is not None:
+        data_full_temp = data_full_temp[node_perm]
+    data_full = np.zeros((n_snaps, n_cells, n_features), dtype=np.float32)
+    for i in range(n_snaps):
+        data_full[i,:,:] = data_full_temp[:,:,i]
+    data_train_mean = np.reshape(scaling[0], (1,1,-1))
+    data_train_std = np.reshape(scaling[1], (1,1,-1))
+    data_full = (data_full - data_train_mean)/(data_train_std + 1e-10)
+    data_full = torch.tensor(data_full, dtype=torch.float32)
+    return data_full[:,:,features_to_keep].contiguous()
+
+
+def benchmark(
+        n_snaps : Optional[int] = 3000,
+        nx : Optional[int] = 120,
+        ny : Optional[int] = 100,
+        n_repeats : Optional[int] = 3) -> None:
+    """
+    Times the snapshot assembly of a synthetic single-case VTK file (nx*ny
+    cells, 3 fields, n_snaps snapshots, 2 fields kept), with and without
+    node reordering: the previous loop (_assemble_snapshots_loop, on the
+    array returned by read_vtk_snapshots) against _read_cell_data (which
+    includes that read, also timed on its own).
+    """
+    def median_time(fn):
+        times = []
+        for _ in range(n_repeats):
+            t_start = time.time()
+            out = fn()
+            times.append(time.time() - t_start)
+        return np.median(times), out
+
+    rng = np.random.default_rng(0)
+    features_to_keep = [1,2]
+    scaling = [np.array([0.1,0.2,0.3]), np.array([1.1,1.2,1.3])]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path_to_vtk = os.path.join(tmp_dir, 'bench.vtk')
+        grid = pv.ImageData(dimensions=(nx+1,ny+1,1), spacing=(1e-3,1e-3,1)).cast_to_unstructured_grid()
+        n_cells = grid.n_cells
+        grid.cell_data['x'] = rng.standard_normal((n_cells, 3*n_snaps), dtype=np.float32)
+        grid.field_data['field_list'] = np.array(['p','ux','uy'])
+        grid.field_data['time'] = np.arange(n_snaps)*1e-4
+        grid.save(path_to_vtk)
+        print('%d cells, 3 fields, %d snapshots (%.0f MB)' %(n_cells, n_snaps, os.path.getsize(path_to_vtk)/1e6))
+
+        t_read, (data_full_temp, _, _) = median_time(lambda : bfs.read_vtk_snapshots(path_to_vtk))
+        print('%-24s %8.2f s' %('read_vtk_snapshots', t_read))
+        for node_perm in [None, rng.permutation(n_cells)]:
+            t_loop, x_loop = median_time(lambda : _assemble_snapshots_loop(
+                data_full_temp, 1, scaling, features_to_keep, node_perm))
+            t_new, out = median_time(lambda : bfs._read_cell_data(
+                path_to_vtk, scaling=scaling, features_to_keep=features_to_keep, node_perm=node_perm))
+            print('%-24s loop %8.2f s   vectorized %8.2f s (incl. read)   max diff %.1e' %(
+                'assembly' if node_perm is None else 'assembly, reordered',
+                t_loop, t_new, float((x_loop - out['snapshots']).abs().max())))
+
+        t_split, _ = median_time(lambda : bfs._split_train_valid(n_snaps, 0.05, 0))
+        print('%-24s %8.2f ms' %('_split_train_valid', t_split*1e3))
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the snapshot assembly of the BFS loaders on a synthetic VTK case.')
+    parser.add_argument('--snaps', type=int, default=3000, help='number of snapshots')
+    parser.add_argument('--nx', type=int, default=120)
+    parser.add_argument('--ny', type=int, default=100)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    benchmark(args.snaps, args.nx, args.ny, args.repeats)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Benchmark of the TopK node selection and filter_adj of pooling.py against
+their previous implementations (full sort of the padded scores, boolean
+indexing), on random batches of equal and unequal graph sizes:
+    python benchmark_topk.py [--nodes 20000 --graphs 4 --ratio 0.25]
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch_scatter import scatter_add
+from torch_geometric.utils.num_nodes import maybe_num_nodes
+
+import pooling
+
+
+def _topk_sort(x, ratio, batch):
+    r"""TopK selection before it was vectorized (full sort of the padded
+    scores, per-graph list of aranges), kept as the baseline of
+    benchmark_topk."""
+    num_nodes = scatter_add(batch.new_ones(x.size(0)), batch, dim=0)
+    batch_size, max_num_nodes = num_nodes.size(0), num_nodes.max().item()
+    cum_num_nodes = torch.cat(
+        [num_nodes.new_zeros(1),
+         num_nodes.cumsum(dim=0)[:-1]], dim=0)
+    index = torch.arange(batch.size(0), dtype=torch.long, device=x.device)
+    index = (index - cum_num_nodes[batch]) + (batch * max_num_nodes)
+    dense_x = x.new_full((batch_size * max_num_nodes, ),
+                         torch.finfo(x.dtype).min)
+    dense_x[index] = x
+    dense_x = dense_x.view(batch_size, max_num_nodes)
+    _, perm = dense_x.sort(dim=-1, descending=True)
+    perm = perm + cum_num_nodes.view(-1, 1)
+    perm = perm.view(-1)
+    k = (ratio * num_nodes.to(torch.float)).ceil().to(torch.long)
+    mask = [
+        torch.arange(k[i], dtype=torch.long, device=x.device) +
+        i * max_num_nodes for i in range(batch_size)
+    ]
+    mask = torch.cat(mask, dim=0)
+    return perm[mask].to(batch.dtype)
+
+
+def _filter_adj_mask(edge_index, edge_attr, perm, num_nodes=None):
+    r"""filter_adj before it was vectorized (new node map per call, boolean
+    indexing), kept as the baseline of benchmark_topk."""
+    num_nodes = maybe_num_nodes(edge_index, num_nodes)
+    mask = perm.new_full((num_nodes, ), -1)
+    i = torch.arange(perm.size(0), dtype=perm.dtype, device=perm.device)
+    mask[perm] = i
+    row, col = edge_index
+    row, col = mask[row], mask[col]
+    mask = (row >= 0) & (col >= 0)
+    row, col = row[mask], col[mask]
+    if edge_attr is not None:
+        edge_attr = edge_attr[mask]
+    return torch.stack([row, col], dim=0), edge_attr, mask
+
+
+def benchmark_topk(n_nodes=20000, n_graphs=4, ratio=0.25, n_features=128, n_repeats=10):
+    r"""Times topk and filter_adj against the baselines _topk_sort and
+    _filter_adj_mask on a batch of n_graphs random graphs (6 edges per
+    node), with equal graph sizes (n_nodes each) and unequal ones (up to
+    10% smaller), and checks that the outputs agree."""
+
+    def median_time(fn):
+        fn()
+        times = []
+        for _ in range(n_repeats):
+            t_start = time.time()
+            fn()
+            times.append(time.time() - t_start)
+        return 1e3 * float(np.median(times))
+
+    gen = torch.Generator().manual_seed(0)
+    for name, sizes in [('equal', [n_nodes] * n_graphs),
+                        ('unequal', torch.randint(int(0.9 * n_nodes), n_nodes + 1, (n_graphs,), generator=gen).tolist())]:
+        num_nodes = torch.tensor(sizes)
+        batch = torch.repeat_interleave(torch.arange(n_graphs), num_nodes)
+        offsets = torch.cat([num_nodes.new_zeros(1), num_nodes.cumsum(0)[:-1]])
+        row = torch.arange(batch.size(0)).repeat_interleave(6)
+        col = (torch.rand(row.size(0), generator=gen) * num_nodes[batch[row]]).long() + offsets[batch[row]]
+        edge_index = torch.stack([row, col])
+        edge_attr = torch.randn(edge_index.size(1), n_features, generator=gen)
+        x = torch.randn(batch.size(0), generator=gen)
+
+        perm = pooling.topk(x, ratio, batch)
+        t_topk_new = median_time(lambda : pooling.topk(x, ratio, batch))
+        t_topk_old = median_time(lambda : _topk_sort(x, ratio, batch))
+        t_filter_new = median_time(lambda : pooling.filter_adj(edge_index, edge_attr, perm, batch.size(0)))
+        t_filter_old = median_time(lambda : _filter_adj_mask(edge_index, edge_attr, perm, batch.size(0)))
+        # nodes with tied scores may come in another order (torch.topk vs
+        # sort), so the selections are compared by their scores
+        same_topk = torch.equal(x[perm], x[_topk_sort(x, ratio, batch)])
+        same_filter = all(torch.equal(a, b) for a, b in zip(pooling.filter_adj(edge_index, edge_attr, perm, batch.size(0)),
+                                                            _filter_adj_mask(edge_index, edge_attr, perm, batch.size(0))))
+        print('%-8s %7d nodes x %2d graphs   topk %8.2f -> %8.2f ms (same scores %s)   filter_adj %8.2f -> %8.2f ms (identical %s)' %(
+            name, n_nodes, n_graphs, t_topk_old, t_topk_new, same_topk, t_filter_old, t_filter_new, same_filter))
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the TopK selection and filter_adj against the previous implementation.')
+    parser.add_argument('--nodes', type=int, default=20000, help='nodes per graph')
+    parser.add_argument('--graphs', type=int, default=4, help='graphs per batch')
+    parser.add_argument('--ratio', type=float, default=0.25)
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+    benchmark_topk(args.nodes, args.graphs, args.ratio)
@@ -2,8 +2,11 @@
 Prepares PyGeom data from BFS VTK files obtained from foamToVTK
 """
 from __future__ import absolute_import, division, print_function, annotations
-from typing import Optional, Union, Callable
+from typing import Optional, Union, Callable, List
 import os,time,sys 
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
 import pyvista as pv 
 
@@ -13,77 +16,726 @@ import torch_geometric.utils as utils
 import torch_geometric.nn as tgnn
 import torch_geometric.transforms as transforms
 
+from dataprep.cache import file_fingerprint, cache_key, load_cache, save_cache, load_npz_cache, save_npz_cache
+from dataprep.datasets import SharedTopologyDataset
+from dataprep.snapshot_store import SnapshotStore, open_snapshot_store
+from dataprep.sharding import shard_samples
+from dataprep.shared_memory import NodeSharedMemory
+from dataprep.reordering import node_permutation, invert_permutation, permutation_key
+from dataprep.precision import to_storage
+from dataprep.statistics import compute_statistics
+
 
 def get_data_statistics(
         path_to_vtk : str, 
         multiple_cases : Optional[bool] = False ) -> List[np.ndarray]:
-    #print('Reading vtk: %s' %(path_to_vtk))
-    mesh = pv.read(path_to_vtk)
-    
-    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    # Extract data
-    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    #print('Extracting data from vtk...')
-    if multiple_cases:
-        #print('\tmultiple cases...')
-        data_full_temp = []
-        time_vec = []
+    """
+    Mean and std of each field over all cells and snapshots of the VTK file,
+    computed in one streaming pass (see dataprep/statistics.py).
+    """
+    stats = compute_statistics([path_to_vtk], multiple_cases = multiple_cases)
+    return [stats['mean'], stats['std']]
 
-        # Get the case file list 
-        case_path_list = mesh.field_data['case_path_list']
-        n_cases = len(case_path_list)
-        for c in range(n_cases):
-            data_full_c = np.array(mesh.cell_data['x_%d' %(c)]) # [N_nodes x (N_features x N_snaps)]
-            time_vec_c = np.array(mesh.field_data['time_%d' %(c)])
-            field_names = np.array(mesh.field_data['field_list'])
-            n_cells = mesh.n_cells
-            n_features = len(field_names)
-            n_snaps = len(time_vec_c)
-            data_full_c = np.reshape(data_full_c, (n_cells, n_features, n_snaps), order='F')
-            data_full_temp.append(data_full_c)
-            time_vec.append(time_vec_c)
-            
-        # Concatenate data_full_temp and time_vec 
-        data_full_temp = np.concatenate(data_full_temp, axis=2)
-        time_vec = np.concatenate(time_vec)
-        n_snaps = len(time_vec)
-    else:
-        #print('\tsingle case...')
-        # Node features 
-        data_full_temp = np.array(mesh.cell_data['x']) # [N_nodes x (N_features x N_snaps)]
-        field_names = np.array(mesh.field_data['field_list'])
-        time_vec = np.array(mesh.field_data['time'])
-        n_cells = mesh.n_cells
-        n_features = len(field_names)
-        n_snaps = len(time_vec)
-        data_full_temp = np.reshape(data_full_temp, (n_cells, n_features, n_snaps), order='F')
 
-    # Do a dumb reshape
-    data_full = np.zeros((n_snaps, n_cells, n_features), dtype=np.float32)
-    for i in range(n_snaps):
-        data_full[i,:,:] = data_full_temp[:,:,i]
+# In-process store of mesh topologies, so that cases on the same mesh share them
+_MESH_TOPOLOGY = {}
+
+def get_mesh_topology(
+        path_to_ei : str,
+        path_to_pos : str,
+        use_radius : bool,
+        cache_dir : Optional[str] = None,
+        reorder : Optional[str] = None) -> dict:
+    """
+    Returns the mesh topology shared by all cases on a mesh: coalesced
+    edge_index, normalized edge_attr (and its mean/std), pos, bounding box and
+    the radius-graph edges if use_radius = True.
+
+    If reorder is one of dataprep.reordering.REORDER_METHODS ('morton',
+    'hilbert', 'rcm'), the nodes are renumbered for memory locality before
+    the edges are built. The topology then also holds the node permutation
+    perm (new --> old: snapshots are reordered with x[perm]) and inv_perm
+    (fields are written back in the OpenFOAM order with x[inv_perm]); both
+    are None otherwise.
+
+    The topology is keyed by a hash of the contents of the edge_index and pos
+    files. It is built once per process (and then memoized by path), and if
+    cache_dir is given it is written to cache_dir as binary arrays so other
+    ranks and later runs skip the text parsing entirely.
+    """
+    path_key = _mesh_path_key(path_to_ei, path_to_pos, use_radius, reorder)
+    if path_key in _MESH_TOPOLOGY:
+        return _MESH_TOPOLOGY[path_key]
+
+    inputs = {
+        'ei' : file_fingerprint(path_to_ei, hash_contents=True)['sha1'],
+        'pos' : file_fingerprint(path_to_pos, hash_contents=True)['sha1'],
+        'use_radius' : use_radius}
+    if reorder is not None:
+        inputs['reorder'] = reorder
+    key = cache_key(inputs)
+    if key in _MESH_TOPOLOGY:
+        _MESH_TOPOLOGY[path_key] = _MESH_TOPOLOGY[key]
+        return _MESH_TOPOLOGY[key]
+
+    arrays = None
+    if cache_dir is not None:
+        path_to_cache = os.path.join(cache_dir, 'mesh_topology_%s.npz' %(key))
+        arrays = load_npz_cache(path_to_cache)
+
+    if arrays is None:
+        arrays = _process_mesh_topology(path_to_ei, path_to_pos, use_radius, reorder)
+        if cache_dir is not None:
+            save_npz_cache(arrays, path_to_cache)
+
+    pos = torch.tensor(arrays['pos'])
+    bbox = arrays['bounding_box']
+    topology = {
+        'edge_index' : torch.tensor(arrays['edge_index']),
+        'edge_attr' : torch.tensor(arrays['edge_attr']),
+        'edge_attr_mean' : torch.tensor(arrays['edge_attr_mean']),
+        'edge_attr_std' : torch.tensor(arrays['edge_attr_std']),
+        'edge_index_radius' : torch.tensor(arrays['edge_index_radius']),
+        'pos' : pos,
+        'distance' : torch.tensor(np.zeros((pos.shape[0], 1))),
+        'bounding_box' : [torch.tensor(bbox[i]) for i in range(4)],
+        'perm' : torch.tensor(arrays['perm']) if 'perm' in arrays else None,
+        'inv_perm' : torch.tensor(arrays['inv_perm']) if 'inv_perm' in arrays else None}
+    _MESH_TOPOLOGY[key] = topology
+    _MESH_TOPOLOGY[path_key] = topology
+    return topology
+
+
+def set_mesh_topology(
+        path_to_ei : str,
+        path_to_pos : str,
+        use_radius : bool,
+        topology : dict,
+        reorder : Optional[str] = None) -> None:
+    """
+    Registers a topology obtained elsewhere (e.g. broadcast from rank 0) for
+    these files, so get_mesh_topology returns it without reading any file.
+    """
+    _MESH_TOPOLOGY[_mesh_path_key(path_to_ei, path_to_pos, use_radius, reorder)] = topology
+    return
+
+
+def _mesh_path_key(path_to_ei : str, path_to_pos : str, use_radius : bool, reorder : Optional[str]) -> tuple:
+    return (os.path.abspath(path_to_ei), os.path.abspath(path_to_pos), bool(use_radius), reorder)
+
+
+def _node_perm(
+        path_to_ei : str,
+        path_to_pos : str,
+        use_radius : bool,
+        cache_dir : Optional[str],
+        reorder : Optional[str]) -> Optional[np.ndarray]:
+    """
+    Node permutation to apply to the snapshots of the mesh, or None.
+    """
+    if reorder is None:
+        return None
+    topology = get_mesh_topology(path_to_ei, path_to_pos, use_radius, cache_dir = cache_dir, reorder = reorder)
+    return topology['perm'].numpy()
+
+
+def _process_mesh_topology(
+        path_to_ei : str,
+        path_to_pos : str,
+        use_radius : bool,
+        reorder : Optional[str] = None) -> dict:
+    # Edge attributes and index, and node positions 
+    #print('Reading edge index and node positions...')
+    edge_index = torch.tensor(np.loadtxt(path_to_ei, dtype=np.longlong).T)
+    pos = torch.tensor(np.loadtxt(path_to_pos, dtype=np.float32))
+
+    # ~~~~ Renumber the nodes for memory locality 
+    perm = None
+    if reorder is not None:
+        perm = node_permutation(reorder, pos.numpy(), edge_index.numpy())
+        inv_perm = invert_permutation(perm)
+        pos = pos[torch.tensor(perm)]
+        edge_index = torch.tensor(inv_perm)[edge_index]
+
+    edge_index_rad = edge_index.new_zeros((2,0))
+    if use_radius:
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        # Create radius graph
+        # -- outputs are edge_index and edge_attr
+        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+        radius = 0.001 # m
+        self_loops = False
+        max_num_neighbors = 30 
+        edge_index_rad = tgnn.radius_graph(pos, r=radius, max_num_neighbors=max_num_neighbors)
+        edge_index = torch.concat((edge_index_rad, edge_index), axis=1)
+
+    # ~~~~ Populate edge_attr and coalesce edge_index
+    data_ref = Data( pos = pos, edge_index = edge_index )
+    cart = transforms.Cartesian(norm=False, max_value = None, cat = False)
+    dist = transforms.Distance(norm = False, max_value = None, cat = True)
+
+    # populate edge_attr
+    data_ref = cart(data_ref) # adds cartesian/component-wise distance
+    data_ref = dist(data_ref) # adds euclidean distance
+
+    # extract edge_attr
+    edge_attr = data_ref.edge_attr
 
-    # Compute mean: 
-    data_mean = data_full.mean(axis=(0,1), keepdims=False)
-    data_std = data_full.std(axis=(0,1), keepdims=False)
+    # Eliminate duplicate edges, sort 
+    edge_index, edge_attr = utils.coalesce(edge_index, edge_attr)
 
-    return [data_mean, data_std]
+    # ~~~~ Normalize edge attributes 
+    eps = 1e-10
+    edge_attr = np.array(edge_attr)
+    edge_attr_mean = edge_attr.mean()
+    edge_attr_std = edge_attr.std()
+    edge_attr = (edge_attr - edge_attr_mean)/(edge_attr_std + eps) 
 
+    # ~~~~ Domain bounding box for node positions: [xlo, xhi, ylo, yhi]
+    pos = np.array(pos)
+    bounding_box = np.array([pos[:,0].min(), pos[:,0].max(), pos[:,1].min(), pos[:,1].max()])
+
+    arrays = {
+        'edge_index' : np.array(edge_index),
+        'edge_attr' : edge_attr,
+        'edge_attr_mean' : edge_attr_mean,
+        'edge_attr_std' : edge_attr_std,
+        'edge_index_radius' : np.array(edge_index_rad),
+        'pos' : pos,
+        'bounding_box' : bounding_box}
+    if perm is not None:
+        arrays['perm'] = perm
+        arrays['inv_perm'] = inv_perm
+    return arrays
 
 
 def get_pygeom_dataset_cell_data(
-        path_to_vtk : str, 
-        path_to_ei : str, 
-        path_to_ea : str, 
-        path_to_pos : str, 
+        path_to_vtk : str,
+        path_to_ei : str,
+        path_to_ea : str,
+        path_to_pos : str,
+        device_for_loading : str,
+        use_radius : bool,
+        time_skip : Optional[int] = 1,
+        time_lag : Optional[int] = 1,
+        scaling : Optional[list] = None,
+        features_to_keep : Optional[list] = None,
+        fraction_valid : Optional[float] = 0.1,
+        multiple_cases : Optional[bool] = False,
+        seed : Optional[int] = None,
+        cache_dir : Optional[str] = None,
+        shared_topology : Optional[bool] = False,
+        reorder : Optional[str] = None,
+        snapshot_dtype : Optional[str] = 'float32') -> tuple[list,list]:
+    """
+    Returns lists of training and validation pyGeom Data objects for a BFS case.
+
+    If shared_topology = True, SharedTopologyDatasets are returned instead: the
+    samples only carry node fields, and the mesh is held once in
+    dataset.topology (to be batched with SharedTopologyCollater).
+
+    The snapshots of a case are held once as a [n_snaps, n_nodes, n_features]
+    tensor: x and y[t] of each sample are views into it, so the memory does not
+    depend on time_lag.
+
+    If cache_dir is given, the scaled snapshots are written to a binary cache
+    in cache_dir, keyed by a fingerprint of the VTK file and the processing
+    parameters. Later calls with the same inputs load the cache instead of
+    re-reading the VTK file. Neither time_lag nor the train/valid split enter
+    the cache, so changing the rollout length does not require re-processing.
+    The mesh topology is cached separately (see get_mesh_topology).
+
+    If reorder is given, the nodes of the mesh and of the snapshots are
+    renumbered (see get_mesh_topology). snapshot_dtype is the dtype the
+    scaled snapshots are held (and cached) in, see dataprep/precision.py;
+    batches are upcast to float32 by SharedTopologyCollater.
+    """
+    tensors = load_cell_data(
+            path_to_vtk,
+            time_skip = time_skip,
+            scaling = scaling,
+            features_to_keep = features_to_keep,
+            multiple_cases = multiple_cases,
+            cache_dir = cache_dir,
+            node_perm = _node_perm(path_to_ei, path_to_pos, use_radius, cache_dir, reorder),
+            snapshot_dtype = snapshot_dtype)
+
+    return _make_pygeom_datasets(
+            tensors['snapshots'],
+            tensors['time_vec'],
+            tensors['data_mean'],
+            tensors['data_std'],
+            tensors['field_names'],
+            path_to_ei,
+            path_to_pos,
+            device_for_loading,
+            use_radius,
+            time_lag = time_lag,
+            fraction_valid = fraction_valid,
+            seed = seed,
+            cache_dir = cache_dir,
+            shared_topology = shared_topology,
+            reorder = reorder)
+
+
+def get_pygeom_dataset_cell_data_multiple(
+        paths_to_vtk : List[str],
+        path_to_ei : str,
+        path_to_ea : str,
+        path_to_pos : str,
+        device_for_loading : str,
+        use_radius : bool,
+        time_skip : Optional[int] = 1,
+        time_lag : Optional[int] = 1,
+        scaling : Optional[list] = None,
+        features_to_keep : Optional[list] = None,
+        fraction_valid : Optional[float] = 0.1,
+        seeds : Optional[List[int]] = None,
+        cache_dir : Optional[str] = None,
+        num_workers : Optional[int] = 1,
+        node_shm : Optional[NodeSharedMemory] = None,
+        reorder : Optional[str] = None,
+        snapshot_dtype : Optional[str] = 'float32') -> tuple[list,list,list]:
+    """
+    Loads several BFS cases on the same mesh as SharedTopologyDatasets. The VTK
+    files are read by a pool of num_workers processes; the mesh topology is
+    built once, in this process. Returns the per-case training and validation
+    datasets, and the per-case load times in seconds.
+
+    If node_shm is given, only the local rank 0 of each node loads the
+    snapshots, into node shared memory, and the other ranks attach to them.
+    """
+    n_cases = len(paths_to_vtk)
+    if seeds is None:
+        seeds = [None] * n_cases
+
+    get_mesh_topology(path_to_ei, path_to_pos, use_radius, cache_dir = cache_dir, reorder = reorder)
+    node_perm = _node_perm(path_to_ei, path_to_pos, use_radius, cache_dir, reorder)
+
+    load_kwargs = {
+            'time_skip' : time_skip,
+            'scaling' : scaling,
+            'features_to_keep' : features_to_keep,
+            'cache_dir' : cache_dir,
+            'node_perm' : node_perm,
+            'snapshot_dtype' : snapshot_dtype}
+    if node_shm is None:
+        results = _load_cell_data_parallel(paths_to_vtk, num_workers, **load_kwargs)
+    else:
+        t_start = time.time()
+        keys = ['bfs_snapshots_%s' %(_cell_data_key(path, time_skip, scaling, features_to_keep, False, node_perm, snapshot_dtype)) for path in paths_to_vtk]
+        load_fn = lambda missing : [result[0] for result in _load_cell_data_parallel(
+                [paths_to_vtk[i] for i in missing], num_workers, **load_kwargs)]
+        shared = node_shm.share(keys, load_fn)
+        load_time = (time.time() - t_start) / n_cases
+        results = [(tensors, load_time) for tensors in shared]
+
+    data_train = []
+    data_valid = []
+    load_times = []
+    for c in range(n_cases):
+        tensors, load_time = results[c]
+        data_train_c, data_valid_c = _make_pygeom_datasets(
+                tensors['snapshots'],
+                tensors['time_vec'],
+                tensors['data_mean'],
+                tensors['data_std'],
+                tensors['field_names'],
+                path_to_ei,
+                path_to_pos,
+                device_for_loading,
+                use_radius,
+                time_lag = time_lag,
+                fraction_valid = fraction_valid,
+                seed = seeds[c],
+                cache_dir = cache_dir,
+                shared_topology = True,
+                reorder = reorder)
+        data_train.append(data_train_c)
+        data_valid.append(data_valid_c)
+        load_times.append(load_time)
+
+    return data_train, data_valid, load_times
+
+
+def load_cell_data(
+        path_to_vtk : str,
+        time_skip : Optional[int] = 1,
+        scaling : Optional[list] = None,
+        features_to_keep : Optional[list] = None,
+        multiple_cases : Optional[bool] = False,
+        cache_dir : Optional[str] = None,
+        node_perm : Optional[np.ndarray] = None,
+        snapshot_dtype : Optional[str] = 'float32') -> dict:
+    """
+    Returns the scaled snapshots of a case, reading them from the cache in
+    cache_dir if present. If node_perm is given, the nodes of the snapshots
+    are reordered as x[node_perm]. The snapshots are held and cached in
+    snapshot_dtype (see dataprep/precision.py).
+    """
+    tensors = None
+    if cache_dir is not None:
+        key = _cell_data_key(path_to_vtk, time_skip, scaling, features_to_keep, multiple_cases, node_perm, snapshot_dtype)
+        path_to_cache = os.path.join(cache_dir, 'bfs_snapshots_%s.pt' %(key))
+        tensors = load_cache(path_to_cache)
+
+    if tensors is None:
+        tensors = _read_cell_data(
+                path_to_vtk,
+                time_skip = time_skip,
+                scaling = scaling,
+                features_to_keep = features_to_keep,
+                multiple_cases = multiple_cases,
+                node_perm = node_perm,
+                snapshot_dtype = snapshot_dtype)
+        if cache_dir is not None:
+            save_cache(tensors, path_to_cache)
+    return tensors
+
+
+def _cell_data_key(
+        path_to_vtk : str,
+        time_skip : int,
+        scaling : Optional[list],
+        features_to_keep : Optional[list],
+        multiple_cases : bool,
+        node_perm : Optional[np.ndarray] = None,
+        snapshot_dtype : Optional[str] = 'float32') -> str:
+    inputs = {
+        'vtk' : file_fingerprint(path_to_vtk),
+        'time_skip' : time_skip,
+        'scaling' : scaling,
+        'features_to_keep' : features_to_keep,
+        'multiple_cases' : multiple_cases}
+    if node_perm is not None:
+        inputs['node_perm'] = permutation_key(node_perm)
+    if snapshot_dtype != 'float32':
+        inputs['snapshot_dtype'] = snapshot_dtype
+    return cache_key(inputs)
+
+
+def _timed_load_cell_data(path_to_vtk : str, **kwargs) -> tuple[dict,float]:
+    t_start = time.time()
+    tensors = load_cell_data(path_to_vtk, **kwargs)
+    return tensors, time.time() - t_start
+
+
+def _load_cell_data_parallel(
+        paths_to_vtk : List[str],
+        num_workers : int,
+        **kwargs) -> list:
+    """
+    Runs load_cell_data on each path with a pool of num_workers processes.
+    Returns a list of (tensors, load time) tuples.
+    """
+    load_fn = partial(_timed_load_cell_data, **kwargs)
+    n_cases = len(paths_to_vtk)
+    if num_workers > 1 and n_cases > 1:
+        # fork, so that workers do not re-run the (MPI-initializing) main script
+        mp_context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=min(num_workers, n_cases), mp_context=mp_context) as pool:
+            results = list(pool.map(load_fn, paths_to_vtk))
+    else:
+        results = [load_fn(path_to_vtk) for path_to_vtk in paths_to_vtk]
+    return results
+
+
+def get_num_snapshots(
+        path : str,
+        time_skip : Optional[int] = 1,
+        multiple_cases : Optional[bool] = False,
+        cache_dir : Optional[str] = None) -> int:
+    """
+    Number of snapshots of a case after time_skip. path is either a VTK file or
+    a snapshot store. For VTK files the whole file has to be read once, so the
+    count is kept in cache_dir for later runs.
+    """
+    if os.path.isdir(path):
+        return len(open_snapshot_store(path, time_skip = time_skip))
+
+    arrays = None
+    if cache_dir is not None:
+        key = cache_key({
+            'vtk' : file_fingerprint(path),
+            'multiple_cases' : multiple_cases})
+        path_to_cache = os.path.join(cache_dir, 'bfs_num_snapshots_%s.npz' %(key))
+        arrays = load_npz_cache(path_to_cache)
+
+    if arrays is None:
+        _, time_vec, _ = read_vtk_snapshots(path, multiple_cases)
+        arrays = {'n_snaps' : np.array(len(time_vec))}
+        if cache_dir is not None:
+            save_npz_cache(arrays, path_to_cache)
+
+    return len(range(0, int(arrays['n_snaps']), time_skip))
+
+
+def get_pygeom_dataset_sharded(
+        paths : List[str],
+        n_snaps : List[int],
+        rank : int,
+        size : int,
+        path_to_ei : str,
+        path_to_pos : str,
+        device_for_loading : str,
+        use_radius : bool,
+        time_skip : Optional[int] = 1,
+        time_lag : Optional[int] = 1,
+        scaling : Optional[list] = None,
+        features_to_keep : Optional[list] = None,
+        fraction_valid : Optional[float] = 0.1,
+        seeds : Optional[List[int]] = None,
+        cache_dir : Optional[str] = None,
+        num_workers : Optional[int] = 1,
+        reorder : Optional[str] = None,
+        snapshot_dtype : Optional[str] = 'float32') -> tuple[list,list,dict]:
+    """
+    Rank-sharded loading of several BFS cases on the same mesh. paths are VTK
+    files or snapshot stores, and n_snaps their snapshot counts (see
+    get_num_snapshots). The train/valid split of every case is decided first,
+    the global train and valid index spaces are partitioned across ranks with
+    shard_samples, and this rank only loads the cases (and keeps only the
+    snapshots) that its shard uses.
+
+    Returns the per-case training and validation datasets of this rank, and
+    a dict {case : load time in s} of the cases it loaded. The datasets are
+    meant to be sampled with a ShardedSampler.
+    """
+    if seeds is None or None in seeds:
+        raise ValueError('Sharded loading needs a seed per case, so that all ranks agree on the split.')
+    n_cases = len(paths)
+
+    # ~~~~ Decide the train/valid index space, then this rank's shard
+    splits = [_split_train_valid(n_snaps[c] - time_lag, fraction_valid, seeds[c]) for c in range(n_cases)]
+    shard_train, _ = shard_samples([len(split[0]) for split in splits], rank, size)
+    shard_valid = {}
+    if fraction_valid > 0:
+        shard_valid, _ = shard_samples([len(split[1]) for split in splits], rank, size)
+    case_ids = sorted(set(shard_train) | set(shard_valid))
+
+    get_mesh_topology(path_to_ei, path_to_pos, use_radius, cache_dir = cache_dir, reorder = reorder)
+    node_perm = _node_perm(path_to_ei, path_to_pos, use_radius, cache_dir, reorder)
+
+    # ~~~~ Load only the cases used by this shard
+    load_times = {}
+    if os.path.isdir(paths[0]):
+        tensors = {}
+        for c in case_ids:
+            t_start = time.time()
+            store = open_snapshot_store(paths[c], time_skip = time_skip, scaling = scaling, features_to_keep = features_to_keep, node_perm = node_perm)
+            tensors[c] = _store_tensors(store)
+            load_times[c] = time.time() - t_start
+    else:
+        results = _load_cell_data_parallel(
+                [paths[c] for c in case_ids],
+                num_workers,
+                time_skip = time_skip,
+                scaling = scaling,
+                features_to_keep = features_to_keep,
+                cache_dir = cache_dir,
+                node_perm = node_perm,
+                snapshot_dtype = snapshot_dtype)
+        tensors = {}
+        for c, result in zip(case_ids, results):
+            tensors[c], load_times[c] = result
+
+    data_train = []
+    data_valid = []
+    for c in case_ids:
+        idx_train, idx_valid = splits[c]
+        idx_train = idx_train[shard_train.get(c, [])]
+        idx_valid = idx_valid[shard_valid.get(c, [])]
+        data_train_c, data_valid_c = _make_pygeom_datasets(
+                tensors[c]['snapshots'],
+                tensors[c]['time_vec'],
+                tensors[c]['data_mean'],
+                tensors[c]['data_std'],
+                tensors[c]['field_names'],
+                path_to_ei,
+                path_to_pos,
+                device_for_loading,
+                use_radius,
+                time_lag = time_lag,
+                fraction_valid = fraction_valid,
+                cache_dir = cache_dir,
+                shared_topology = True,
+                idx = (idx_train, idx_valid),
+                reorder = reorder)
+        data_train.append(data_train_c)
+        if fraction_valid > 0:
+            data_valid.append(data_valid_c)
+
+    return data_train, data_valid, load_times
+
+
+def get_pygeom_dataset_snapshot_store(
+        path_to_store : str,
+        path_to_ei : str,
+        path_to_pos : str,
         device_for_loading : str,
         use_radius : bool,
         time_skip : Optional[int] = 1,
         time_lag : Optional[int] = 1,
         scaling : Optional[list] = None,
-        features_to_keep : Optional[list] = None, 
-        fraction_valid : Optional[float] = 0.1, 
-        multiple_cases : Optional[bool] = False ) -> tuple[list,list]:
+        features_to_keep : Optional[list] = None,
+        fraction_valid : Optional[float] = 0.1,
+        seed : Optional[int] = None,
+        cache_dir : Optional[str] = None,
+        reorder : Optional[str] = None) -> tuple[SharedTopologyDataset,SharedTopologyDataset]:
+    """
+    Same as get_pygeom_dataset_cell_data(shared_topology = True), but reads
+    the snapshots lazily from a chunked snapshot store (see
+    dataprep/snapshot_store.py) instead of loading the case into memory. Only
+    the kept features and the time_skip-th snapshots are read from disk.
+    POD stores (see dataprep/pod.py) are read the same way, with the
+    snapshots reconstructed on access.
+    """
+    store = open_snapshot_store(
+            path_to_store,
+            time_skip = time_skip,
+            scaling = scaling,
+            features_to_keep = features_to_keep,
+            node_perm = _node_perm(path_to_ei, path_to_pos, use_radius, cache_dir, reorder))
+    tensors = _store_tensors(store)
+
+    return _make_pygeom_datasets(
+            tensors['snapshots'],
+            tensors['time_vec'],
+            tensors['data_mean'],
+            tensors['data_std'],
+            tensors['field_names'],
+            path_to_ei,
+            path_to_pos,
+            device_for_loading,
+            use_radius,
+            time_lag = time_lag,
+            fraction_valid = fraction_valid,
+            seed = seed,
+            cache_dir = cache_dir,
+            shared_topology = True,
+            reorder = reorder)
+
+
+def _store_tensors(store : SnapshotStore) -> dict:
+    """
+    Same entries as load_cell_data, with the snapshots read lazily from store.
+    """
+    return {
+        'snapshots' : store,
+        'time_vec' : torch.tensor(store.time_vec),
+        'data_mean' : torch.tensor(np.reshape(store.data_mean, (1,1,1,-1))),
+        'data_std' : torch.tensor(np.reshape(store.data_std, (1,1,1,-1))),
+        'field_names' : store.meta['field_names']}
+
+
+def _make_pygeom_datasets(
+        snapshots : Union[torch.Tensor, SnapshotStore],
+        time_vec : torch.Tensor,
+        data_mean : torch.Tensor,
+        data_std : torch.Tensor,
+        field_names : list,
+        path_to_ei : str,
+        path_to_pos : str,
+        device_for_loading : str,
+        use_radius : bool,
+        time_lag : Optional[int] = 1,
+        fraction_valid : Optional[float] = 0.1,
+        seed : Optional[int] = None,
+        cache_dir : Optional[str] = None,
+        shared_topology : Optional[bool] = False,
+        idx : Optional[tuple] = None,
+        reorder : Optional[str] = None) -> tuple:
+    """
+    Builds the train/valid datasets of a case from its snapshots. If idx =
+    (idx_train, idx_valid) is given, the split is not drawn here, and only the
+    snapshots spanned by these windows are kept.
+    """
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # Time lagged windows: 
+    # if time_lag = 0, data_x = data_y 
+    # if time_lag > 0, dataset size decreases by value of time_lag.
+    #       -- data_y contains future snapshots for input data_x
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    if idx is None:
+        n_windows = len(snapshots) - time_lag
+        idx_train, idx_valid = _split_train_valid(n_windows, fraction_valid, seed)
+    else:
+        idx_train, idx_valid = idx
+        if isinstance(snapshots, torch.Tensor):
+            idx_all = np.concatenate((idx_train, idx_valid))
+            lo = int(idx_all.min())
+            hi = int(idx_all.max()) + time_lag + 1
+            snapshots = snapshots[lo:hi].clone()
+            time_vec = time_vec[lo:hi].clone()
+            idx_train = idx_train - lo
+            idx_valid = idx_valid - lo
+
+    if isinstance(snapshots, torch.Tensor):
+        snapshots = snapshots.to(device_for_loading)
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # Mesh topology: shared by all cases on this mesh
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    mesh_topology = get_mesh_topology(
+            path_to_ei,
+            path_to_pos,
+            use_radius,
+            cache_dir = cache_dir,
+            reorder = reorder)
+
+    topology = Data(
+            distance = mesh_topology['distance'],
+            edge_index = mesh_topology['edge_index'],
+            edge_attr = mesh_topology['edge_attr'],
+            pos = mesh_topology['pos'],
+            bounding_box = mesh_topology['bounding_box'],
+            data_scale = (data_mean, data_std),
+            edge_scale = (mesh_topology['edge_attr_mean'], mesh_topology['edge_attr_std']),
+            field_names = np.array(field_names)).to(device_for_loading)
+
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # Make pyGeom dataset
+    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    data_train = SharedTopologyDataset(
+            snapshots,
+            time_vec,
+            idx_train,
+            time_lag,
+            topology)
+    data_valid = []
+    if fraction_valid > 0:
+        data_valid = SharedTopologyDataset(
+                snapshots,
+                time_vec,
+                idx_valid,
+                time_lag,
+                topology)
+
+    if shared_topology:
+        return data_train, data_valid
+
+    # Lists of self-contained Data objects
+    data_train_list = [data_train.get_full(i) for i in range(len(data_train))]
+    data_valid_list = [data_valid.get_full(i) for i in range(len(data_valid))]
+
+    # print('\n\tTraining samples: ', len(data_train_list))
+    # print('\tValidation samples: ', len(data_valid_list))
+    # print('\tN_nodes: ', data_train_list[0].x.shape[0])
+    # print('\tN_edges: ', data_train_list[0].edge_index.shape[1])
+    # print('\tN_features: ', data_train_list[0].x.shape[1])
+    # print('\thas_self_loops: ', data_train_list[0].has_self_loops())
+    # print('\n')
+
+    return data_train_list, data_valid_list
+
+
+def read_vtk_snapshots(
+        path_to_vtk : str,
+        multiple_cases : Optional[bool] = False) -> tuple[np.ndarray,np.ndarray,np.ndarray]:
+    """
+    Reads all snapshots from a BFS VTK file. Returns the data as
+    [n_cells, n_features, n_snaps], the time vector and the field names.
+    """
     #print('Reading vtk: %s' %(path_to_vtk))
     mesh = pv.read(path_to_vtk)
     
@@ -100,7 +752,7 @@ def get_pygeom_dataset_cell_data(
         case_path_list = mesh.field_data['case_path_list']
         n_cases = len(case_path_list)
         for c in range(n_cases):
-            data_full_c = np.array(mesh.cell_data['x_%d' %(c)]) # [N_nodes x (N_features x N_snaps)]
+            data_full_c = np.asarray(mesh.cell_data['x_%d' %(c)]) # [N_nodes x (N_features x N_snaps)]
             time_vec_c = np.array(mesh.field_data['time_%d' %(c)])
             field_names = np.array(mesh.field_data['field_list'])
             n_cells = mesh.n_cells
@@ -113,11 +765,10 @@ def get_pygeom_dataset_cell_data(
         # Concatenate data_full_temp and time_vec 
         data_full_temp = np.concatenate(data_full_temp, axis=2)
         time_vec = np.concatenate(time_vec)
-        n_snaps = len(time_vec)
     else:
         #print('\tsingle case...')
         # Node features 
-        data_full_temp = np.array(mesh.cell_data['x']) # [N_nodes x (N_features x N_snaps)]
+        data_full_temp = np.asarray(mesh.cell_data['x']) # [N_nodes x (N_features x N_snaps)]
         field_names = np.array(mesh.field_data['field_list'])
         time_vec = np.array(mesh.field_data['time'])
         n_cells = mesh.n_cells
@@ -125,144 +776,39 @@ def get_pygeom_dataset_cell_data(
         n_snaps = len(time_vec)
         data_full_temp = np.reshape(data_full_temp, (n_cells, n_features, n_snaps), order='F')
 
-    # Timestep reduction 
-    # data_full_temp, time_vec, n_snaps 
-    data_full_temp = data_full_temp[:, :, ::time_skip]
-    time_vec = time_vec[::time_skip]
-    n_snaps = len(time_vec)
-    dt = time_vec[1:] - time_vec[:-1]
-
-    # Do a dumb reshape
-    data_full = np.zeros((n_snaps, n_cells, n_features), dtype=np.float32)
-    for i in range(n_snaps):
-        data_full[i,:,:] = data_full_temp[:,:,i]
-
-    # Edge attributes and index, and node positions 
-    #print('Reading edge index and node positions...')
-    edge_index = torch.tensor(np.loadtxt(path_to_ei, dtype=np.longlong).T)
-    #edge_attr = np.loadtxt(path_to_ea, dtype=np.float32)
-    pos = torch.tensor(np.loadtxt(path_to_pos, dtype=np.float32))
-  
-    # Distance field
-    #distance = np.array(mesh.cell_data['distance'], dtype=np.float32)
-    #distance = np.reshape(distance, (n_cells, 1), order='F')
-    distance = np.zeros((n_cells, 1))
-
-    if use_radius:
-        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-        # Create radius graph
-        # -- outputs are edge_index and edge_attr
-        # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-        pos = torch.tensor(pos)
-        radius = 0.001 # m
-        self_loops = False
-        max_num_neighbors = 30 
-        edge_index_rad = tgnn.radius_graph(pos, r=radius, max_num_neighbors=max_num_neighbors)
-        edge_index = torch.concat((edge_index_rad, torch.tensor(edge_index)), axis=1)
-
-    # ~~~~ Populate edge_attr and coalesce edge_index
-    data_ref = Data( pos = pos, edge_index = edge_index )
-    cart = transforms.Cartesian(norm=False, max_value = None, cat = False)
-    dist = transforms.Distance(norm = False, max_value = None, cat = True)
-
-    # populate edge_attr
-    cart(data_ref) # adds cartesian/component-wise distance
-    dist(data_ref) # adds euclidean distance
-
-    # extract edge_attr
-    edge_attr = data_ref.edge_attr
-
-    # Eliminate duplicate edges
-    edge_index, edge_attr = utils.coalesce(edge_index, edge_attr)
+    return data_full_temp, time_vec, field_names
 
-    # change back to numpy 
-    pos = np.array(pos)
-    edge_attr = np.array(edge_attr)
 
-    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    # Create Time Lagged Data
-    # if time_lag = 0, just copy data such that data_x = data_y 
-    # if time_lag > 0, dataset size decreases by value of time_lag.
-    #       -- data_y contains future snapshots for input data_x
-    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    n_snaps = data_full.shape[0] - time_lag
-    data_x = [] 
-    data_y = []
-    time_y = []
-    for i in range(n_snaps): 
-        data_x.append([data_full[i]]) 
-        if time_lag == 0:
-            y_temp = [data_full[i]]
-            time_temp = [time_vec[i]]
-        else:
-            y_temp = []
-            time_temp = [] 
-            for t in range(1, time_lag+1):
-                y_temp.append(data_full[i+t])
-                time_temp.append(time_vec[i+t])
-        data_y.append(y_temp)
-        time_y.append(time_temp)
-    
-    data_x = np.array(data_x) # shape: [n_snaps, 1, n_nodes, n_features]
-    data_y = np.array(data_y) # shape: [n_snaps, time_lag, n_nodes, n_features]
-    time_y = np.array(time_y) # shape: [n_snaps, time_lag] 
-
-    if time_lag > 0:
-        time_vec = time_vec[:-time_lag] 
-
-    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    # Shuffle -- train/valid split
-    # set aside 10% of the data for validation  
-    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    #print('arranging data for train/valid split...')
-    #print('\tvalidation size is %g * n_data' %(fraction_valid))
-    
-    if fraction_valid > 0:
-        # How many total snapshots to extract 
-        n_full = n_snaps
-        n_valid = int(np.floor(fraction_valid * n_full))
-
-        # Get validation set indices 
-        idx_valid = np.sort(np.random.choice(n_full, n_valid, replace=False))
-
-        # Get training set indices 
-        idx_train = np.array(list(set(list(range(n_full))) - set(list(idx_valid))))
-
-        # Train/test split 
-        data_x_train = data_x[idx_train]
-        data_y_train = data_y[idx_train]
-
-        data_x_valid = data_x[idx_valid]
-        data_y_valid = data_y[idx_valid]
-
-        time_vec_train = time_vec[idx_train]
-        time_vec_valid = time_vec[idx_valid]
+def _read_cell_data(
+        path_to_vtk : str,
+        time_skip : Optional[int] = 1,
+        scaling : Optional[list] = None,
+        features_to_keep : Optional[list] = None,
+        multiple_cases : Optional[bool] = False,
+        node_perm : Optional[np.ndarray] = None,
+        snapshot_dtype : Optional[str] = 'float32') -> dict:
+    """
+    Reads the VTK file and returns the scaled snapshots, [n_snaps, n_nodes,
+    n_features] in snapshot_dtype, and their times. Time-lagged windows are
+    not materialized.
+    """
+    data_full_temp, time_vec, field_names = read_vtk_snapshots(path_to_vtk, multiple_cases)
+    n_cells, n_features, n_snaps = data_full_temp.shape
+    if features_to_keep == None:
+        features_to_keep = list(range(n_features))
 
-        time_y_train = time_y[idx_train]
-        time_y_valid = time_y[idx_valid]
+    # Timestep reduction, as a [n_snaps, n_cells, n_features] view of the
+    # VTK data
+    data_full = data_full_temp.transpose(2, 0, 1)[::time_skip]
+    time_vec = time_vec[::time_skip]
+    n_snaps = len(time_vec)
 
-        n_train = n_full - n_valid
+    # Node reordering and features_to_keep, gathered in a single copy
+    if node_perm is not None:
+        data_full = data_full[:, np.asarray(node_perm)[:,None], features_to_keep]
     else:
-        data_x_train = data_x
-        data_y_train = data_y
-        data_x_valid = None
-        data_y_valid = None
-        time_vec_train = time_vec
-        time_vec_valid = time_vec
-        time_y_train = time_y
-        time_y_valid = time_y
-        n_full = n_snaps
-        n_valid = 0
-        n_train = n_full
-    
-    #print('\tn_full: ', n_full)
-    #print('\tn_train: ', n_train)
-    #print('\tn_valid: ', n_valid)
-
-    #print('data_x_train: ', data_x_train.shape)
-    #print('data_y_train: ', data_y_train.shape)
-    #print('data_x_valid: ', data_x_valid.shape)
-    #print('data_y_valid: ', data_y_valid.shape)
+        data_full = data_full[:, :, features_to_keep]
+    data_full = np.asarray(data_full, dtype=np.float32)
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     # Scaling node features
@@ -275,118 +821,46 @@ def get_pygeom_dataset_cell_data(
         data_train_mean = np.zeros(n_features)
         data_train_std = np.ones(n_features)
 
-    data_train_mean = np.reshape(data_train_mean, (1,1,1,-1))
-    data_train_std = np.reshape(data_train_std, (1,1,1,-1))
+    data_train_mean = np.reshape(data_train_mean, (1,1,1,-1))[:,:,:,features_to_keep]
+    data_train_std = np.reshape(data_train_std, (1,1,1,-1))[:,:,:,features_to_keep]
 
-    data_x_train = (data_x_train - data_train_mean)/(data_train_std + eps)
-    data_y_train = (data_y_train - data_train_mean)/(data_train_std + eps)
-    if fraction_valid > 0:
-        data_x_valid = (data_x_valid - data_train_mean)/(data_train_std + eps)
-        data_y_valid = (data_y_valid - data_train_mean)/(data_train_std + eps)
-    
-    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    # Normalize edge attributes 
-    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    edge_attr_mean = edge_attr.mean()
-    edge_attr_std = edge_attr.std()
-    edge_attr = (edge_attr - edge_attr_mean)/(edge_attr_std + eps) 
-
-    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    # Make pyGeom dataset 
-    # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    data_x_train = torch.tensor(data_x_train, dtype=torch.float32)
-    data_y_train = torch.tensor(data_y_train, dtype=torch.float32)
-    time_vec_train = torch.tensor(time_vec_train)
-    time_y_train = torch.tensor(time_y_train)
-    if fraction_valid > 0:
-        data_x_valid = torch.tensor(data_x_valid, dtype=torch.float32)
-        data_y_valid = torch.tensor(data_y_valid, dtype=torch.float32)
-        time_vec_valid = torch.tensor(time_vec_valid)
-        time_y_valid = torch.tensor(time_y_valid)
-    
-    edge_index = torch.tensor(edge_index)
-    edge_attr = torch.tensor(edge_attr)
-    pos = torch.tensor(pos)
-    distance = torch.tensor(distance)
-    
-    # Re-sort:  
-    edge_index, edge_attr = utils.coalesce(edge_index, edge_attr)
-
-    # Add self loops:
-    #edge_index, edge_attr = utils.add_self_loops(edge_index, edge_attr, fill_value='mean')
-
-    # Restrict data based on features_to_keep: 
-    if features_to_keep == None:
-        n_features = data_x_train[0].shape[-1]
-        features_to_keep = list(range(n_features))
-    data_x_train = data_x_train[:,:,:,features_to_keep]
-    data_y_train = data_y_train[:,:,:,features_to_keep]
-    if fraction_valid > 0:
-        data_x_valid = data_x_valid[:,:,:,features_to_keep]
-        data_y_valid = data_y_valid[:,:,:,features_to_keep]
-    data_train_mean = data_train_mean[:,:,:,features_to_keep]
-    data_train_std = data_train_std[:,:,:,features_to_keep]
+    # in place, in float32
+    data_full -= data_train_mean[0].astype(np.float32)
+    data_full /= (data_train_std[0] + eps).astype(np.float32)
+    data_full = to_storage(torch.from_numpy(data_full), snapshot_dtype)
+    time_vec = torch.tensor(time_vec)
 
     data_train_mean = torch.tensor(data_train_mean)
     data_train_std = torch.tensor(data_train_std)
 
-    # Training 
-    data_train_list = []
-    for i in range(n_train):
-        if time_lag == 0:
-            y_temp = data_y_train[i,0]
-        else:
-            y_temp = [] 
-            for t in range(time_lag):
-                y_temp.append(data_y_train[i,t])
-
-        data_temp = Data(   x = data_x_train[i,0],
-                            y = y_temp,
-                            distance = distance, 
-                            edge_index = edge_index,
-                            edge_attr = edge_attr,
-                            pos = pos,
-                            bounding_box = [pos[:,0].min(), pos[:,0].max(), pos[:,1].min(), pos[:,1].max()],
-                            data_scale = (data_train_mean, data_train_std),
-                            edge_scale = (edge_attr_mean, edge_attr_std),
-                            t_x = time_vec_train[i],
-                            t_y = time_y_train[i],
-                            field_names = field_names)
-        data_temp = data_temp.to(device_for_loading)
-        data_train_list.append(data_temp)
-
-    # Testing: 
-    data_valid_list = []
-    if fraction_valid > 0: 
-        for i in range(n_valid):
-            if time_lag == 0:
-                y_temp = data_y_valid[i,0]
-            else:
-                y_temp = [] 
-                for t in range(time_lag):
-                    y_temp.append(data_y_valid[i,t])
-
-            data_temp = Data(   x = data_x_valid[i,0],
-                                y = y_temp,
-                                distance = distance,
-                                edge_index = edge_index,
-                                edge_attr = edge_attr,
-                                pos = pos,
-                                bounding_box = [pos[:,0].min(), pos[:,0].max(), pos[:,1].min(), pos[:,1].max()],
-                                data_scale = (data_train_mean, data_train_std),
-                                edge_scale = (edge_attr_mean, edge_attr_std),
-                                t_x = time_vec_valid[i],
-                                t_y = time_y_valid[i],
-                                field_names = field_names)
-            data_temp = data_temp.to(device_for_loading)
-            data_valid_list.append(data_temp)
+    return {
+        'snapshots' : data_full,
+        'time_vec' : time_vec,
+        'data_mean' : data_train_mean,
+        'data_std' : data_train_std,
+        'field_names' : [str(name) for name in field_names]}
+
+
+def _split_train_valid(
+        n_full : int,
+        fraction_valid : float,
+        seed : Optional[int] = None) -> tuple[np.ndarray,np.ndarray]:
+    """
+    Shuffle -- train/valid split of n_full samples. Returns the train and
+    valid sample indices.
+    """
+    if fraction_valid > 0:
+        n_valid = int(np.floor(fraction_valid * n_full))
 
-    # print('\n\tTraining samples: ', len(data_train_list))
-    # print('\tValidation samples: ', len(data_valid_list))
-    # print('\tN_nodes: ', data_train_list[0].x.shape[0])
-    # print('\tN_edges: ', data_train_list[0].edge_index.shape[1])
-    # print('\tN_features: ', data_train_list[0].x.shape[1])
-    # print('\thas_self_loops: ', data_train_list[0].has_self_loops())
-    # print('\n')
+        # Get validation set indices 
+        rng = np.random if seed is None else np.random.RandomState(seed)
+        idx_valid = np.sort(rng.choice(n_full, n_valid, replace=False))
 
-    return data_train_list, data_valid_list
+        # Get training set indices 
+        is_train = np.ones(n_full, dtype=bool)
+        is_train[idx_valid] = False
+        idx_train = np.nonzero(is_train)[0]
+    else:
+        idx_train = np.arange(n_full)
+        idx_valid = np.arange(0)
+    return idx_train, idx_valid
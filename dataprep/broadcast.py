@@ -0,0 +1,142 @@
+"""
+Read-once, broadcast-to-all for small shared artifacts (statistics,
+checkpoints, mesh topology): rank 0 reads the file, and the other ranks
+receive the contents over the process group instead of hitting the shared
+filesystem at the same time
+"""
+from __future__ import absolute_import, division, print_function, annotations
+from typing import Optional, Union, Callable, List
+import numpy as np
+
+import torch
+from torch import Tensor
+import torch.distributed as dist
+
+
+class _TensorMeta:
+    """
+    Placeholder for a tensor in the skeleton of a broadcast object.
+    """
+    def __init__(self, index : int, shape : tuple, dtype : torch.dtype):
+        self.index = index
+        self.shape = shape
+        self.dtype = dtype
+
+
+def _split_tensors(obj, tensors : List[Tensor]):
+    """
+    Replaces the tensors in a nested dict/list/tuple by _TensorMeta
+    placeholders, and appends them to tensors.
+    """
+    if isinstance(obj, Tensor):
+        tensors.append(obj.detach())
+        return _TensorMeta(len(tensors) - 1, tuple(obj.shape), obj.dtype)
+    if isinstance(obj, dict):
+        return type(obj)((key, _split_tensors(value, tensors)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_split_tensors(value, tensors) for value in obj)
+    return obj
+
+
+def _merge_tensors(obj, tensors : List[Tensor]):
+    if isinstance(obj, _TensorMeta):
+        return tensors[obj.index]
+    if isinstance(obj, dict):
+        return type(obj)((key, _merge_tensors(value, tensors)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_merge_tensors(value, tensors) for value in obj)
+    return obj
+
+
+def _collect_metas(obj, metas : List[_TensorMeta]) -> None:
+    if isinstance(obj, _TensorMeta):
+        metas.append(obj)
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            _collect_metas(value, metas)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            _collect_metas(value, metas)
+    return
+
+
+def _get_buckets(metas : List[_TensorMeta], bucket_size : int) -> List[List[_TensorMeta]]:
+    """
+    Groups tensors of the same dtype into buckets of at most bucket_size
+    bytes, in order. A tensor larger than bucket_size gets its own bucket.
+    """
+    buckets = {} # dtype --> list of buckets
+    for meta in metas:
+        nbytes = int(np.prod(meta.shape)) * torch.tensor([], dtype=meta.dtype).element_size()
+        dtype_buckets = buckets.setdefault(meta.dtype, [[[], 0]])
+        if dtype_buckets[-1][1] > 0 and dtype_buckets[-1][1] + nbytes > bucket_size:
+            dtype_buckets.append([[], 0])
+        dtype_buckets[-1][0].append(meta)
+        dtype_buckets[-1][1] += nbytes
+    return [bucket for dtype_buckets in buckets.values() for bucket, _ in dtype_buckets if len(bucket) > 0]
+
+
+def broadcast_tensors(
+        obj,
+        src : Optional[int] = 0,
+        device : Optional[Union[str, torch.device]] = 'cpu',
+        bucket_size_mb : Optional[float] = 25.):
+    """
+    Broadcasts obj, a nested dict/list/tuple holding tensors and other
+    picklable objects (e.g. a state dict or a checkpoint), from rank src. The
+    other ranks pass obj = None. Every rank gets a copy with its tensors on
+    the cpu, as with torch.load(..., map_location='cpu'); device is the
+    device used for the broadcasts ('cuda' with the nccl backend).
+
+    The structure is sent once as a pickled skeleton, and the tensors are
+    flattened into buckets of bucket_size_mb per dtype, so a large state dict
+    takes a few large broadcasts instead of one per tensor.
+    """
+    rank = dist.get_rank()
+    tensors = []
+    skeleton = [_split_tensors(obj, tensors) if rank == src else None]
+    dist.broadcast_object_list(skeleton, src=src, device=device)
+    skeleton = skeleton[0]
+
+    metas = []
+    _collect_metas(skeleton, metas)
+    metas = sorted(metas, key=lambda meta : meta.index)
+
+    received = [None] * len(metas)
+    for bucket in _get_buckets(metas, int(bucket_size_mb * 1024**2)):
+        numels = [int(np.prod(meta.shape)) for meta in bucket]
+        if rank == src:
+            flat = torch.cat([tensors[meta.index].reshape(-1).to(device) for meta in bucket])
+        else:
+            flat = torch.empty(sum(numels), dtype=bucket[0].dtype, device=device)
+        dist.broadcast(flat, src=src)
+        for meta, t in zip(bucket, torch.split(flat, numels)):
+            received[meta.index] = t.view(meta.shape).to('cpu', copy=True)
+    return _merge_tensors(skeleton, received)
+
+
+def load_and_broadcast(
+        load_fn : Callable[[], object],
+        src : Optional[int] = 0,
+        device : Optional[Union[str, torch.device]] = 'cpu',
+        bucket_size_mb : Optional[float] = 25.):
+    """
+    Returns load_fn() on every rank, with load_fn only called on rank src
+    (see broadcast_tensors). Without an initialized process group, load_fn is
+    simply called. An exception in load_fn on rank src is raised on all
+    ranks, so a missing file does not leave the other ranks waiting.
+    """
+    if not dist.is_initialized() or dist.get_world_size() == 1:
+        return load_fn()
+
+    status = [None]
+    obj = None
+    if dist.get_rank() == src:
+        try:
+            obj = load_fn()
+        except Exception as e:
+            status[0] = e
+    dist.broadcast_object_list(status, src=src, device=device)
+    if status[0] is not None:
+        raise status[0]
+    return broadcast_tensors(obj, src=src, device=device, bucket_size_mb=bucket_size_mb)
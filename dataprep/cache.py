@@ -0,0 +1,100 @@
+"""
+On-disk caching utilities for processed datasets
+"""
+from __future__ import absolute_import, division, print_function, annotations
+from typing import Optional, Union, Callable
+import os,json,hashlib
+import logging
+import numpy as np
+
+import torch
+
+log = logging.getLogger(__name__)
+
+
+def file_fingerprint(
+        path : str,
+        hash_contents : Optional[bool] = False) -> dict:
+    """
+    Fingerprint of a file on disk. By default this uses the file size and
+    modification time, which is cheap for the multi-GB VTK files. If
+    hash_contents = True, a sha1 of the file contents is used instead.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    fp = {'path' : path, 'size' : st.st_size}
+    if hash_contents:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                sha.update(block)
+        fp['sha1'] = sha.hexdigest()
+    else:
+        fp['mtime_ns'] = st.st_mtime_ns
+    return fp
+
+
+def _to_jsonable(obj):
+    if isinstance(obj, dict):
+        return {str(k) : _to_jsonable(v) for k,v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_to_jsonable(v) for v in obj]
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().cpu().numpy().tolist()
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return np.asarray(obj).tolist()
+    return obj
+
+
+def cache_key(inputs : dict) -> str:
+    """
+    Hash of a dictionary of cache inputs (fingerprints, processing parameters).
+    """
+    a = json.dumps(_to_jsonable(inputs), sort_keys=True)
+    return hashlib.sha1(a.encode('utf-8')).hexdigest()
+
+
+def load_cache(path : str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    try:
+        return torch.load(path)
+    except (RuntimeError, EOFError, OSError) as e:
+        # corrupt / truncated cache file: re-process
+        log.warning('could not read cache %s (%s), re-processing.' %(path, e))
+        return None
+
+
+def save_cache(obj : dict, path : str) -> None:
+    """
+    Write the cache atomically: several ranks may build the same entry at once,
+    so write to a unique temporary file and rename it into place.
+    """
+    cache_dir = os.path.dirname(os.path.abspath(path))
+    os.makedirs(cache_dir, exist_ok=True)
+    path_tmp = '%s.%d.tmp' %(path, os.getpid())
+    torch.save(obj, path_tmp)
+    os.replace(path_tmp, path)
+
+
+def load_npz_cache(path : str) -> Optional[dict]:
+    """
+    Binary (numpy) counterpart of load_cache, for caches of plain arrays.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as f:
+            return {k : f[k] for k in f.files}
+    except (ValueError, EOFError, OSError) as e:
+        log.warning('could not read cache %s (%s), re-processing.' %(path, e))
+        return None
+
+
+def save_npz_cache(arrays : dict, path : str) -> None:
+    cache_dir = os.path.dirname(os.path.abspath(path))
+    os.makedirs(cache_dir, exist_ok=True)
+    path_tmp = '%s.%d.tmp' %(path, os.getpid())
+    with open(path_tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(path_tmp, path)
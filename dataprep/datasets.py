@@ -0,0 +1,171 @@
+"""
+Datasets whose samples share one mesh topology
+"""
+from __future__ import absolute_import, division, print_function, annotations
+from typing import Optional, Union, Callable, List
+import numpy as np
+
+import torch
+from torch import Tensor
+from torch_geometric.data import Data, Batch, Dataset
+
+from dataprep.snapshot_store import SnapshotStore
+from dataprep.precision import upcast
+
+
+class SharedTopologyDataset(Dataset):
+    """
+    Dataset of time-lagged windows of snapshots on a single mesh. The snapshots
+    of a case are either a single [n_snaps, n_nodes, n_features] tensor or a
+    memory-mapped SnapshotStore, and sample i is built on access: x is snapshot
+    idx[i] and y[t] is snapshot idx[i]+t+1. Memory is therefore independent of
+    time_lag, and the time lag can be changed with set_time_lag without
+    reloading.
+
+    Samples only carry node fields (x, y, t_x, t_y); the mesh topology
+    (edge_index, edge_attr, pos, distance, bounding_box) and the scaling info
+    live once in self.topology, and are attached per batch by
+    SharedTopologyCollater.
+
+    The snapshot tensor may be held in a low-precision dtype (see
+    dataprep/precision.py); x and y are then returned in that dtype, and
+    upcast to float32 per batch.
+    """
+    def __init__(
+            self,
+            snapshots : Union[Tensor, SnapshotStore],
+            time_vec : Tensor,
+            idx : np.ndarray,
+            time_lag : int,
+            topology : Data):
+        super().__init__()
+        self.snapshots = snapshots # [n_snaps, n_nodes, n_features]
+        self.time_vec = time_vec # [n_snaps]
+        self.idx_windows = np.asarray(idx, dtype=np.int64) # window start snapshots
+        self.topology = topology
+        self.set_time_lag(time_lag)
+
+    def set_time_lag(self, time_lag : int) -> None:
+        """
+        Sets the number of target snapshots per sample. Windows that no longer
+        fit in the time series are dropped.
+        """
+        n_snaps = len(self.snapshots)
+        self.time_lag = time_lag
+        self.idx = self.idx_windows[self.idx_windows + time_lag < n_snaps]
+
+    def len(self) -> int:
+        return len(self.idx)
+
+    def get(self, idx : int) -> Data:
+        i = int(self.idx[idx])
+        x = self.snapshots[i]
+        if self.time_lag == 0:
+            y = x
+            t_y = self.time_vec[i:i+1]
+        else:
+            y = [self.snapshots[i+t] for t in range(1, self.time_lag+1)]
+            t_y = self.time_vec[i+1:i+self.time_lag+1]
+        return Data(
+                x = x,
+                y = y,
+                t_x = self.time_vec[i],
+                t_y = t_y)
+
+    def get_full(self, idx : int) -> Data:
+        """
+        Returns sample idx, in float32, with the mesh topology attached.
+        """
+        data = self[idx]
+        data.x = upcast(data.x)
+        data.y = upcast(data.y) if isinstance(data.y, Tensor) else [upcast(y) for y in data.y]
+        for key in self.topology.keys():
+            data[key] = self.topology[key]
+        return data
+
+
+class SharedTopologyCollater:
+    """
+    Collate function for samples that carry only node fields. The shared mesh
+    is attached once per batch: the batched edge_index (with node offsets),
+    edge_attr, pos, distance and batch vectors are built once for each batch
+    size and reused.
+
+    index_dtype is the dtype of the batched edge_index and batch vector.
+    With torch.int32, the pooling and message passing indices derived from
+    them (perms, clusters, edge maps) are int32 as well, which halves the
+    index memory and bandwidth; the mesh must have fewer than 2**31 nodes
+    per batch.
+
+    Low-precision snapshots (see dataprep/precision.py) are upcast to float32
+    here. With upcast = False, x and y are left in the storage dtype, which
+    halves the host-to-device copy, and are upcast on the device with
+    dataprep.precision.upcast.
+
+    With dense = True, batches are in the shared-topology layout: x and y are
+    stacked to [B, N, F], and the mesh tensors are attached once, unbatched
+    (edge_index [2, E] of the mesh, no batch vector). See the dense mode of
+    GNN_TopK_NoReduction, SinglescaleGNN and ConsGNN.
+    """
+    def __init__(
+            self,
+            topology : Data,
+            index_dtype : Optional[torch.dtype] = torch.long,
+            upcast : Optional[bool] = True,
+            dense : Optional[bool] = False):
+        self.topology = topology
+        self.index_dtype = index_dtype
+        self.upcast = upcast
+        self.dense = dense
+        self.batched_topology = {} # batch size --> batched mesh tensors
+
+    def get_batched_topology(self, batch_size : int) -> dict:
+        if self.dense:
+            if 'dense' not in self.batched_topology:
+                self.batched_topology['dense'] = {
+                    'edge_index' : self.topology.edge_index.to(self.index_dtype),
+                    'edge_attr' : self.topology.edge_attr,
+                    'pos' : self.topology.pos,
+                    'distance' : self.topology.distance}
+            return self.batched_topology['dense']
+        if batch_size not in self.batched_topology:
+            edge_index = self.topology.edge_index
+            n_nodes = self.topology.pos.shape[0]
+            n_edges = edge_index.shape[1]
+            if batch_size * n_nodes > torch.iinfo(self.index_dtype).max:
+                raise ValueError('%d nodes per batch do not fit in %s indices' %(batch_size * n_nodes, self.index_dtype))
+            offset = torch.arange(batch_size, dtype=edge_index.dtype) * n_nodes
+            self.batched_topology[batch_size] = {
+                'edge_index' : (edge_index.repeat(1, batch_size) + offset.repeat_interleave(n_edges)).to(self.index_dtype),
+                'edge_attr' : self.topology.edge_attr.repeat(batch_size, 1),
+                'pos' : self.topology.pos.repeat(batch_size, 1),
+                'distance' : self.topology.distance.repeat(batch_size, 1),
+                'batch' : torch.arange(batch_size, dtype=self.index_dtype).repeat_interleave(n_nodes),
+                'ptr' : torch.arange(batch_size + 1) * n_nodes}
+        return self.batched_topology[batch_size]
+
+    def __call__(self, data_list : List[Data]) -> Batch:
+        batch_size = len(data_list)
+        topology = self.get_batched_topology(batch_size)
+        join = torch.stack if self.dense else torch.cat
+        if isinstance(data_list[0].y, Tensor):
+            y = join([data.y for data in data_list], dim=0)
+        else:
+            time_lag = len(data_list[0].y)
+            y = [join([data.y[t] for data in data_list], dim=0) for t in range(time_lag)]
+        x = join([data.x for data in data_list], dim=0)
+        if self.upcast:
+            x = upcast(x)
+            y = upcast(y) if isinstance(y, Tensor) else [upcast(y_t) for y_t in y]
+        batch = Batch(
+                x = x,
+                y = y,
+                t_x = torch.stack([data.t_x for data in data_list]),
+                t_y = torch.cat([data.t_y.view(-1) for data in data_list]),
+                bounding_box = self.topology.bounding_box,
+                data_scale = self.topology.data_scale,
+                edge_scale = self.topology.edge_scale,
+                field_names = self.topology.field_names,
+                **topology)
+        batch._num_graphs = batch_size
+        return batch
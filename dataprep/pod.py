@@ -0,0 +1,306 @@
+"""
+POD-compressed snapshot stores. The snapshots of a BFS case are highly
+correlated in time, so each field is kept as its temporal mean plus a
+truncated POD expansion,
+    a(t) ~= mean + coefficients[t] @ basis,
+with basis the [rank, n_cells] spatial modes and coefficients the [n_snaps,
+rank] temporal coefficients. The rank of each field is the smallest one that
+keeps the relative error ||A - A_pod||_F / ||A - mean||_F below tol.
+
+The basis is computed with a blocked randomized range finder (randQB with
+error indicator and power iterations), which streams the snapshots chunk by
+chunk, so a case never has to fit in memory as a dense matrix.
+
+A POD store is a directory holding one case:
+    meta.json                      -- format, n_cells, n_snaps, field_names, tol, ranks, errors
+    time.npy                       -- [n_snaps] snapshot times
+    <field_name>/mean.npy          -- [n_cells]
+    <field_name>/basis.npy         -- [rank, n_cells]
+    <field_name>/coefficients.npy  -- [n_snaps, rank]
+
+PODStore reads it like a SnapshotStore, reconstructing snapshots on access.
+Compress a snapshot store or a VTK file with:
+    python -m dataprep.pod <path_to_store_or_vtk> <path_to_pod> [--tol 1e-3]
+"""
+from __future__ import absolute_import, division, print_function, annotations
+from typing import Optional, Union, Callable, List
+import os,json,time,argparse
+import numpy as np
+
+from dataprep.snapshot_store import SnapshotStore
+
+
+def _orth(a : np.ndarray) -> np.ndarray:
+    return np.linalg.qr(a)[0]
+
+
+def randomized_pod(
+        read_rows : Callable[[int, int], np.ndarray],
+        n_snaps : int,
+        n_cells : int,
+        tol : Optional[float] = 1e-3,
+        max_rank : Optional[int] = None,
+        block_size : Optional[int] = 16,
+        n_power_iter : Optional[int] = 1,
+        chunk_size : Optional[int] = 64,
+        seed : Optional[int] = 0) -> dict:
+    """
+    Truncated POD of the snapshots of one field, A = [n_snaps, n_cells], with
+    read_rows(t0, t1) returning A[t0:t1]. Rows are read in chunks of
+    chunk_size snapshots, and each block of block_size modes costs
+    2*(n_power_iter + 1) passes over A.
+
+    Returns the mean [n_cells], basis [rank, n_cells], coefficients
+    [n_snaps, rank] and singular values [rank], with the estimated relative
+    error of the truncation.
+    """
+    if max_rank is None:
+        max_rank = min(n_snaps, n_cells)
+    max_rank = min(max_rank, n_snaps, n_cells)
+    rng = np.random.default_rng(seed)
+    chunks = [(t0, min(t0 + chunk_size, n_snaps)) for t0 in range(0, n_snaps, chunk_size)]
+
+    # ~~~~ temporal mean and energy of the fluctuations
+    mean = np.zeros(n_cells)
+    for t0, t1 in chunks:
+        mean += read_rows(t0, t1).sum(axis=0)
+    mean /= n_snaps
+    norm2 = 0.
+    for t0, t1 in chunks:
+        norm2 += float(((read_rows(t0, t1) - mean)**2).sum())
+
+    def mult(omega : np.ndarray) -> np.ndarray:
+        # (A - mean) @ omega, [n_snaps, k]
+        y = np.empty((n_snaps, omega.shape[1]))
+        for t0, t1 in chunks:
+            y[t0:t1] = read_rows(t0, t1) @ omega
+        return y - mean @ omega
+
+    def mult_t(q : np.ndarray) -> np.ndarray:
+        # (A - mean)^T @ q, [n_cells, k]
+        z = np.zeros((n_cells, q.shape[1]))
+        for t0, t1 in chunks:
+            z += read_rows(t0, t1).T @ q[t0:t1]
+        return z - np.outer(mean, q.sum(axis=0))
+
+    # ~~~~ randQB: A - mean ~= Q @ B, grown block by block until the
+    # residual energy norm2 - ||B||_F^2 is below tol
+    Q = np.zeros((n_snaps, 0))
+    B = np.zeros((0, n_cells))
+    residual2 = norm2
+    while Q.shape[1] < max_rank and residual2 > tol**2 * norm2:
+        k = min(block_size, max_rank - Q.shape[1])
+        omega = rng.standard_normal((n_cells, k))
+        q = _orth(mult(omega) - Q @ (B @ omega))
+        for _ in range(n_power_iter):
+            z = _orth(mult_t(q) - B.T @ (Q.T @ q))
+            q = _orth(mult(z) - Q @ (B @ z))
+        q = _orth(q - Q @ (Q.T @ q))
+        b = mult_t(q).T - (q.T @ Q) @ B
+        Q = np.concatenate((Q, q), axis=1)
+        B = np.concatenate((B, b), axis=0)
+        residual2 -= float((b**2).sum())
+
+    # ~~~~ SVD of the small factor, truncated to the tolerance
+    u, s, vt = np.linalg.svd(B, full_matrices=False)
+    residual2 = max(residual2, 0.)
+    tail2 = np.concatenate((np.cumsum((s**2)[::-1])[::-1], [0.])) # energy of modes rank:
+    within_tol = np.nonzero(tail2 + residual2 <= tol**2 * norm2)[0]
+    rank = int(within_tol[0]) if len(within_tol) > 0 else len(s)
+    error = np.sqrt((tail2[rank] + residual2) / norm2) if norm2 > 0 else 0.
+
+    return {
+        'mean' : mean.astype(np.float32),
+        'basis' : vt[:rank].astype(np.float32),
+        'coefficients' : ((Q @ u[:, :rank]) * s[:rank]).astype(np.float32),
+        'singular_values' : s[:rank],
+        'error_estimate' : float(error)}
+
+
+def reconstruction_error(
+        read_rows : Callable[[int, int], np.ndarray],
+        pod : dict,
+        chunk_size : Optional[int] = 64) -> dict:
+    """
+    Relative Frobenius error (w.r.t. the fluctuations) and max abs error of
+    the POD reconstruction, from one pass over the snapshots.
+    """
+    n_snaps = pod['coefficients'].shape[0]
+    err2 = 0.
+    norm2 = 0.
+    max_err = 0.
+    for t0 in range(0, n_snaps, chunk_size):
+        t1 = min(t0 + chunk_size, n_snaps)
+        a = read_rows(t0, t1)
+        diff = a - pod['mean'] - pod['coefficients'][t0:t1] @ pod['basis']
+        err2 += float((diff**2).sum())
+        norm2 += float(((a - pod['mean'])**2).sum())
+        max_err = max(max_err, float(np.abs(diff).max()))
+    return {
+        'relative_error' : np.sqrt(err2 / norm2) if norm2 > 0 else 0.,
+        'max_error' : max_err,
+        'field_std' : np.sqrt(norm2 / (n_snaps * pod['basis'].shape[1]))}
+
+
+def write_pod_store(
+        read_field_rows : Callable[[int, int, int], np.ndarray],
+        n_snaps : int,
+        n_cells : int,
+        time_vec : np.ndarray,
+        field_names : List[str],
+        path_to_pod : str,
+        tol : Optional[float] = 1e-3,
+        **kwargs) -> dict:
+    """
+    Writes the POD store of a case, with read_field_rows(f, t0, t1) returning
+    snapshots t0:t1 of field f as [t1 - t0, n_cells]. kwargs go to
+    randomized_pod. Returns the meta of the store.
+    """
+    os.makedirs(path_to_pod, exist_ok=True)
+    fields = {}
+    for f, field in enumerate(field_names):
+        read_rows = lambda t0, t1 : np.asarray(read_field_rows(f, t0, t1), dtype=np.float64)
+        pod = randomized_pod(read_rows, n_snaps, n_cells, tol = tol, **kwargs)
+        path_to_field = os.path.join(path_to_pod, str(field))
+        os.makedirs(path_to_field, exist_ok=True)
+        for key in ['mean', 'basis', 'coefficients']:
+            np.save(os.path.join(path_to_field, '%s.npy' %(key)), pod[key])
+        fields[str(field)] = {
+            'rank' : int(pod['basis'].shape[0]),
+            'error_estimate' : pod['error_estimate'],
+            **reconstruction_error(read_rows, pod)}
+
+    np.save(os.path.join(path_to_pod, 'time.npy'), np.asarray(time_vec))
+
+    # meta is written last: a store without it is incomplete
+    # (time_chunk: the coefficients of a field are a single array)
+    meta = {'format' : 'pod',
+            'n_cells' : int(n_cells),
+            'n_snaps' : int(n_snaps),
+            'field_names' : [str(name) for name in field_names],
+            'time_chunk' : int(n_snaps),
+            'tol' : tol,
+            'fields' : fields}
+    with open(os.path.join(path_to_pod, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def compress(
+        path_to_source : str,
+        path_to_pod : str,
+        tol : Optional[float] = 1e-3,
+        multiple_cases : Optional[bool] = False,
+        **kwargs) -> dict:
+    """
+    POD-compresses a case given as a snapshot store (read chunk by chunk) or
+    a BFS VTK file (read into memory).
+    """
+    if os.path.isdir(path_to_source):
+        store = SnapshotStore(path_to_source)
+        field_names = store.meta['field_names']
+        time_chunk = store.time_chunk
+        def read_field_rows(f, t0, t1):
+            field = field_names[f]
+            rows = []
+            for c in range(t0 // time_chunk, (t1 - 1) // time_chunk + 1):
+                lo = max(t0 - c * time_chunk, 0)
+                hi = min(t1 - c * time_chunk, time_chunk)
+                rows.append(store.decode(field, store.get_chunk(field, c)[lo:hi]))
+            return np.concatenate(rows, axis=0)
+        return write_pod_store(read_field_rows, len(store), store.n_cells, store.time_vec,
+                field_names, path_to_pod, tol, **kwargs)
+
+    from dataprep.backward_facing_step import read_vtk_snapshots
+    data_full, time_vec, field_names = read_vtk_snapshots(path_to_source, multiple_cases)
+    n_cells, n_features, n_snaps = data_full.shape
+    read_field_rows = lambda f, t0, t1 : data_full[:, f, t0:t1].T
+    return write_pod_store(read_field_rows, n_snaps, n_cells, time_vec,
+            field_names, path_to_pod, tol, **kwargs)
+
+
+def is_pod_store(path : str) -> bool:
+    meta = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta):
+        return False
+    with open(meta, 'r') as f:
+        return json.load(f).get('format') == 'pod'
+
+
+class PODStore(SnapshotStore):
+    """
+    Read access to a POD store, with the interface of SnapshotStore: indexing
+    returns the (optionally scaled) snapshot of the kept features, [n_cells,
+    n_features_to_keep], reconstructed from the modes on access. The modes
+    of each kept field are loaded on first access, and only they are held in
+    memory.
+    """
+    def get_modes(self, field : str) -> tuple:
+        """
+        mean, basis and coefficients of field, with the cells in node_perm
+        order.
+        """
+        if field not in self.chunks:
+            path = os.path.join(self.path_to_store, field)
+            mean = np.load(os.path.join(path, 'mean.npy'))
+            basis = np.load(os.path.join(path, 'basis.npy'), mmap_mode='r')
+            coefficients = np.load(os.path.join(path, 'coefficients.npy'))
+            if self.node_perm is not None:
+                mean = mean[self.node_perm]
+                basis = basis[:, self.node_perm]
+            self.chunks[field] = (mean, basis, coefficients)
+        return self.chunks[field]
+
+    def read(self, t : int) -> np.ndarray:
+        """
+        Reconstructs raw snapshot t (in time_skip units) as [n_cells, n_features_to_keep].
+        """
+        t_store = t * self.time_skip
+        out = np.empty((self.n_cells, len(self.field_names)), dtype=np.float32)
+        for f, field in enumerate(self.field_names):
+            mean, basis, coefficients = self.get_modes(field)
+            out[:,f] = mean + coefficients[t_store] @ basis
+        return out
+
+
+def _dir_size(path : str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='POD-compress a BFS case (snapshot store or VTK file).')
+    parser.add_argument('path_to_source', type=str, help='snapshot store directory or VTK file')
+    parser.add_argument('path_to_pod', type=str)
+    parser.add_argument('--tol', type=float, default=1e-3, help='relative reconstruction error of each field')
+    parser.add_argument('--max_rank', type=int, default=None)
+    parser.add_argument('--block_size', type=int, default=16, help='modes added per randomized block')
+    parser.add_argument('--power_iter', type=int, default=1)
+    parser.add_argument('--multiple_cases', action='store_true')
+    args = parser.parse_args()
+
+    t_start = time.time()
+    meta = compress(args.path_to_source, args.path_to_pod, args.tol, args.multiple_cases,
+            max_rank = args.max_rank, block_size = args.block_size, n_power_iter = args.power_iter)
+    print('Wrote %s in %g s' %(args.path_to_pod, time.time() - t_start))
+
+    n_snaps, n_cells = meta['n_snaps'], meta['n_cells']
+    raw_bytes = 0
+    pod_bytes = 0
+    for field, info in meta['fields'].items():
+        rank = info['rank']
+        raw_bytes += 4 * n_snaps * n_cells
+        pod_bytes += 4 * (n_cells + rank * n_cells + n_snaps * rank)
+        print('%-8s rank %4d   relative error %.2e   max error %.3e (field std %.3e)' %(
+            field, rank, info['relative_error'], info['max_error'], info['field_std']))
+    print('memory (float32): raw %.2f MB, POD %.2f MB (%.1fx)' %(raw_bytes/1e6, pod_bytes/1e6, raw_bytes/max(pod_bytes, 1)))
+    if os.path.isdir(args.path_to_source):
+        source_bytes = _dir_size(args.path_to_source)
+    else:
+        source_bytes = os.path.getsize(args.path_to_source)
+    print('disk: source %.2f MB, POD store %.2f MB (%.1fx)' %(
+        source_bytes/1e6, _dir_size(args.path_to_pod)/1e6, source_bytes/max(_dir_size(args.path_to_pod), 1)))
+    return
+
+
+if __name__ == '__main__':
+    main()
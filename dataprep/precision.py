@@ -0,0 +1,72 @@
+"""
+Low-precision storage of snapshots. The scaled snapshots ((x - mean)/std with
+the stats.npz mean/std) are kept in memory, in the cache and in node shared
+memory as bfloat16, float16 or int16, and upcast to float32 per batch (in
+SharedTopologyCollater, or on the device after the host-to-device copy).
+int16 uses a fixed step of INT16_STEP std: values within +-16 std are kept
+to 2.4e-4 std.
+"""
+from __future__ import absolute_import, division, print_function, annotations
+from typing import Optional, Union, Callable, List
+import logging
+import numpy as np
+
+import torch
+from torch import Tensor
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_DTYPES = ['float32', 'bfloat16', 'float16', 'int16']
+INT16_STEP = 2.0**-11
+INT16_MAX = 32767
+
+
+def storage_dtype(snapshot_dtype : str) -> torch.dtype:
+    if snapshot_dtype not in SNAPSHOT_DTYPES:
+        raise ValueError('Invalid snapshot dtype: %s (expected one of %s)' %(snapshot_dtype, SNAPSHOT_DTYPES))
+    return getattr(torch, snapshot_dtype)
+
+
+def to_storage(x : Tensor, snapshot_dtype : str) -> Tensor:
+    """
+    Converts scaled float32 snapshots to the storage dtype.
+    """
+    dtype = storage_dtype(snapshot_dtype)
+    if dtype == torch.int16:
+        q = torch.round(x / INT16_STEP)
+        n_clipped = int((q.abs() > INT16_MAX).sum())
+        if n_clipped > 0:
+            log.warning('%d snapshot values beyond +-%g std are clipped in int16 storage.' %(n_clipped, INT16_MAX * INT16_STEP))
+        return q.clamp(-INT16_MAX, INT16_MAX).to(dtype)
+    return x.to(dtype)
+
+
+def upcast(x : Tensor) -> Tensor:
+    """
+    Float32 snapshots from stored ones; float32 tensors are returned as is.
+    """
+    if x.dtype == torch.int16:
+        return x.float() * INT16_STEP
+    return x.float()
+
+
+def quantize_int16(a : np.ndarray) -> tuple[np.ndarray,float,float]:
+    """
+    int16 quantization of the raw (unscaled) field values a, for snapshot
+    stores: a ~= offset + scale * q, with offset the mean of a and scale
+    set by the largest deviation from it, so nothing is clipped.
+
+    This is not the fixed-step int16 of to_storage: stores hold raw fields,
+    with no std to set a step with. A store is decoded to float32 on read,
+    so the two schemes never apply one after the other, but an int16 store
+    and int16 in-memory snapshots of the same case are different
+    approximations (to 1/65534 of the largest deviation, and to 2.4e-4
+    std). Use float32 stores where a store and the VTK file must give the
+    same samples.
+    """
+    offset = float(a.mean())
+    scale = float(np.abs(a - offset).max()) / INT16_MAX
+    if scale == 0:
+        scale = 1.0
+    q = np.round((a - offset) / scale).astype(np.int16)
+    return q, offset, scale
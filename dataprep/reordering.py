@@ -0,0 +1,198 @@
+"""
+Node renumbering for cache locality. foamToVTK orders cells as OpenFOAM
+does, so neighbouring cells can be far apart in memory; renumbering them
+along a space-filling curve (Morton, Hilbert) or by reverse Cuthill-McKee
+keeps the x[edge_index[0]] gathers and the aggregations at edge_index[1]
+local.
+
+A permutation perm maps new node ids to old ones: new node i is old node
+perm[i], so fields are reordered with x[perm] and written back in the
+original (OpenFOAM) order with x[inv_perm]. Compare the orderings on a mesh with:
+    python -m dataprep.reordering <path_to_ei> <path_to_pos> [--features 128]
+"""
+from __future__ import absolute_import, division, print_function, annotations
+from typing import Optional, Union, Callable, List
+from collections import deque
+import hashlib,time,argparse
+import numpy as np
+
+
+REORDER_METHODS = ['morton', 'hilbert', 'rcm']
+
+
+def _quantize(pos : np.ndarray, n_bits : int) -> np.ndarray:
+    """
+    Integer coordinates in [0, 2**n_bits) of the points pos, [N, 2], scaled
+    by the larger side of their bounding box.
+    """
+    lo = pos.min(axis=0)
+    extent = (pos.max(axis=0) - lo).max()
+    if extent == 0:
+        return np.zeros(pos.shape, dtype=np.int64)
+    q = (pos - lo) / extent * (2**n_bits - 1)
+    return np.round(q).astype(np.int64)
+
+
+def morton_order(pos : np.ndarray, n_bits : Optional[int] = 16) -> np.ndarray:
+    """
+    Permutation that sorts the points pos, [N, 2], along a Morton (Z-order)
+    curve.
+    """
+    q = _quantize(pos, n_bits)
+    code = np.zeros(pos.shape[0], dtype=np.int64)
+    for b in range(n_bits):
+        code |= ((q[:,0] >> b) & 1) << (2*b)
+        code |= ((q[:,1] >> b) & 1) << (2*b + 1)
+    return np.argsort(code, kind='stable')
+
+
+def hilbert_order(pos : np.ndarray, n_bits : Optional[int] = 16) -> np.ndarray:
+    """
+    Permutation that sorts the points pos, [N, 2], along a Hilbert curve.
+    Unlike the Morton curve, consecutive cells of the Hilbert curve are
+    always adjacent.
+    """
+    q = _quantize(pos, n_bits)
+    x = q[:,0].copy()
+    y = q[:,1].copy()
+    code = np.zeros(pos.shape[0], dtype=np.int64)
+    n = 2**n_bits
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        code += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # rotate the quadrant
+        flip = ~ry & rx
+        x[flip] = n - 1 - x[flip]
+        y[flip] = n - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap].copy()
+        s //= 2
+    return np.argsort(code, kind='stable')
+
+
+def rcm_order(edge_index : np.ndarray, n_nodes : int) -> np.ndarray:
+    """
+    Reverse Cuthill-McKee permutation of the graph edge_index, [2, E]: a
+    breadth-first numbering from a low-degree node, neighbours visited by
+    increasing degree, reversed. It minimizes the bandwidth of the
+    adjacency, i.e. the distance in memory between neighbouring nodes.
+    """
+    row, col = np.concatenate((edge_index, edge_index[::-1]), axis=1)
+    keep = row != col
+    row, col = row[keep], col[keep]
+    degree = np.bincount(row, minlength=n_nodes)
+
+    # CSR adjacency, neighbours sorted by degree
+    order = np.lexsort((degree[col], row))
+    col = col[order]
+    rowptr = np.concatenate(([0], np.cumsum(degree)))
+
+    visited = np.zeros(n_nodes, dtype=bool)
+    perm = []
+    for start in np.argsort(degree, kind='stable'):
+        if visited[start]:
+            continue
+        visited[start] = True
+        queue = deque([start])
+        while queue:
+            i = queue.popleft()
+            perm.append(i)
+            neighbours = col[rowptr[i]:rowptr[i+1]]
+            neighbours = neighbours[~visited[neighbours]]
+            # a node can appear twice with duplicate edges
+            neighbours = neighbours[np.sort(np.unique(neighbours, return_index=True)[1])]
+            visited[neighbours] = True
+            queue.extend(neighbours.tolist())
+    return np.asarray(perm[::-1], dtype=np.int64)
+
+
+def node_permutation(
+        method : str,
+        pos : np.ndarray,
+        edge_index : np.ndarray) -> np.ndarray:
+    """
+    Node permutation (new --> old) for method in REORDER_METHODS.
+    """
+    if method == 'morton':
+        return morton_order(pos)
+    if method == 'hilbert':
+        return hilbert_order(pos)
+    if method == 'rcm':
+        return rcm_order(edge_index, pos.shape[0])
+    raise ValueError('Invalid node reordering: %s (expected one of %s)' %(method, REORDER_METHODS))
+
+
+def invert_permutation(perm : np.ndarray) -> np.ndarray:
+    inv_perm = np.empty_like(perm)
+    inv_perm[perm] = np.arange(len(perm), dtype=perm.dtype)
+    return inv_perm
+
+
+def permutation_key(perm : Optional[np.ndarray]) -> Optional[str]:
+    """
+    Short hash of a permutation, for the keys of caches holding reordered data.
+    """
+    if perm is None:
+        return None
+    return hashlib.sha1(np.ascontiguousarray(perm, dtype=np.int64).tobytes()).hexdigest()
+
+
+def benchmark(
+        path_to_ei : str,
+        path_to_pos : str,
+        n_features : Optional[int] = 128,
+        n_repeats : Optional[int] = 10) -> None:
+    """
+    Times the edge gathers x[edge_index[0]], x[edge_index[1]] and the mean
+    aggregation at edge_index[1] of a message passing layer on the mesh, in
+    the original order and for each reordering.
+    """
+    import torch
+    from torch_scatter import scatter
+    from torch_geometric.utils import coalesce
+
+    edge_index = np.loadtxt(path_to_ei, dtype=np.longlong).T
+    pos = np.loadtxt(path_to_pos, dtype=np.float32)
+    n_nodes = pos.shape[0]
+    print('%d nodes, %d edges, %d features' %(n_nodes, edge_index.shape[1], n_features))
+
+    def median_time(fn):
+        fn()
+        times = []
+        for _ in range(n_repeats):
+            t_start = time.time()
+            fn()
+            times.append(time.time() - t_start)
+        return np.median(times)
+
+    for method in [None] + REORDER_METHODS:
+        t_start = time.time()
+        ei = edge_index
+        if method is not None:
+            ei = invert_permutation(node_permutation(method, pos, edge_index))[edge_index]
+        t_perm = time.time() - t_start
+        ei = coalesce(torch.tensor(ei), num_nodes=n_nodes)
+        x = torch.randn(n_nodes, n_features)
+        e = torch.randn(ei.shape[1], n_features)
+        t_gather = median_time(lambda : (x[ei[0]], x[ei[1]]))
+        t_scatter = median_time(lambda : scatter(e, ei[1], dim=0, dim_size=n_nodes, reduce='mean'))
+        print('%-8s gather %8.2f ms   scatter %8.2f ms   (permutation %.2f s)' %(
+            method, t_gather*1e3, t_scatter*1e3, t_perm))
+    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the edge gathers/scatters of a mesh for each node reordering.')
+    parser.add_argument('path_to_ei', type=str)
+    parser.add_argument('path_to_pos', type=str)
+    parser.add_argument('--features', type=int, default=128, help='node/edge feature size')
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+    benchmark(args.path_to_ei, args.path_to_pos, args.features, args.repeats)
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Partitioning of the sample index space across ranks, so that each rank only
+loads the samples its sampler will use
+"""
+from __future__ import absolute_import, division, print_function, annotations
+from typing import Optional, Union, Callable, List
+import numpy as np
+
+import torch
+
+
+def shard_samples(
+        case_sizes : List[int],
+        rank : int,
+        size : int) -> tuple[dict,int]:
+    """
+    Splits the global sample index space (all samples of case 0, then case 1,
+    ...) into SIZE contiguous blocks of equal length. As in
+    DistributedSampler, the index space is padded by wrapping around to the
+    first samples, so every rank gets the same number of samples. Contiguous
+    blocks mean each rank touches as few cases as possible.
+
+    Returns a dict {case : positions of the rank's samples within the case},
+    and the number of samples per rank.
+    """
+    n_total = int(np.sum(case_sizes))
+    num_samples = int(np.ceil(n_total / size))
+    idx = (rank * num_samples + np.arange(num_samples)) % n_total
+
+    case_offsets = np.concatenate(([0], np.cumsum(case_sizes)))
+    case_ids = np.searchsorted(case_offsets, idx, side='right') - 1
+
+    shard = {}
+    for c in np.unique(case_ids):
+        shard[int(c)] = idx[case_ids == c] - case_offsets[c]
+    return shard, num_samples
+
+
+class ShardedSampler(torch.utils.data.Sampler):
+    """
+    Sampler for a dataset that holds only the local shard of a rank (see
+    shard_samples). It replaces DistributedSampler: the local samples are
+    reshuffled every epoch through set_epoch, and nothing is discarded.
+    """
+    def __init__(
+            self,
+            dataset : torch.utils.data.Dataset,
+            shuffle : Optional[bool] = True,
+            seed : Optional[int] = 0):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+        return iter(indices)
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def set_epoch(self, epoch : int) -> None:
+        self.epoch = epoch
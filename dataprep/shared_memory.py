@@ -0,0 +1,105 @@
+"""
+Node-level shared memory for datasets: the local rank 0 of each node
+materializes the tensors once, and the other ranks on the node attach to them
+without a copy
+"""
+from __future__ import absolute_import, division, print_function, annotations
+from typing import Optional, Union, Callable, List
+import os,json,shutil
+import numpy as np
+
+import torch
+
+
+def save_shared(tensors : dict, path : str) -> None:
+    """
+    Writes a dict of tensors (and small json-able objects) to path, one .npy
+    file per tensor. meta.json is written last and marks the entry complete.
+    bfloat16 tensors, which numpy does not have, are saved as their int16 bit
+    pattern.
+    """
+    os.makedirs(path, exist_ok=True)
+    meta = {'tensors' : [], 'objects' : {}, 'bfloat16' : []}
+    for key, value in tensors.items():
+        if isinstance(value, torch.Tensor):
+            if value.dtype == torch.bfloat16:
+                value = value.view(torch.int16)
+                meta['bfloat16'].append(key)
+            np.save(os.path.join(path, '%s.npy' %(key)), value.numpy())
+            meta['tensors'].append(key)
+        else:
+            meta['objects'][key] = value
+    path_tmp = os.path.join(path, 'meta.json.%d.tmp' %(os.getpid()))
+    with open(path_tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(path_tmp, os.path.join(path, 'meta.json'))
+    return
+
+
+def load_shared(path : str) -> dict:
+    """
+    Attaches to an entry written by save_shared. The tensors are
+    copy-on-write memory maps of the files, so every process on the node
+    shares the same physical pages.
+    """
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    tensors = dict(meta['objects'])
+    for key in meta['tensors']:
+        a = np.load(os.path.join(path, '%s.npy' %(key)), mmap_mode='c')
+        tensors[key] = torch.from_numpy(a)
+        if key in meta.get('bfloat16', []):
+            tensors[key] = tensors[key].view(torch.bfloat16)
+    return tensors
+
+
+def is_shared(path : str) -> bool:
+    return os.path.exists(os.path.join(path, 'meta.json'))
+
+
+class NodeSharedMemory:
+    """
+    Shares tensors between the ranks of a node through files in shm_dir, which
+    should be on a memory-backed filesystem (/dev/shm) or a node-local disk.
+    local_rank is the rank within the node, and barrier synchronizes the ranks
+    of the node (e.g. the Barrier of an MPI COMM_TYPE_SHARED communicator).
+
+    Entries are keyed, so a later job on the same node re-attaches to them
+    without loading; remove them with cleanup.
+    """
+    def __init__(
+            self,
+            shm_dir : str,
+            local_rank : int,
+            barrier : Callable[[], None]):
+        self.shm_dir = shm_dir
+        self.local_rank = local_rank
+        self.barrier = barrier
+
+    def share(
+            self,
+            keys : List[str],
+            load_fn : Callable[[List[int]], List[dict]]) -> List[dict]:
+        """
+        Returns the tensors of every key. Entries that are not in shared memory
+        yet are produced by load_fn(indices of the missing keys) on the local
+        rank 0 only; all ranks then attach to them.
+        """
+        paths = [os.path.join(self.shm_dir, key) for key in keys]
+        if self.local_rank == 0:
+            missing = [i for i, path in enumerate(paths) if not is_shared(path)]
+            if len(missing) > 0:
+                for i, tensors in zip(missing, load_fn(missing)):
+                    save_shared(tensors, paths[i])
+        self.barrier()
+        return [load_shared(path) for path in paths]
+
+    def cleanup(self) -> None:
+        """
+        Removes all entries. Ranks that still hold memory maps keep their data
+        until they exit.
+        """
+        self.barrier()
+        if self.local_rank == 0 and os.path.exists(self.shm_dir):
+            shutil.rmtree(self.shm_dir)
+        return
@@ -0,0 +1,216 @@
+"""
+Chunked on-disk snapshot store for BFS cases.
+
+A store is a directory holding one case, chunked by field and by time:
+    meta.json                      -- n_cells, n_snaps, field_names, time_chunk, dtype
+    time.npy                       -- [n_snaps] snapshot times
+    <field_name>/chunk_<c>.npy     -- [n_chunk_snaps, n_cells] in the store dtype
+
+The store dtype is float32, float16, bfloat16 (kept as its int16 bit
+pattern) or int16 (quantized per field, see dataprep.precision.quantize_int16,
+with the offset and scale of each field in meta.json). Snapshots are
+decoded to float32 on read.
+
+Chunks are memory-mapped on access, so only the requested fields and time
+slices are read from disk. Convert a VTK file (from foamToVTK) with:
+    python -m dataprep.snapshot_store <path_to_vtk> <path_to_store> [--time_chunk 32] [--dtype float32]
+"""
+from __future__ import absolute_import, division, print_function, annotations
+from typing import Optional, Union, Callable, List
+import os,json,time,argparse
+import numpy as np
+
+import torch
+from torch import Tensor
+
+from dataprep.precision import SNAPSHOT_DTYPES, quantize_int16
+
+
+def write_snapshot_store(
+        data_full : np.ndarray,
+        time_vec : np.ndarray,
+        field_names : List[str],
+        path_to_store : str,
+        time_chunk : Optional[int] = 32,
+        dtype : Optional[str] = 'float32') -> None:
+    """
+    Writes snapshots given as [n_cells, n_features, n_snaps] to a store,
+    with chunks in dtype (one of dataprep.precision.SNAPSHOT_DTYPES).
+    """
+    if dtype not in SNAPSHOT_DTYPES:
+        raise ValueError('Invalid store dtype: %s (expected one of %s)' %(dtype, SNAPSHOT_DTYPES))
+    n_cells, n_features, n_snaps = data_full.shape
+    os.makedirs(path_to_store, exist_ok=True)
+
+    quantization = {}
+    for f in range(n_features):
+        path_to_field = os.path.join(path_to_store, str(field_names[f]))
+        os.makedirs(path_to_field, exist_ok=True)
+        data_f = np.asarray(data_full[:, f, :], dtype=np.float32)
+        if dtype == 'int16':
+            data_f, offset, scale = quantize_int16(data_f)
+            quantization[str(field_names[f])] = [offset, scale]
+        for c, t0 in enumerate(range(0, n_snaps, time_chunk)):
+            t1 = min(t0 + time_chunk, n_snaps)
+            chunk = np.ascontiguousarray(data_f[:, t0:t1].T)
+            if dtype == 'float16':
+                chunk = chunk.astype(np.float16)
+            elif dtype == 'bfloat16':
+                chunk = torch.from_numpy(chunk).to(torch.bfloat16).view(torch.int16).numpy()
+            np.save(os.path.join(path_to_field, 'chunk_%d.npy' %(c)), chunk)
+
+    np.save(os.path.join(path_to_store, 'time.npy'), np.asarray(time_vec))
+
+    # meta is written last: a store without it is incomplete
+    meta = {'n_cells' : int(n_cells),
+            'n_snaps' : int(n_snaps),
+            'field_names' : [str(name) for name in field_names],
+            'time_chunk' : int(time_chunk),
+            'dtype' : dtype}
+    if dtype == 'int16':
+        meta['quantization'] = quantization
+    with open(os.path.join(path_to_store, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return
+
+
+def convert_vtk(
+        path_to_vtk : str,
+        path_to_store : str,
+        time_chunk : Optional[int] = 32,
+        multiple_cases : Optional[bool] = False,
+        dtype : Optional[str] = 'float32') -> None:
+    """
+    Converts a BFS VTK file to a chunked snapshot store.
+    """
+    from dataprep.backward_facing_step import read_vtk_snapshots
+    data_full, time_vec, field_names = read_vtk_snapshots(path_to_vtk, multiple_cases)
+    write_snapshot_store(data_full, time_vec, field_names, path_to_store, time_chunk, dtype)
+    return
+
+
+class SnapshotStore:
+    """
+    Read access to a chunked snapshot store. Indexing returns the (optionally
+    scaled) snapshot of the kept features, [n_cells, n_features_to_keep], for
+    every time_skip-th snapshot. Chunks are memory-mapped on first access.
+    If node_perm is given, the cells are returned in that order.
+    """
+    def __init__(
+            self,
+            path_to_store : str,
+            time_skip : Optional[int] = 1,
+            scaling : Optional[list] = None,
+            features_to_keep : Optional[list] = None,
+            node_perm : Optional[np.ndarray] = None):
+        self.path_to_store = path_to_store
+        with open(os.path.join(path_to_store, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.time_skip = time_skip
+        self.time_chunk = self.meta['time_chunk']
+        self.dtype = self.meta.get('dtype', 'float32')
+        self.quantization = self.meta.get('quantization', {})
+        self.n_cells = self.meta['n_cells']
+
+        n_features = len(self.meta['field_names'])
+        if features_to_keep is None:
+            features_to_keep = list(range(n_features))
+        self.features_to_keep = list(features_to_keep)
+        self.field_names = [self.meta['field_names'][i] for i in self.features_to_keep]
+
+        # scaling is given for all fields of the store
+        if scaling:
+            data_mean = np.reshape(scaling[0], (1,-1))
+            data_std = np.reshape(scaling[1], (1,-1))
+        else:
+            data_mean = np.zeros((1,n_features))
+            data_std = np.ones((1,n_features))
+        self.data_mean = data_mean[:, self.features_to_keep]
+        self.data_std = data_std[:, self.features_to_keep]
+
+        time_vec = np.load(os.path.join(path_to_store, 'time.npy'))
+        self.time_vec = time_vec[::time_skip]
+        self.node_perm = node_perm # nodes are read as x[node_perm] (see dataprep/reordering.py)
+        self.chunks = {} # (field, chunk) --> memory-mapped array
+
+    def __len__(self) -> int:
+        return len(self.time_vec)
+
+    @property
+    def shape(self) -> tuple:
+        return (len(self), self.n_cells, len(self.features_to_keep))
+
+    def get_chunk(self, field : str, c : int) -> np.ndarray:
+        if (field, c) not in self.chunks:
+            path = os.path.join(self.path_to_store, field, 'chunk_%d.npy' %(c))
+            self.chunks[(field, c)] = np.load(path, mmap_mode='r')
+        return self.chunks[(field, c)]
+
+    def decode(self, field : str, a : np.ndarray) -> np.ndarray:
+        """
+        Float32 values of field from stored values a.
+        """
+        if self.dtype == 'bfloat16':
+            # bfloat16 is the upper half of a float32
+            return (np.ascontiguousarray(a).view(np.uint16).astype(np.uint32) << 16).view(np.float32)
+        if self.dtype == 'int16':
+            offset, scale = self.quantization[field]
+            return offset + scale * a.astype(np.float32)
+        return a
+
+    def read(self, t : int) -> np.ndarray:
+        """
+        Reads raw snapshot t (in time_skip units) as [n_cells, n_features_to_keep].
+        """
+        t_store = t * self.time_skip
+        c, i = divmod(t_store, self.time_chunk)
+        out = np.empty((self.n_cells, len(self.field_names)), dtype=np.float32)
+        for f, field in enumerate(self.field_names):
+            if self.node_perm is None:
+                out[:,f] = self.decode(field, self.get_chunk(field, c)[i])
+            else:
+                out[:,f] = self.decode(field, self.get_chunk(field, c)[i][self.node_perm])
+        return out
+
+    def __getitem__(self, t : int) -> Tensor:
+        if t < 0:
+            t += len(self)
+        eps = 1e-10
+        out = (self.read(t) - self.data_mean)/(self.data_std + eps)
+        return torch.tensor(out, dtype=torch.float32)
+
+    def __getstate__(self) -> dict:
+        # memory maps are re-opened in each worker process
+        state = self.__dict__.copy()
+        state['chunks'] = {}
+        return state
+
+
+def open_snapshot_store(path_to_store : str, **kwargs) -> SnapshotStore:
+    """
+    SnapshotStore of path_to_store, or PODStore if it is POD-compressed (see
+    dataprep/pod.py). kwargs go to the store.
+    """
+    from dataprep.pod import PODStore, is_pod_store
+    if is_pod_store(path_to_store):
+        return PODStore(path_to_store, **kwargs)
+    return SnapshotStore(path_to_store, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a BFS VTK file to a chunked snapshot store.')
+    parser.add_argument('path_to_vtk', type=str)
+    parser.add_argument('path_to_store', type=str)
+    parser.add_argument('--time_chunk', type=int, default=32, help='snapshots per chunk')
+    parser.add_argument('--multiple_cases', action='store_true')
+    parser.add_argument('--dtype', type=str, default='float32', choices=SNAPSHOT_DTYPES, help='dtype of the stored snapshots')
+    args = parser.parse_args()
+
+    t_start = time.time()
+    convert_vtk(args.path_to_vtk, args.path_to_store, args.time_chunk, args.multiple_cases, args.dtype)
+    print('Wrote %s in %g s' %(args.path_to_store, time.time() - t_start))
+    return
+
+
+if __name__ == '__main__':
+    main()
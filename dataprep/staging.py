@@ -0,0 +1,124 @@
+"""
+Node-local staging of dataset files from the shared filesystem. One rank per
+node copies (or converts to snapshot stores) the files into a node-local
+directory, and the other ranks of the node read the local copies.
+"""
+from __future__ import absolute_import, division, print_function, annotations
+from typing import Optional, Union, Callable, List
+import os,json,time,shutil
+
+from dataprep.cache import file_fingerprint, cache_key
+from dataprep.snapshot_store import convert_vtk
+
+# written in a staged store directory: fingerprint of the source meta.json
+STAGED_FROM = '.staged_from.json'
+
+
+def staged_path(
+        path : str,
+        src_root : str,
+        stage_dir : str,
+        convert : Optional[bool] = False) -> str:
+    """
+    Location of path (under src_root) in stage_dir. Paths outside src_root
+    are staged by their base name. Converted VTK files become snapshot store
+    directories, named without the .vtk extension.
+    """
+    rel = os.path.relpath(os.path.abspath(path), os.path.abspath(src_root))
+    if rel.startswith(os.pardir):
+        rel = os.path.basename(path)
+    dst = os.path.join(stage_dir, rel)
+    if convert and dst.endswith('.vtk'):
+        dst = dst[:-len('.vtk')]
+    return dst
+
+
+def _is_staged(src : str, dst : str, convert : bool, store_dtype : str) -> bool:
+    if convert and src.endswith('.vtk'):
+        # a converted store is complete once meta.json is written
+        meta = os.path.join(dst, 'meta.json')
+        if not os.path.exists(meta) or os.stat(meta).st_mtime_ns < os.stat(src).st_mtime_ns:
+            return False
+        with open(meta, 'r') as f:
+            return json.load(f).get('dtype', 'float32') == store_dtype
+    if os.path.isdir(src):
+        # a copied store is complete, and current, if it was copied from the
+        # source meta.json as it is now
+        marker = os.path.join(dst, STAGED_FROM)
+        if not os.path.exists(marker):
+            return False
+        with open(marker, 'r') as f:
+            return json.load(f) == file_fingerprint(os.path.join(src, 'meta.json'))
+    if not os.path.exists(dst):
+        return False
+    # copy2 keeps the modification time
+    st_src, st_dst = os.stat(src), os.stat(dst)
+    return st_src.st_size == st_dst.st_size and st_src.st_mtime_ns == st_dst.st_mtime_ns
+
+
+def _stage(src : str, dst : str, convert : bool, store_dtype : str) -> None:
+    if _is_staged(src, dst, convert, store_dtype):
+        return
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if convert and src.endswith('.vtk'):
+        convert_vtk(src, dst, dtype=store_dtype)
+    elif os.path.isdir(src):
+        # a stale copy is replaced, not overwritten: chunks of an older
+        # conversion would be left behind
+        fingerprint = file_fingerprint(os.path.join(src, 'meta.json'))
+        if os.path.exists(dst):
+            shutil.rmtree(dst)
+        shutil.copytree(src, dst)
+        with open(os.path.join(dst, STAGED_FROM), 'w') as f:
+            json.dump(fingerprint, f)
+    else:
+        dst_tmp = '%s.%d.tmp' %(dst, os.getpid())
+        shutil.copy2(src, dst_tmp)
+        os.replace(dst_tmp, dst)
+    return
+
+
+def stage_files(
+        paths : List[str],
+        src_root : str,
+        stage_dir : str,
+        is_stager : bool,
+        barrier : Optional[Callable[[], None]] = None,
+        convert : Optional[bool] = False,
+        timeout : Optional[float] = 3600.,
+        store_dtype : Optional[str] = 'float32') -> List[str]:
+    """
+    Stages paths (files or snapshot stores under src_root) to stage_dir and
+    returns the staged paths. Only the rank with is_stager = True (one per
+    node) copies, or with convert = True turns VTK files into snapshot
+    stores with chunks in store_dtype; files that are already staged and up
+    to date are skipped.
+
+    The other ranks wait on barrier (e.g. the Barrier of an MPI
+    COMM_TYPE_SHARED communicator). Without a barrier they poll for a marker
+    file written by the stager, which also works for plain processes on a
+    local filesystem.
+    """
+    dsts = [staged_path(path, src_root, stage_dir, convert) for path in paths]
+    inputs = {'paths' : [file_fingerprint(path) for path in paths], 'convert' : convert}
+    if convert and store_dtype != 'float32':
+        inputs['store_dtype'] = store_dtype
+    key = cache_key(inputs)
+    marker = os.path.join(stage_dir, '.staged_%s' %(key))
+
+    if is_stager:
+        os.makedirs(stage_dir, exist_ok=True)
+        for src, dst in zip(paths, dsts):
+            _stage(src, dst, convert, store_dtype)
+        with open(marker, 'w') as f:
+            f.write('%f\n' %(time.time()))
+
+    if barrier is not None:
+        barrier()
+    else:
+        t_start = time.time()
+        while not os.path.exists(marker):
+            if time.time() - t_start > timeout:
+                raise TimeoutError('Staging to %s did not finish in %g s' %(stage_dir, timeout))
+            time.sleep(0.5)
+    return dsts
@@ -0,0 +1,314 @@
+"""
+Normalization statistics (per-field mean and std over all cells and
+snapshots) of a set of BFS cases, computed in one streaming pass. Each case
+is reduced to its moments (count, mean, sum of squared deviations) chunk by
+chunk, cases are processed by a pool of workers, and the per-case moments
+are merged with the pairwise update of Chan et al., so the snapshots of all
+cases are never held at once.
+
+stats.npz holds mean and std (as before), the count, the field names and a
+provenance record of the cases it was computed from. The provenance does not
+depend on where the dataset lives: each case is fingerprinted by its path
+relative to the stats file and its size (optionally a sha1 of its contents).
+An existing stats file is never overwritten. load_statistics only reads and
+checks; stats for changed cases go to a new file next to the old one,
+stats.<key>.npz. Build one offline with:
+    python -m dataprep.statistics <path_to_stats> <case> [<case> ...] [--workers 4]
+where a case is a BFS VTK file or a snapshot store.
+"""
+from __future__ import absolute_import, division, print_function, annotations
+from typing import Optional, Union, Callable, List
+import os,json,time,socket,argparse
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+
+from dataprep.cache import file_fingerprint, cache_key
+
+log = logging.getLogger(__name__)
+
+class RunningMoments:
+    """
+    Count, mean and sum of squared deviations (m2) of each feature, in
+    float64. Batches are added with update, and moments of disjoint data are
+    combined with merge.
+    """
+    def __init__(self, n_features : int):
+        self.count = 0
+        self.mean = np.zeros(n_features)
+        self.m2 = np.zeros(n_features)
+
+    def merge(self, count : int, mean : np.ndarray, m2 : np.ndarray) -> None:
+        """
+        Chan et al. pairwise combination with the moments of another set.
+        """
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta**2 * (self.count * count / total)
+        self.count = total
+        return
+
+    def update(self, x : np.ndarray) -> None:
+        """
+        Adds a batch of samples x, [n, n_features].
+        """
+        x = np.asarray(x, dtype=np.float64)
+        if x.shape[0] == 0:
+            return
+        mean = x.mean(axis=0)
+        self.merge(x.shape[0], mean, ((x - mean)**2).sum(axis=0))
+        return
+
+    @property
+    def std(self) -> np.ndarray:
+        # population std, as np.std
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+
+def _snapshot_batches(
+        path : str,
+        multiple_cases : Optional[bool] = False,
+        time_chunk : Optional[int] = 32):
+    """
+    Yields the snapshots of a case as [n_cells * n_chunk_snaps, n_features]
+    batches, and the field names first.
+    """
+    if os.path.isdir(path):
+        from dataprep.snapshot_store import open_snapshot_store
+        store = open_snapshot_store(path)
+        yield store.field_names
+        for t0 in range(0, len(store), time_chunk):
+            t1 = min(t0 + time_chunk, len(store))
+            yield np.concatenate([store.read(t) for t in range(t0, t1)], axis=0)
+        return
+
+    import pyvista as pv
+    mesh = pv.read(path)
+    field_names = [str(name) for name in mesh.field_data['field_list']]
+    n_features = len(field_names)
+    yield field_names
+    if multiple_cases:
+        keys = ['x_%d' %(c) for c in range(len(mesh.field_data['case_path_list']))]
+    else:
+        keys = ['x']
+    for key in keys:
+        # [n_cells, n_features * n_snaps], feature-fastest columns
+        data = np.asarray(mesh.cell_data[key])
+        data = data.reshape(mesh.n_cells, -1, n_features)
+        for t0 in range(0, data.shape[1], time_chunk):
+            yield data[:, t0:t0+time_chunk].reshape(-1, n_features)
+    return
+
+
+def case_moments(path : str, multiple_cases : Optional[bool] = False) -> dict:
+    """
+    Moments of the fields of one case (VTK file or snapshot store).
+    """
+    batches = _snapshot_batches(path, multiple_cases)
+    field_names = next(batches)
+    moments = RunningMoments(len(field_names))
+    for x in batches:
+        moments.update(x)
+    return {'field_names' : list(field_names),
+            'count' : moments.count,
+            'mean' : moments.mean,
+            'm2' : moments.m2}
+
+
+def case_fingerprint(
+        path : str,
+        root : str,
+        hash_contents : Optional[bool] = False) -> dict:
+    """
+    Fingerprint of a case that does not depend on where the dataset is
+    mounted: its path relative to root, and the size (or sha1) of the VTK
+    file, or of the meta.json of a snapshot store.
+    """
+    name = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+    if os.path.isdir(path):
+        path = os.path.join(path, 'meta.json')
+    fp = file_fingerprint(path, hash_contents)
+    fp.pop('path')
+    fp.pop('mtime_ns', None)
+    fp['name'] = name
+    return fp
+
+
+def compute_statistics(
+        paths : List[str],
+        num_workers : Optional[int] = 1,
+        multiple_cases : Optional[bool] = False) -> dict:
+    """
+    Mean and std of each field over all cells and snapshots of the cases in
+    paths. Cases are reduced by a pool of num_workers processes and merged in
+    order, so the result does not depend on num_workers.
+    """
+    moments_fn = partial(case_moments, multiple_cases = multiple_cases)
+    if num_workers > 1 and len(paths) > 1:
+        # fork, so that workers do not re-run the (MPI-initializing) main script
+        mp_context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(paths)), mp_context=mp_context) as pool:
+            results = list(pool.map(moments_fn, paths))
+    else:
+        results = [moments_fn(path) for path in paths]
+
+    field_names = results[0]['field_names']
+    moments = RunningMoments(len(field_names))
+    for path, result in zip(paths, results):
+        if result['field_names'] != field_names:
+            raise ValueError('Fields of %s (%s) differ from %s' %(path, result['field_names'], field_names))
+        moments.merge(result['count'], result['mean'], result['m2'])
+    return {'mean' : moments.mean.astype(np.float32),
+            'std' : moments.std.astype(np.float32),
+            'count' : moments.count,
+            'field_names' : field_names}
+
+
+def statistics_key(
+        path_to_stats : str,
+        paths : List[str],
+        multiple_cases : Optional[bool] = False,
+        hash_contents : Optional[bool] = False) -> str:
+    """
+    Key of the cases in paths, fingerprinted relative to the directory of
+    path_to_stats.
+    """
+    root = os.path.dirname(os.path.abspath(path_to_stats))
+    return cache_key({
+        'cases' : [case_fingerprint(path, root, hash_contents) for path in paths],
+        'multiple_cases' : multiple_cases})
+
+
+def keyed_statistics_path(path_to_stats : str, paths : List[str], multiple_cases : Optional[bool] = False) -> str:
+    """
+    Where the stats of paths go when path_to_stats holds the stats of other
+    cases: stats.npz --> stats.<key>.npz, in the same directory.
+    """
+    key = statistics_key(path_to_stats, paths, multiple_cases)
+    return '%s.%s.npz' %(os.path.splitext(path_to_stats)[0], key[:12])
+
+
+def _read_statistics(path_to_stats : str, paths : List[str], multiple_cases : bool) -> Optional[dict]:
+    """
+    Reads path_to_stats if it exists. Returns None if its provenance does
+    not match the cases in paths.
+    """
+    if not os.path.exists(path_to_stats):
+        return None
+    stats = dict(np.load(path_to_stats))
+    if 'provenance' not in stats:
+        log.warning('%s has no provenance (built by an earlier tool): using it as is.' %(path_to_stats))
+        return stats
+    provenance = json.loads(str(stats['provenance']))
+    key = statistics_key(path_to_stats, paths, multiple_cases, provenance.get('hash_contents', False))
+    if provenance['key'] != key:
+        return None
+    return stats
+
+
+def write_statistics(
+        path_to_stats : str,
+        paths : List[str],
+        num_workers : Optional[int] = 1,
+        multiple_cases : Optional[bool] = False,
+        hash_contents : Optional[bool] = False,
+        overwrite : Optional[bool] = False) -> dict:
+    """
+    Computes the statistics of the cases in paths and writes them, with their
+    provenance, to path_to_stats (atomically). Raises FileExistsError if
+    path_to_stats exists, unless overwrite = True. Returns the statistics.
+    """
+    if os.path.exists(path_to_stats) and not overwrite:
+        raise FileExistsError('%s exists (pass overwrite = True to replace it).' %(path_to_stats))
+    t_start = time.time()
+    stats = compute_statistics(paths, num_workers, multiple_cases)
+    root = os.path.dirname(os.path.abspath(path_to_stats))
+    provenance = {
+        'key' : statistics_key(path_to_stats, paths, multiple_cases, hash_contents),
+        'cases' : [case_fingerprint(path, root, hash_contents) for path in paths],
+        'multiple_cases' : multiple_cases,
+        'hash_contents' : hash_contents,
+        'field_names' : stats['field_names'],
+        'created' : time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host' : socket.gethostname(),
+        'compute_time' : time.time() - t_start}
+    stats['provenance'] = json.dumps(provenance)
+
+    os.makedirs(root, exist_ok=True)
+    path_tmp = '%s.%d.tmp.npz' %(path_to_stats, os.getpid())
+    np.savez(path_tmp, **stats)
+    os.replace(path_tmp, path_to_stats)
+    return stats
+
+
+def update_statistics(
+        path_to_stats : str,
+        paths : List[str],
+        num_workers : Optional[int] = 1,
+        multiple_cases : Optional[bool] = False) -> str:
+    """
+    Makes sure load_statistics finds the stats of the cases in paths:
+    computes them to path_to_stats if it does not exist, or to
+    keyed_statistics_path if path_to_stats holds the stats of other cases.
+    Nothing is overwritten. Returns the path of the stats.
+    """
+    for path in [path_to_stats, keyed_statistics_path(path_to_stats, paths, multiple_cases)]:
+        if not os.path.exists(path):
+            write_statistics(path, paths, num_workers, multiple_cases)
+            return path
+        if _read_statistics(path, paths, multiple_cases) is not None:
+            return path
+    raise FileExistsError('%s does not match the cases.' %(path))
+
+
+def load_statistics(
+        path_to_stats : str,
+        paths : List[str],
+        multiple_cases : Optional[bool] = False) -> dict:
+    """
+    Reads the stats of the cases in paths: path_to_stats, or the
+    stats.<key>.npz next to it if the cases changed since path_to_stats was
+    written. A stats file without provenance (built by an earlier tool) is
+    used as is. Raises FileNotFoundError if neither matches; build the stats
+    with update_statistics or the command line first.
+    """
+    for path in [path_to_stats, keyed_statistics_path(path_to_stats, paths, multiple_cases)]:
+        stats = _read_statistics(path, paths, multiple_cases)
+        if stats is not None:
+            return stats
+    if os.path.exists(path_to_stats):
+        path_new = keyed_statistics_path(path_to_stats, paths, multiple_cases)
+    else:
+        path_new = path_to_stats
+    raise FileNotFoundError(
+        'No statistics of the current %d cases at %s: build them with\n'
+        '    python -m dataprep.statistics %s <case> [<case> ...]\n'
+        'or train with regenerate_stats = True.' %(len(paths), path_to_stats, path_new))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute the normalization statistics (stats.npz) of BFS cases.')
+    parser.add_argument('path_to_stats', type=str)
+    parser.add_argument('paths', type=str, nargs='+', help='VTK files or snapshot stores')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes reading the cases')
+    parser.add_argument('--multiple_cases', action='store_true')
+    parser.add_argument('--hash_contents', action='store_true', help='fingerprint the cases by a sha1 of their contents instead of their size')
+    parser.add_argument('--overwrite', action='store_true', help='replace an existing path_to_stats')
+    args = parser.parse_args()
+
+    stats = write_statistics(args.path_to_stats, args.paths, args.workers, args.multiple_cases,
+                             args.hash_contents, args.overwrite)
+    print('Wrote %s (%d cases, %d samples per field) in %.2f s' %(
+        args.path_to_stats, len(args.paths), stats['count'], json.loads(stats['provenance'])['compute_time']))
+    for name, mean, std in zip(stats['field_names'], stats['mean'], stats['std']):
+        print('%-8s mean %12.5e   std %12.5e' %(name, mean, std))
+    return
+
+
+if __name__ == '__main__':
+    main()
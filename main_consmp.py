@@ -4,6 +4,7 @@ PyTorch DDP integrated with PyGeom for multi-node training
 from __future__ import absolute_import, division, print_function, annotations
 import os
 import socket
+import contextlib
 import logging
 
 from typing import Optional, Union, Callable, Tuple, Dict
@@ -37,6 +38,14 @@ import models.gnn_cons as gnn
 # Data preparation
 import dataprep.unstructured_mnist as umnist
 import dataprep.backward_facing_step as bfs
+from dataprep.datasets import SharedTopologyCollater
+from dataprep.sharding import ShardedSampler
+from dataprep.shared_memory import NodeSharedMemory
+from dataprep.staging import stage_files
+from dataprep.broadcast import load_and_broadcast
+from dataprep.precision import upcast
+from dataprep.statistics import load_statistics, update_statistics
+from pooling import set_aggregation_backend
 
 
 
@@ -118,6 +127,11 @@ class Trainer:
         self.backend = self.cfg.backend
         if WITH_DDP:
             init_process_group(RANK, SIZE, backend=self.backend)
+
+        # ~~~~ Device for broadcasting shared artifacts (nccl needs cuda tensors)
+        self.comm_device = 'cpu'
+        if WITH_DDP and dist.get_backend() == 'nccl':
+            self.comm_device = 'cuda'
         
         # ~~~~ Init torch stuff 
         self.setup_torch()
@@ -166,7 +180,11 @@ class Trainer:
         self.epoch_start = 1
         self.training_iter = 0
         if self.cfg.restart:
-            ckpt = torch.load(self.ckpt_path)
+            # read on rank 0 only, then broadcast
+            ckpt = load_and_broadcast(
+                    lambda : torch.load(self.ckpt_path),
+                    device = self.comm_device,
+                    bucket_size_mb = self.cfg.broadcast_bucket_mb)
             self.model.load_state_dict(ckpt['model_state_dict'])
             self.epoch_start = ckpt['epoch'] + 1
             self.epoch = self.epoch_start
@@ -260,6 +278,9 @@ class Trainer:
             log.info(f"SAVE HEADER: {model.get_save_header()}")
             log.info(f"number of parameters: {count_parameters(model)}")
 
+        # ~~~~ Edge aggregation backend: 'scatter' or 'csr' (deterministic, cached CSR index)
+        set_aggregation_backend(model, self.cfg.aggregation_backend)
+
         return model
 
     def build_optimizer(self, model: nn.Module) -> torch.optim.Optimizer:
@@ -302,30 +323,118 @@ class Trainer:
         device_for_loading = 'cpu'
 
         # ~~~~ BFS: FULL-GEOM
+        filenames = [] # this contains the vtk locations 
+        filenames = os.listdir(self.cfg.data_dir + '/BACKWARD_FACING_STEP/full/20_cases/')
+        filenames = sorted([item for item in filenames if 'Re_' in item])
+
         # Get statistics using combined dataset:
-        stats = np.load(self.cfg.data_dir + '/BACKWARD_FACING_STEP/full/20_cases/stats.npz')
+        # -- keyed on the source VTK files. Built offline (python -m
+        #    dataprep.statistics), or with regenerate_stats by rank 0 before
+        #    any collective, while the other ranks wait in an MPI broadcast
+        #    (stats.npz is never overwritten: changed cases get a new file)
+        path_to_stats = self.cfg.data_dir + '/BACKWARD_FACING_STEP/full/20_cases/stats.npz'
+        vtk_paths = [self.cfg.data_dir + '/BACKWARD_FACING_STEP/full/20_cases/' + item + '/VTK/Backward_Facing_Step_0_final_smooth.vtk' for item in filenames]
+        if self.cfg.regenerate_stats:
+            error = None
+            if RANK == 0:
+                try:
+                    update_statistics(path_to_stats, vtk_paths, num_workers = self.cfg.num_load_workers)
+                except Exception as e:
+                    error = e
+            if WITH_DDP:
+                error = MPI.COMM_WORLD.bcast(error, root=0)
+            if error is not None:
+                raise error
+
+        # -- read on rank 0 only, then broadcast
+        stats = load_and_broadcast(
+                lambda : load_statistics(path_to_stats, vtk_paths),
+                device = self.comm_device)
         data_mean = stats['mean']
         data_std = stats['std']
 
         # Load rollout dataset
-        filenames = [] # this contains the vtk locations 
-        filenames = os.listdir(self.cfg.data_dir + '/BACKWARD_FACING_STEP/full/20_cases/')
-        filenames = sorted([item for item in filenames if 'Re_' in item])
-
         filenames = filenames[::2]
 
-        train_dataset = []
-        test_dataset = []
-        for item in filenames: 
-            if RANK == 0: 
-                log.info('loading %s...' %(item))
-            path_to_vtk = self.cfg.data_dir + '/BACKWARD_FACING_STEP/full/20_cases/' + item + '/VTK/Backward_Facing_Step_0_final_smooth.vtk' 
+        # Ranks on this node: used for node-local staging and shared memory
+        if WITH_DDP:
+            node_comm = MPI.COMM_WORLD.Split_type(MPI.COMM_TYPE_SHARED)
+            local_rank, node_barrier = node_comm.Get_rank(), node_comm.Barrier
+        else:
+            local_rank, node_barrier = 0, (lambda : None)
 
-            train_dataset_temp, test_dataset_temp = bfs.get_pygeom_dataset_cell_data(
-                path_to_vtk, 
-                self.cfg.path_to_ei, 
-                self.cfg.path_to_ea,
-                self.cfg.path_to_pos, 
+        seeds = [self.cfg.seed + case_id for case_id in range(len(filenames))]
+        use_store = self.cfg.snapshot_store_dir is not None
+        if use_store:
+            paths = [os.path.join(self.cfg.snapshot_store_dir, item) for item in filenames]
+        else:
+            paths = [self.cfg.data_dir + '/BACKWARD_FACING_STEP/full/20_cases/' + item + '/VTK/Backward_Facing_Step_0_final_smooth.vtk' for item in filenames]
+        path_to_ei = self.cfg.path_to_ei
+        path_to_pos = self.cfg.path_to_pos
+
+        # Node-local staging: one rank per node copies the case and mesh files
+        # from the shared filesystem to stage_dir (optionally converting the
+        # VTK files to snapshot stores), and the loaders read the local copies
+        if self.cfg.stage_dir is not None:
+            t_stage = time.time()
+            path_to_ei, path_to_pos = stage_files(
+                    [path_to_ei, path_to_pos],
+                    self.cfg.data_dir,
+                    os.path.join(self.cfg.stage_dir, 'mesh'),
+                    local_rank == 0,
+                    barrier = node_barrier)
+            paths = stage_files(
+                    paths,
+                    self.cfg.snapshot_store_dir if use_store else self.cfg.data_dir,
+                    os.path.join(self.cfg.stage_dir, 'cases'),
+                    local_rank == 0,
+                    barrier = node_barrier,
+                    convert = self.cfg.stage_convert,
+                    store_dtype = self.cfg.snapshot_dtype)
+            use_store = use_store or self.cfg.stage_convert
+            if RANK == 0:
+                log.info('staged %d cases to %s in %.2f s' %(len(paths), self.cfg.stage_dir, time.time() - t_stage))
+
+        # Mesh topology is shared by all cases: build (or read from the
+        # topology cache) once on rank 0, and broadcast it to the other ranks
+        mesh_topology = load_and_broadcast(
+                lambda : bfs.get_mesh_topology(
+                    path_to_ei,
+                    path_to_pos,
+                    self.cfg.use_radius,
+                    cache_dir = self.cfg.cache_dir,
+                    reorder = self.cfg.node_reorder),
+                device = self.comm_device,
+                bucket_size_mb = self.cfg.broadcast_bucket_mb)
+        bfs.set_mesh_topology(path_to_ei, path_to_pos, self.cfg.use_radius, mesh_topology, reorder = self.cfg.node_reorder)
+
+        # Node shared memory: the local rank 0 loads the snapshots, and the
+        # other ranks on the node attach to them
+        self.node_shm = None
+        if self.cfg.shared_memory_dir is not None:
+            self.node_shm = NodeSharedMemory(self.cfg.shared_memory_dir, local_rank, node_barrier)
+
+        if self.cfg.shard_data:
+            # rank-sharded loading: the train/valid index space is decided
+            # first, then each rank only reads the cases its shard uses.
+            # Snapshot counts are looked up round-robin and gathered.
+            n_snaps = {}
+            for case_id in range(RANK, len(paths), SIZE):
+                n_snaps[case_id] = bfs.get_num_snapshots(
+                        paths[case_id],
+                        time_skip = self.cfg.gnn_dt,
+                        cache_dir = self.cfg.cache_dir)
+            if WITH_DDP and SIZE > 1:
+                n_snaps = {c : n for item in MPI.COMM_WORLD.allgather(n_snaps) for c, n in item.items()}
+            n_snaps = [n_snaps[case_id] for case_id in range(len(paths))]
+
+            train_dataset, test_dataset, load_times = bfs.get_pygeom_dataset_sharded(
+                paths,
+                n_snaps,
+                RANK,
+                SIZE,
+                path_to_ei, 
+                path_to_pos, 
                 device_for_loading, 
                 self.cfg.use_radius,
                 time_skip = self.cfg.gnn_dt,
@@ -333,34 +442,104 @@ class Trainer:
                 scaling = [data_mean, data_std],
                 features_to_keep = [1,2], 
                 fraction_valid = 0.05, 
-                multiple_cases = False)
-            
-            if RANK == 0:
-                log.info('\tnumber of training graphs: %d' %(len(train_dataset_temp)))
-                log.info('\tnumber of validation graphs: %d' %(len(test_dataset_temp)))
+                seeds = seeds,
+                cache_dir = self.cfg.cache_dir,
+                num_workers = self.cfg.num_load_workers,
+                reorder = self.cfg.node_reorder,
+                snapshot_dtype = self.cfg.snapshot_dtype)
+
+        elif use_store:
+            # lazily read snapshots from chunked stores (dataprep/snapshot_store.py)
+            train_dataset = []
+            test_dataset = []
+            load_times = {}
+            for case_id, item in enumerate(filenames): 
+                t_load = time.time()
+                train_dataset_temp, test_dataset_temp = bfs.get_pygeom_dataset_snapshot_store(
+                    paths[case_id],
+                    path_to_ei, 
+                    path_to_pos, 
+                    device_for_loading, 
+                    self.cfg.use_radius,
+                    time_skip = self.cfg.gnn_dt,
+                    time_lag = self.cfg.rollout_steps,
+                    scaling = [data_mean, data_std],
+                    features_to_keep = [1,2], 
+                    fraction_valid = 0.05, 
+                    seed = seeds[case_id],
+                    cache_dir = self.cfg.cache_dir,
+                    reorder = self.cfg.node_reorder)
+                train_dataset.append(train_dataset_temp)
+                test_dataset.append(test_dataset_temp)
+                load_times[case_id] = time.time() - t_load
 
-            train_dataset = train_dataset + train_dataset_temp
-            test_dataset = test_dataset + test_dataset_temp
+        else:
+            # read the VTK files with a pool of num_load_workers processes
+            train_dataset, test_dataset, load_times = bfs.get_pygeom_dataset_cell_data_multiple(
+                paths, 
+                path_to_ei, 
+                self.cfg.path_to_ea,
+                path_to_pos, 
+                device_for_loading, 
+                self.cfg.use_radius,
+                time_skip = self.cfg.gnn_dt,
+                time_lag = self.cfg.rollout_steps,
+                scaling = [data_mean, data_std],
+                features_to_keep = [1,2], 
+                fraction_valid = 0.05, 
+                seeds = seeds,
+                cache_dir = self.cfg.cache_dir,
+                num_workers = self.cfg.num_load_workers,
+                node_shm = self.node_shm,
+                reorder = self.cfg.node_reorder,
+                snapshot_dtype = self.cfg.snapshot_dtype)
+            load_times = dict(enumerate(load_times))
 
-        self.bounding_box = train_dataset[0].bounding_box
+        if RANK == 0:
+            for case_id, load_time in load_times.items():
+                log.info('loaded %s in %.2f s' %(filenames[case_id], load_time))
+            log.info('\tnumber of training graphs: %d' %(sum([len(item) for item in train_dataset])))
+            log.info('\tnumber of validation graphs: %d' %(sum([len(item) for item in test_dataset])))
+
+        # All cases are on the same mesh: batches attach the shared topology.
+        # Low-precision snapshots are upcast on the device when using cuda
+        topology = train_dataset[0].topology
+        collater = SharedTopologyCollater(
+                topology,
+                index_dtype = getattr(torch, self.cfg.index_dtype),
+                upcast = not WITH_CUDA,
+                dense = self.cfg.dense_batch)
+        train_dataset = torch.utils.data.ConcatDataset(train_dataset)
+        test_dataset = torch.utils.data.ConcatDataset(test_dataset)
+
+        self.bounding_box = topology.bounding_box
 
         # DDP: use DistributedSampler to partition training data
-        train_sampler = torch.utils.data.distributed.DistributedSampler(
-            train_dataset, num_replicas=SIZE, rank=RANK,
-        )
-        train_loader = torch_geometric.loader.DataLoader(
+        # -- with sharded loading, the datasets only hold this rank's shard
+        if self.cfg.shard_data:
+            train_sampler = ShardedSampler(train_dataset, seed=self.cfg.seed)
+        else:
+            train_sampler = torch.utils.data.distributed.DistributedSampler(
+                train_dataset, num_replicas=SIZE, rank=RANK,
+            )
+        train_loader = torch.utils.data.DataLoader(
             train_dataset,
             batch_size=self.cfg.batch_size,
             sampler=train_sampler,
+            collate_fn=collater,
             **kwargs
         )
 
         # DDP: use DistributedSampler to partition the test data
-        test_sampler = torch.utils.data.distributed.DistributedSampler(
-            test_dataset, num_replicas=SIZE, rank=RANK
-        )
-        test_loader = torch_geometric.loader.DataLoader(
-            test_dataset, batch_size=self.cfg.test_batch_size
+        if self.cfg.shard_data:
+            test_sampler = ShardedSampler(test_dataset, shuffle=False)
+        else:
+            test_sampler = torch.utils.data.distributed.DistributedSampler(
+                test_dataset, num_replicas=SIZE, rank=RANK
+            )
+        test_loader = torch.utils.data.DataLoader(
+            test_dataset, batch_size=self.cfg.test_batch_size,
+            collate_fn=collater
         )
 
         return {
@@ -374,6 +553,25 @@ class Trainer:
             }
         }
 
+    def rollout_loss(
+            self,
+            x_old: Tensor,
+            data: DataBatch,
+            nvec: Tensor,
+            t: int,
+            loss_scale: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        One step of the rollout: the prediction x_new from x_old, and its loss 
+        against data.y[t], scaled by loss_scale. nvec are the edge normals.
+        """
+        x_new = self.model(x_old, data.edge_index, data.pos, data.edge_attr, nvec, data.batch)
+
+        # Accumulate loss 
+        target = data.y[t]
+        if WITH_CUDA:
+            target = upcast(target.cuda())
+        return x_new, loss_scale * self.loss_fn(x_new, target)
+
     def train_step(
         self,
         data: DataBatch
@@ -390,11 +588,12 @@ class Trainer:
         loss_dict['lam'] = torch.tensor([-0.0002459254785])
 
         if WITH_CUDA:
-            data.x = data.x.cuda()
+            data.x = upcast(data.x.cuda())
             data.edge_index = data.edge_index.cuda()
             data.edge_attr = data.edge_attr.cuda()
             data.pos = data.pos.cuda()
-            data.batch = data.batch.cuda()
+            if data.batch is not None:
+                data.batch = data.batch.cuda()
             loss = loss.cuda()
             loss_scale = loss_scale.cuda()
             loss_dict['comp1'] = loss_dict['comp1'].cuda()
@@ -412,37 +611,128 @@ class Trainer:
         nvec = dvec/dist
 
         self.optimizer.zero_grad()
-        
-        # Rollout prediction: 
-        x_new = data.x
-        for t in range(rollout_length):
-            if self.cfg.use_noise and t == 0:
-                noise = self.noise_dist.sample((data.x.shape[0],))
-                if WITH_CUDA:
-                    noise = noise.cuda()
-                x_old = torch.clone(x_new) + noise
-            else:
-                x_old = torch.clone(x_new)
-
-            x_new = self.model(x_old, data.edge_index, data.pos, data.edge_attr, nvec, data.batch)
 
-            # Accumulate loss 
-            target = data.y[t]
+        # Initial condition 
+        x_new = data.x
+        if self.cfg.use_noise:
+            noise = self.noise_dist.sample(data.x.shape[:-1])
             if WITH_CUDA:
-                target = target.cuda()
-            loss += loss_scale * self.loss_fn(x_new, target)
+                noise = noise.cuda()
+            x_new = torch.clone(x_new) + noise
 
+        # Rollout prediction: the gradient is that of the loss summed over the 
+        # rollout in every mode, except for the steps pushforward runs without grad 
+        if self.cfg.rollout_mode == 'stepwise':
+            loss += self.rollout_stepwise(x_new, data, nvec, rollout_length, loss_scale)
+        else:
+            for steps, with_grad, sync in self.rollout_segments(rollout_length):
+                # DDP: gradients of all but the last segment are accumulated locally 
+                with self.grad_sync(sync), torch.set_grad_enabled(with_grad):
+                    # start the segment from the state of the previous one (truncation)
+                    x_new = x_new.detach()
+                    loss_segment = 0.
+                    for t in steps:
+                        x_new, loss_t = self.rollout_loss(torch.clone(x_new), data, nvec, t, loss_scale)
+                        loss_segment = loss_segment + loss_t
+                    if with_grad:
+                        self.backward(loss_segment)
+                loss += loss_segment.detach()
 
         if self.scaler is not None and isinstance(self.scaler, GradScaler):
-            self.scaler.scale(loss).backward()
             self.scaler.step(self.optimizer)
             self.scaler.update()
         else:
-            loss.backward()
             self.optimizer.step()
 
         return loss, loss_dict
 
+    def rollout_segments(self, rollout_length: int) -> list:
+        """
+        The rollout as segments (steps, with_grad, sync): the graph is cut 
+        between segments, and each segment with grad is backpropagated on 
+        its own, so only the graph of one segment is held at a time. sync is 
+        False for segments whose gradients are only accumulated (DDP no_sync).
+            full:        one segment, backpropagation through the whole rollout
+            tbptt:       segments of rollout_truncation steps (truncated BPTT)
+            pushforward: rollout_length - rollout_truncation steps without 
+                         grad, then rollout_truncation steps with grad 
+        """
+        mode = self.cfg.rollout_mode
+        k = min(self.cfg.rollout_truncation, rollout_length)
+        if mode == 'full':
+            return [(range(rollout_length), True, True)]
+        elif mode == 'tbptt':
+            starts = list(range(0, rollout_length, k))
+            return [(range(t, min(t + k, rollout_length)), True, t == starts[-1]) for t in starts]
+        elif mode == 'pushforward':
+            segments = [(range(rollout_length - k, rollout_length), True, True)]
+            if rollout_length > k:
+                segments = [(range(rollout_length - k), False, True)] + segments
+            return segments
+        else:
+            raise ValueError('Invalid rollout mode: %s' %(mode))
+
+    def rollout_stepwise(
+            self,
+            x_0: Tensor,
+            data: DataBatch,
+            nvec: Tensor,
+            rollout_length: int,
+            loss_scale: Tensor) -> Tensor:
+        """
+        Backpropagation through the whole rollout with the graph of one step 
+        at a time: the rollout is first run without grad, keeping only the 
+        states x_t. Then, from the last step back, step t is run again from 
+        x_t and backpropagated, with the gradient of the later steps' loss 
+        wrt its output; the gradient wrt x_t is passed on to step t-1. The 
+        parameter gradients are accumulated over the steps, and are those of 
+        the full mode. Returns the loss.
+        """
+        loss = 0.
+        states = [x_0]
+        with torch.no_grad():
+            for t in range(rollout_length):
+                x_new, loss_t = self.rollout_loss(torch.clone(states[-1]), data, nvec, t, loss_scale)
+                states += [x_new]
+                loss += loss_t
+
+        grad = None
+        for t in reversed(range(rollout_length)):
+            # DDP: gradients are reduced in the backward of the first step only 
+            with self.grad_sync(t == 0):
+                x_old = states[t].detach().requires_grad_(t > 0)
+                x_new, loss_t = self.rollout_loss(x_old, data, nvec, t, loss_scale)
+                self.backward(loss_t, x_new, grad)
+                grad = x_old.grad
+        return loss
+
+    def grad_sync(self, sync: bool):
+        """
+        Context of a backward pass: with sync = False and DDP, the gradients 
+        are accumulated locally (no_sync), and reduced with those of the next 
+        backward in sync. 
+        """
+        if not sync and isinstance(self.model, DDP):
+            return self.model.no_sync()
+        return contextlib.nullcontext()
+
+    def backward(
+            self, 
+            loss: Tensor,
+            output: Optional[Tensor] = None, 
+            grad_output: Optional[Tensor] = None) -> None:
+        """
+        Accumulates the gradients of loss (scaled by the grad scaler, if 
+        any), plus those of output with its incoming gradient grad_output.
+        """
+        if self.scaler is not None and isinstance(self.scaler, GradScaler):
+            loss = self.scaler.scale(loss)
+        if grad_output is None:
+            loss.backward()
+        else:
+            torch.autograd.backward([loss, output], [None, grad_output])
+        return
+
     def train_epoch(
             self,
             epoch: int,
@@ -539,11 +829,12 @@ class Trainer:
                 loss_dict['lam'] = torch.tensor([-0.0002459254785])
 
                 if WITH_CUDA:
-                    data.x = data.x.cuda()
+                    data.x = upcast(data.x.cuda())
                     data.edge_index = data.edge_index.cuda()
                     data.edge_attr = data.edge_attr.cuda()
                     data.pos = data.pos.cuda()
-                    data.batch = data.batch.cuda()
+                    if data.batch is not None:
+                        data.batch = data.batch.cuda()
                     loss = loss.cuda()
                     loss_scale = loss_scale.cuda()
                     loss_dict['comp1'] = loss_dict['comp1'].cuda() 
@@ -565,7 +856,7 @@ class Trainer:
                 x_new = data.x
                 for t in range(rollout_length):
                     if self.cfg.use_noise and t == 0:
-                        noise = self.noise_dist.sample((data.x.shape[0],))
+                        noise = self.noise_dist.sample(data.x.shape[:-1])
                         if WITH_CUDA:
                             noise = noise.cuda()
                         x_old = torch.clone(x_new) + noise
@@ -577,7 +868,7 @@ class Trainer:
                     # Accumulate loss 
                     target = data.y[t]
                     if WITH_CUDA:
-                        target = target.cuda()
+                        target = upcast(target.cuda())
                     loss += loss_scale * self.loss_fn(x_new, target)
 
                 running_loss += loss.item()
@@ -693,6 +984,9 @@ def train(cfg: DictConfig):
             torch.save(ckpt, trainer.ckpt_path)
         dist.barrier()
 
+    if trainer.node_shm is not None:
+        trainer.node_shm.cleanup()
+
     rstr = f'[{RANK}] ::'
     log.info(' '.join([
         rstr,
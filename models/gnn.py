@@ -3,10 +3,136 @@ from typing import Optional, Union, Callable
 import torch
 from torch import Tensor
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 import torch.nn.functional as F
 import torch_geometric.nn as tgnn
 from torch_geometric.nn.conv import MessagePassing
-from pooling import TopKPooling_Mod, avg_pool_mod, avg_pool_mod_no_x
+from pooling import TopKPooling_Mod, segment_aggregate, avg_pool_mod, MultiscaleHierarchy, get_hierarchy, get_batched_graph
+
+
+def factorized_edge_linear(
+        lin: nn.Linear, 
+        x: Tensor, 
+        edge_index: LongTensor, 
+        edge_attr: Tensor) -> Tensor:
+    """
+    Computes lin(torch.cat((x[edge_index[0]], x[edge_index[1]], edge_attr), axis=1))
+    without the [n_edges, 2*n_x + n_e] concatenation. The weight of lin is split 
+    into owner, neighbor and edge blocks; the owner and neighbor blocks are applied 
+    to the nodes, and the results are gathered to the edges. The parameters of lin 
+    are used as they are, so state_dicts are unchanged.
+
+    x may also be a dense batch [B, N, F] on the graph of edge_index, with
+    edge_attr [E, F_e] (shared) or [B, E, F_e]: the gathers act on the node
+    dimension of all samples, and the result is [B, E, F_out].
+    """
+    n_x = x.size(-1)
+    w_own, w_nei, w_edge = torch.split(lin.weight, [n_x, n_x, lin.in_features - 2*n_x], dim=1)
+    x_own, x_nei = F.linear(x, torch.cat((w_own, w_nei), dim=0)).split(lin.out_features, dim=-1)
+    return x_own.index_select(-2, edge_index[0]) + x_nei.index_select(-2, edge_index[1]) + F.linear(edge_attr, w_edge, lin.bias)
+
+
+def edge_block(
+        lins: nn.ModuleList,
+        norm: nn.Module,
+        act: Callable,
+        x: Tensor,
+        edge_index: LongTensor,
+        edge_attr: Tensor) -> Tensor:
+    """
+    Edge update of a message passing step: norm(edge_attr + mlp([x_own, x_nei, edge_attr])), 
+    with act between the Linear layers lins and the first layer factorized 
+    (see factorized_edge_linear). Straight-line code with no host syncs, so 
+    that it compiles to one graph (see compile_blocks).
+    """
+    h = factorized_edge_linear(lins[0], x, edge_index, edge_attr)
+    for j in range(1, len(lins)):
+        h = lins[j](act(h))
+    return norm(edge_attr + h)
+
+
+def node_block(
+        lins: nn.ModuleList,
+        norm: nn.Module,
+        act: Callable,
+        x: Tensor,
+        edge_agg: Tensor) -> Tensor:
+    """
+    Node update of a message passing step: norm(x + mlp([x, edge_agg])). 
+    Compiles to one graph, like edge_block.
+    """
+    h = lins[0](torch.cat((x, edge_agg), dim=-1))
+    for j in range(1, len(lins)):
+        h = lins[j](act(h))
+    return norm(x + h)
+
+
+def compile_blocks(model: nn.Module, **kwargs) -> nn.Module:
+    """
+    Opt-in torch.compile of the message passing layers of model: the edge and 
+    node blocks of every Multiscale_MessagePassing_Layer are replaced by one 
+    shared compiled version of edge_block/node_block (fullgraph, so they 
+    cannot graph-break; kwargs go to torch.compile). The rest of the forward 
+    (hierarchy lookups, sparse interpolation, edge aggregation, TopK pooling) 
+    runs eagerly between the compiled regions. Parameters and state_dicts 
+    are unchanged.
+    """
+    edge_fn = torch.compile(edge_block, fullgraph=True, **kwargs)
+    node_fn = torch.compile(node_block, fullgraph=True, **kwargs)
+    for module in model.modules():
+        if isinstance(module, Multiscale_MessagePassing_Layer):
+            module.edge_block = edge_fn
+            module.node_block = node_fn
+    return model
+
+
+CHECKPOINT_GRANULARITIES = ['none', 'block', 'level', 'step']
+
+
+def set_checkpointing(model: nn.Module, granularity: str) -> nn.Module:
+    """
+    Activation checkpointing in the Multiscale_MessagePassing_Layers of model, 
+    which then keep only the inputs of each checkpointed segment for backward 
+    and recompute the rest: 
+        'block': the whole layer (one U-Net) 
+        'level': each level of the U-Net (pooling/interpolation + its steps) 
+        'step':  each message passing step (edge update, aggregation, node update) 
+        'none':  no checkpointing 
+    Coarser segments keep fewer tensors, but are larger to recompute at once. 
+    """
+    if granularity not in CHECKPOINT_GRANULARITIES:
+        raise ValueError('Invalid checkpointing granularity: %s (expected one of %s)' %(granularity, CHECKPOINT_GRANULARITIES))
+    for module in model.modules():
+        if isinstance(module, Multiscale_MessagePassing_Layer):
+            module.checkpointing = None if granularity == 'none' else granularity
+    return model
+
+
+def graph_break_report(model: nn.Module, *args) -> str:
+    """
+    Summary of what stops model(*args) from compiling as a whole: traces it 
+    once with torch.compile (eager backend, no_grad) and lists the graph 
+    breaks by reason, the functions that are resumed after a break, and the 
+    frames dynamo gives up on and runs eagerly. Compiled code that is already 
+    cached (e.g. the blocks of compile_blocks) is kept.
+    """
+    from torch._dynamo.utils import counters
+    counters.clear()
+    with torch.no_grad():
+        torch.compile(model, backend='eager')(*args)
+    lines = ['%d graphs, %d graph breaks, %d/%d frames compiled' %(
+        counters['stats']['unique_graphs'], sum(counters['graph_break'].values()), 
+        counters['frames']['ok'], counters['frames']['total'])]
+    # first line of a reason: the kind of break, second: what triggered it
+    brief = lambda reason: ' '.join(line.strip() for line in reason.splitlines()[:2])
+    for reason, count in counters['graph_break'].items():
+        lines += ['  break (x%d): %s' %(count, brief(reason))]
+    for reason in counters['unimplemented']:
+        lines += ['  eager frame: %s' %(brief(reason))]
+    if counters['resumes']:
+        lines += ['  resumed in: %s' %(', '.join(name.replace('torch_dynamo_resume_in_', '') for name in counters['resumes']))]
+    return '\n'.join(lines)
+
 
 class Multiscale_MessagePassing_UNet(torch.nn.Module):
     def __init__(self, 
@@ -263,10 +389,17 @@ class Multiscale_MessagePassing_UNet(torch.nn.Module):
             edge_index: LongTensor, 
             edge_attr: Tensor, 
             pos: Tensor, 
-            batch: Optional[LongTensor] = None) -> Tensor:
+            batch: Optional[LongTensor] = None,
+            hierarchy: Optional[MultiscaleHierarchy] = None) -> Tensor:
         if batch is None:
             batch = edge_index.new_zeros(x.size(0))
 
+        # Voxel clustering hierarchy: static for a given mesh and batch size,
+        # so it is memoized unless given by the caller 
+        if hierarchy is None:
+            hierarchy = get_hierarchy(edge_index, pos, batch, self.lengthscales, 
+                                      [self.x_lo, self.x_hi, self.y_lo, self.y_hi])
+
         # ~~~~ Node Encoder: 
         for i in range(self.n_mlp_encode):
             x = self.node_encode[i](x) 
@@ -287,14 +420,13 @@ class Multiscale_MessagePassing_UNet(torch.nn.Module):
         m = 0 # level index 
         n_mp = self.n_mp_down[m] # number of message passing blocks 
         for i in range(n_mp):
-            # 1) concatenate edge + neighbor + owner into new edge_attr 
-            x_own = x[edge_index[0,:], :]
-            x_nei = x[edge_index[1,:], :]
-            edge_attr_t = torch.cat((x_own, x_nei, edge_attr), axis=1)
-
-            # 2) edge update mlp
+            # 1-2) edge update mlp on [owner, neighbor, edge]. The first layer is 
+            # factorized: owner/neighbor blocks are applied per node, then gathered 
             for j in range(self.n_mlp_mp):
-                edge_attr_t = self.edge_down_mps[m][i][j](edge_attr_t) 
+                if j == 0:
+                    edge_attr_t = factorized_edge_linear(self.edge_down_mps[m][i][j], x, edge_index, edge_attr)
+                else:
+                    edge_attr_t = self.edge_down_mps[m][i][j](edge_attr_t) 
                 if j < self.n_mlp_mp - 1:
                     edge_attr_t = self.act(edge_attr_t)
                 else:
@@ -342,29 +474,24 @@ class Multiscale_MessagePassing_UNet(torch.nn.Module):
         # ~~~~ Downward message passing 
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         for m in range(1, self.depth + 1):
-            # Run voxel clustering
-            cluster = tgnn.voxel_grid(pos = pos,
-                                      size = self.lengthscales[m-1],
-                                      batch = batch,
-                                      start = [self.x_lo, self.y_lo], 
-                                      end = [self.x_hi, self.y_hi])
+            # Voxel clustering and pooled graph: precomputed in the hierarchy 
+            cluster = hierarchy.clusters[m-1]
+            edge_index = hierarchy.edge_indices[m]
+            batch = hierarchy.batches[m]
+            pos = hierarchy.positions[m]
+
+            # Pool edge attributes: segment mean over the pooled edges 
+            edge_attr = hierarchy.pool_edge_attr(m, edge_attr)
 
             if self.interpolation_mode == 'learned':
-                pos_f = pos.clone()
-                edge_index, edge_attr, batch, pos, cluster, perm = avg_pool_mod_no_x(
-                                                                                cluster,
-                                                                                edge_index, 
-                                                                                edge_attr,
-                                                                                batch, 
-                                                                                pos)
-                
-                # construct the edge index 
-                n_nodes = x.shape[0]
-                edge_index_f2c = torch.concat( (torch.arange(0, n_nodes, dtype=torch.long, device=x.device).view(1,-1), cluster.view(1,-1)), axis=0 )
+                pos_f = hierarchy.positions[m-1]
+
+                # fine-to-coarse edge index 
+                edge_index_f2c = hierarchy.edge_indices_f2c[m-1]
                 
                 # intialize the edge attributes using distance vector. Normalize by characteristic length at fine level 
                 pos_c = pos
-                edge_attr_f2c = (pos_c[edge_index_f2c[1,:]] - pos_f[edge_index_f2c[0,:]])/self.l_char[m-1]
+                edge_attr_f2c = hierarchy.distances_f2c[m-1]/self.l_char[m-1]
 
                 # encode the edge attributes with MLP
                 for j in range(self.n_mlp_mp):
@@ -398,13 +525,8 @@ class Multiscale_MessagePassing_UNet(torch.nn.Module):
                 x = self.edge_aggregator( (pos_f, pos_c), edge_index_f2c, temp_ea )  
                 
             else:
-                x, edge_index, edge_attr, batch, pos, cluster, perm = avg_pool_mod(
-                                                                                cluster, 
-                                                                                x, 
-                                                                                edge_index, 
-                                                                                edge_attr,
-                                                                                batch, 
-                                                                                pos)
+                # Pool node attributes 
+                x = hierarchy.pool_x(m, x)
             
             # Append lists
             positions += [pos]
@@ -413,14 +535,13 @@ class Multiscale_MessagePassing_UNet(torch.nn.Module):
 
             # Do message passing on coarse graph
             for i in range(self.n_mp_down[m]):
-                # 1) concatenate edge + neighbor + owner into new edge_attr 
-                x_own = x[edge_index[0,:], :]
-                x_nei = x[edge_index[1,:], :]
-                edge_attr_t = torch.cat((x_own, x_nei, edge_attr), axis=1)
-
-                # 2) edge update mlp
+                # 1-2) edge update mlp on [owner, neighbor, edge]. The first layer is 
+                # factorized: owner/neighbor blocks are applied per node, then gathered 
                 for j in range(self.n_mlp_mp):
-                    edge_attr_t = self.edge_down_mps[m][i][j](edge_attr_t) 
+                    if j == 0:
+                        edge_attr_t = factorized_edge_linear(self.edge_down_mps[m][i][j], x, edge_index, edge_attr)
+                    else:
+                        edge_attr_t = self.edge_down_mps[m][i][j](edge_attr_t) 
                     if j < self.n_mlp_mp - 1:
                         edge_attr_t = self.act(edge_attr_t)
                     else:
@@ -480,12 +601,8 @@ class Multiscale_MessagePassing_UNet(torch.nn.Module):
             if self.interpolation_mode == 'pc':
                 x = x[clusters[fine]] + res
             elif self.interpolation_mode == 'knn':
-                x = tgnn.knn_interpolate(x = x,
-                                         pos_x = positions[fine+1],
-                                         pos_y = positions[fine],
-                                         batch_x = batches[fine+1],
-                                         batch_y = batches[fine],
-                                         k = 4) 
+                # knn interpolation: product with the cached interpolation matrix 
+                x = hierarchy.interpolate(fine+1, x, k = 4) 
                 x += res
             elif self.interpolation_mode == 'learned':
 
@@ -513,14 +630,13 @@ class Multiscale_MessagePassing_UNet(torch.nn.Module):
             # Message passing on new upsampled graph
             for i in range(self.n_mp_up[m]):
                 for r in range(self.n_repeat_mp_up):
-                    # 1) concatenate edge + neighbor + owner into new edge_attr 
-                    x_own = x[edge_index[0,:], :]
-                    x_nei = x[edge_index[1,:], :]
-                    edge_attr_t = torch.cat((x_own, x_nei, edge_attr), axis=1)
-
-                    # 2) edge update mlp
+                    # 1-2) edge update mlp on [owner, neighbor, edge]. The first layer is 
+                    # factorized: owner/neighbor blocks are applied per node, then gathered 
                     for j in range(self.n_mlp_mp):
-                        edge_attr_t = self.edge_up_mps[m][i][j](edge_attr_t) 
+                        if j == 0:
+                            edge_attr_t = factorized_edge_linear(self.edge_up_mps[m][i][j], x, edge_index, edge_attr)
+                        else:
+                            edge_attr_t = self.edge_up_mps[m][i][j](edge_attr_t) 
                         if j < self.n_mlp_mp - 1:
                             edge_attr_t = self.act(edge_attr_t)
                         else:
@@ -630,6 +746,14 @@ class Multiscale_MessagePassing_UNet(torch.nn.Module):
 
 
 class Multiscale_MessagePassing_Layer(torch.nn.Module):
+    # residual mlp blocks of the message passing steps, replaced by compiled 
+    # versions in compile_blocks 
+    edge_block = staticmethod(edge_block)
+    node_block = staticmethod(node_block)
+
+    # activation checkpointing granularity, set by set_checkpointing 
+    checkpointing = None
+
     def __init__(self, hidden_channels: int, 
                  n_mlp_mp: int, 
                  n_mp_down: List[int], 
@@ -839,184 +963,62 @@ class Multiscale_MessagePassing_Layer(torch.nn.Module):
             edge_index: LongTensor, 
             edge_attr: Tensor, 
             pos: Tensor, 
-            batch: Optional[LongTensor] = None) -> Tensor:
+            batch: Optional[LongTensor] = None,
+            hierarchy: Optional[MultiscaleHierarchy] = None) -> Tensor:
+        # x is [N, F], or a dense batch [B, N, F] of samples on the graph 
+        # (edge_index, pos, batch) with shared [E, F] or per-sample [B, E, F] edge_attr 
         if batch is None:
-            batch = edge_index.new_zeros(x.size(0))
-
-        # ~~~~ INITIAL MESSAGE PASSING ON FINE GRAPH (m = 0)
-        m = 0 # level index 
-        n_mp = self.n_mp_down[m] # number of message passing blocks 
-        for i in range(n_mp):
-            # 1) concatenate edge + neighbor + owner into new edge_attr 
-            x_own = x[edge_index[0,:], :]
-            x_nei = x[edge_index[1,:], :]
-            edge_attr_t = torch.cat((x_own, x_nei, edge_attr), axis=1)
-
-            # 2) edge update mlp
-            for j in range(self.n_mlp_mp):
-                edge_attr_t = self.edge_down_mps[m][i][j](edge_attr_t) 
-                if j < self.n_mlp_mp - 1:
-                    edge_attr_t = self.act(edge_attr_t)
-                else:
-                    edge_attr_t = edge_attr_t
- 
-            # 3) edge residual connection
-            edge_attr = edge_attr + edge_attr_t
-           
-            # 4) edge layer norm
-            edge_attr = self.edge_down_norms[m][i](edge_attr)
+            batch = edge_index.new_zeros(pos.size(0))
 
-            # 5) get the aggregate edge features as node features: mean aggregation 
-            edge_agg = self.edge_aggregator(x, edge_index, edge_attr)
+        # Voxel clustering hierarchy: static for a given mesh and batch size,
+        # so it is memoized unless given by the caller 
+        if hierarchy is None:
+            hierarchy = get_hierarchy(edge_index, pos, batch, self.lengthscales, 
+                                      [self.x_lo, self.x_hi, self.y_lo, self.y_hi])
 
-            # 6) concatenate owner node + edge 
-            x_t = torch.cat((x, edge_agg), axis=1)
+        return self.run_checkpointed('block', self.unet, x, edge_index, edge_attr, hierarchy)
 
-            # 7) node update mlp
-            for j in range(self.n_mlp_mp):
-                x_t = self.node_down_mps[m][i][j](x_t)
-                if j < self.n_mlp_mp - 1:
-                    x_t = self.act(x_t) 
-                else:
-                    x_t = x_t
-            
-            # 8) node residual connection
-            x = x + x_t
-
-            # 9) node layer norm 
-            x = self.node_down_norms[m][i](x)
+    def run_checkpointed(self, granularity: str, fn: Callable, *args):
+        """
+        fn(*args), under activation checkpointing if it is enabled at this 
+        granularity (see set_checkpointing): the activations inside fn are not 
+        kept for backward, and fn is run again to recompute them. 
+        """
+        if self.checkpointing == granularity and torch.is_grad_enabled():
+            return checkpoint(fn, *args, use_reentrant=False)
+        return fn(*args)
 
+    def unet(
+            self, 
+            x: Tensor, 
+            edge_index: LongTensor, 
+            edge_attr: Tensor, 
+            hierarchy: MultiscaleHierarchy) -> Tuple[Tensor, Tensor]:
+        # ~~~~ INITIAL MESSAGE PASSING ON FINE GRAPH (m = 0)
+        m = 0 # level index 
+        x, edge_attr = self.run_checkpointed('level', self.mp_steps, 
+                                             self.n_mp_down[m], 1, 
+                                             self.edge_down_mps[m], self.edge_down_norms[m], 
+                                             self.node_down_mps[m], self.node_down_norms[m], 
+                                             x, edge_index, edge_attr)
             
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # ~~~~ Store level 0 embeddings in lists  
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         xs = [x] 
-        edge_indices = [edge_index]
         edge_attrs = [edge_attr]
-        positions = [pos]
-        batches = [batch]
-        clusters = []
         edge_attrs_f2c = []
        
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         # ~~~~ Downward message passing 
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         for m in range(1, self.depth + 1):
-            # Run voxel clustering
-            cluster = tgnn.voxel_grid(pos = pos,
-                                      size = self.lengthscales[m-1],
-                                      batch = batch,
-                                      start = [self.x_lo, self.y_lo], 
-                                      end = [self.x_hi, self.y_hi])
-
-            if self.interpolation_mode == 'learned':
-                pos_f = pos.clone()
-                edge_index, edge_attr, batch, pos, cluster, perm = avg_pool_mod_no_x(
-                                                                                cluster,
-                                                                                edge_index, 
-                                                                                edge_attr,
-                                                                                batch, 
-                                                                                pos)
-                
-                # construct the edge index 
-                n_nodes = x.shape[0]
-                edge_index_f2c = torch.concat( (torch.arange(0, n_nodes, dtype=torch.long, device=x.device).view(1,-1), cluster.view(1,-1)), axis=0 )
-                
-                # intialize the edge attributes using distance vector. Normalize by characteristic length at fine level 
-                pos_c = pos
-                edge_attr_f2c = (pos_c[edge_index_f2c[1,:]] - pos_f[edge_index_f2c[0,:]])/self.l_char[m-1]
-
-                # encode the edge attributes with MLP
-                for j in range(self.n_mlp_mp):
-                    edge_attr_f2c = self.edge_encoder_f2c_mlp[j](edge_attr_f2c)
-                    if j < self.n_mlp_mp - 1:
-                        edge_attr_f2c = self.act(edge_attr_f2c)
-                    else:
-                        edge_attr_f2c = edge_attr_f2c
-                 
-                # append list
-                edge_attrs_f2c += [edge_attr_f2c]
-
-                # Concatenate
-                temp_ea = torch.cat((edge_attr_f2c, x), axis=1)
-
-                # Apply downsample MLP
-                for j in range(self.n_mlp_mp):
-                    temp_ea = self.downsample_mlp[j](temp_ea)
-                    if j < self.n_mlp_mp - 1:
-                        temp_ea = self.act(temp_ea)
-                    else:
-                        temp_ea = temp_ea
-
-                # Residual connection
-                temp_ea = edge_attr_f2c + temp_ea
-
-                # normalization
-                temp_ea = self.downsample_norm(temp_ea)
-
-                # apply edge agg
-                x = self.edge_aggregator( (pos_f, pos_c), edge_index_f2c, temp_ea )  
-                
-            else:
-                x, edge_index, edge_attr, batch, pos, cluster, perm = avg_pool_mod(
-                                                                                cluster, 
-                                                                                x, 
-                                                                                edge_index, 
-                                                                                edge_attr,
-                                                                                batch, 
-                                                                                pos)
-            
-            # Append lists
-            positions += [pos]
-            batches += [batch]
-            clusters += [cluster]
-
-            # Do message passing on coarse graph
-            for i in range(self.n_mp_down[m]):
-                # 1) concatenate edge + neighbor + owner into new edge_attr 
-                x_own = x[edge_index[0,:], :]
-                x_nei = x[edge_index[1,:], :]
-                edge_attr_t = torch.cat((x_own, x_nei, edge_attr), axis=1)
-
-                # 2) edge update mlp
-                for j in range(self.n_mlp_mp):
-                    edge_attr_t = self.edge_down_mps[m][i][j](edge_attr_t) 
-                    if j < self.n_mlp_mp - 1:
-                        edge_attr_t = self.act(edge_attr_t)
-                    else:
-                        edge_attr_t = edge_attr_t
-                
-                # 3) edge residual conneciton 
-                edge_attr = edge_attr + edge_attr_t
-
-                # 4) edge layer norm
-                edge_attr = self.edge_down_norms[m][i](edge_attr)
-                
-                # 5) get the aggregate edge features as node features: mean aggregation 
-                edge_agg = self.edge_aggregator(x, edge_index, edge_attr)
-
-                # 6) concatenate owner node + edge 
-                x_t = torch.cat((x, edge_agg), axis=1)
-
-                # 7) node update mlp
-                for j in range(self.n_mlp_mp):
-                    x_t = self.node_down_mps[m][i][j](x_t)
-                    if j < self.n_mlp_mp - 1:
-                        x_t = self.act(x_t) 
-                    else:
-                        x_t = x_t
-                
-                # 8) node residual connection 
-                x = x + x_t
-
-                # 9) node layer norm 
-                x = self.node_down_norms[m][i](x)
-
+            x, edge_attr, edge_attr_f2c = self.run_checkpointed('level', self.down_level, m, x, edge_attr, hierarchy)
+            edge_attrs_f2c += [edge_attr_f2c]
             
             # If there are coarser levels, append the fine-level lists
             if m < self.depth:
                 xs += [x]
-                edge_indices += [edge_index]
                 edge_attrs += [edge_attr]
 
         # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -1026,91 +1028,173 @@ class Multiscale_MessagePassing_Layer(torch.nn.Module):
             # Get the fine level index
             # if m = 0: fine = 1 - 1 - 0 = 0
             fine = self.depth - 1 - m
+            x, edge_attr = self.run_checkpointed('level', self.up_level, m, x, xs[fine], edge_attrs[fine], 
+                                                 edge_attrs_f2c[fine], hierarchy)
+        return x, edge_attr 
 
-            # Get node features and edge features on fine level
-            res = xs[fine]
+    def down_level(
+            self, 
+            m: int, 
+            x: Tensor, 
+            edge_attr: Tensor, 
+            hierarchy: MultiscaleHierarchy) -> Tuple[Tensor, Tensor, Optional[Tensor]]:
+        """
+        Level m of the downward path: pooling from level m-1 and message 
+        passing on the coarse graph. Returns x, edge_attr and the encoded 
+        fine-to-coarse edge features (learned interpolation only, else None). 
+        """
+        # Voxel clustering and pooled graph: precomputed in the hierarchy 
+        edge_index = hierarchy.edge_indices[m]
+        pos = hierarchy.positions[m]
+        edge_attr_f2c = None
 
-            # Get edge index on fine level
-            edge_index = edge_indices[fine]
+        # Pool edge attributes: segment mean over the pooled edges 
+        edge_attr = hierarchy.pool_edge_attr(m, edge_attr)
 
-            # Upsample edge features
-            edge_attr = edge_attrs[fine]
+        if self.interpolation_mode == 'learned':
+            pos_f = hierarchy.positions[m-1]
 
-            # # Upsample node features: Piecewise constant interpolation 
-            if self.interpolation_mode == 'pc':
-                x = x[clusters[fine]] + res
-            elif self.interpolation_mode == 'knn':
-                x = tgnn.knn_interpolate(x = x,
-                                         pos_x = positions[fine+1],
-                                         pos_y = positions[fine],
-                                         batch_x = batches[fine+1],
-                                         batch_y = batches[fine],
-                                         k = 4) 
-                x += res
-            elif self.interpolation_mode == 'learned':
+            # fine-to-coarse edge index 
+            edge_index_f2c = hierarchy.edge_indices_f2c[m-1]
+            
+            # intialize the edge attributes using distance vector. Normalize by characteristic length at fine level 
+            pos_c = pos
+            edge_attr_f2c = hierarchy.distances_f2c[m-1]/self.l_char[m-1]
 
-                # Get edge attributes 
-                edge_attr_c2f = -edge_attrs_f2c[fine]
-    
-                # coarse node attributes upsampled using pc interp 
-                x = x[clusters[fine]]
+            # encode the edge attributes with MLP
+            for j in range(self.n_mlp_mp):
+                edge_attr_f2c = self.edge_encoder_f2c_mlp[j](edge_attr_f2c)
+                if j < self.n_mlp_mp - 1:
+                    edge_attr_f2c = self.act(edge_attr_f2c)
+                else:
+                    edge_attr_f2c = edge_attr_f2c
 
-                # concatenate, include residual from fine grid:  
-                x = torch.cat((edge_attr_c2f, x, res), axis=1)
+            # Concatenate
+            temp_ea = torch.cat((edge_attr_f2c.expand(x.shape[:-1] + (-1,)), x), axis=-1)
 
-                # apply MLP: interpolation
-                for j in range(self.n_mlp_mp):
-                    x = self.upsample_mlp[j](x)
-                    if j < self.n_mlp_mp - 1:
-                        x = self.act(x)
-                    else:
-                        x = x
+            # Apply downsample MLP
+            for j in range(self.n_mlp_mp):
+                temp_ea = self.downsample_mlp[j](temp_ea)
+                if j < self.n_mlp_mp - 1:
+                    temp_ea = self.act(temp_ea)
+                else:
+                    temp_ea = temp_ea
 
-                x = self.upsample_norm(x)
-            else:
-                raise ValueError('Invalid input to interpolation_mode: %s' %(self.interpolation_mode)) 
+            # Residual connection
+            temp_ea = edge_attr_f2c + temp_ea
 
-            # Message passing on new upsampled graph
-            for i in range(self.n_mp_up[m]):
-                for r in range(self.n_repeat_mp_up):
-                    # 1) concatenate edge + neighbor + owner into new edge_attr 
-                    x_own = x[edge_index[0,:], :]
-                    x_nei = x[edge_index[1,:], :]
-                    edge_attr_t = torch.cat((x_own, x_nei, edge_attr), axis=1)
+            # normalization
+            temp_ea = self.downsample_norm(temp_ea)
 
-                    # 2) edge update mlp
-                    for j in range(self.n_mlp_mp):
-                        edge_attr_t = self.edge_up_mps[m][i][j](edge_attr_t) 
-                        if j < self.n_mlp_mp - 1:
-                            edge_attr_t = self.act(edge_attr_t)
-                        else:
-                            edge_attr_t = edge_attr_t
+            # apply edge agg
+            x = self.edge_aggregator( (pos_f, pos_c), edge_index_f2c, temp_ea )  
+            
+        else:
+            # Pool node attributes 
+            x = hierarchy.pool_x(m, x)
 
-                    # residual: 
-                    edge_attr = edge_attr + edge_attr_t
+        # Do message passing on coarse graph
+        x, edge_attr = self.mp_steps(self.n_mp_down[m], 1, 
+                                     self.edge_down_mps[m], self.edge_down_norms[m], 
+                                     self.node_down_mps[m], self.node_down_norms[m], 
+                                     x, edge_index, edge_attr)
+        return x, edge_attr, edge_attr_f2c
 
-                    # 3) edge layer norm
-                    edge_attr = self.edge_up_norms[m][i](edge_attr)
+    def up_level(
+            self, 
+            m: int, 
+            x: Tensor, 
+            res: Tensor, 
+            edge_attr: Tensor, 
+            edge_attr_f2c: Optional[Tensor], 
+            hierarchy: MultiscaleHierarchy) -> Tuple[Tensor, Tensor]:
+        """
+        Level m of the upward path: interpolation of x to the fine level, 
+        with the residual res (node features of the downward path on that 
+        level), and message passing on the fine graph, starting from the 
+        fine-level edge features edge_attr.
+        """
+        fine = self.depth - 1 - m
 
-                    # 4) get the aggregate edge features as node features: mean aggregation 
-                    edge_agg = self.edge_aggregator(x, edge_index, edge_attr)
+        # Get edge index on fine level
+        edge_index = hierarchy.edge_indices[fine]
 
-                    # 5) concatenate owner node + edge 
-                    x_t = torch.cat((x, edge_agg), axis=1)
+        # # Upsample node features: Piecewise constant interpolation 
+        if self.interpolation_mode == 'pc':
+            x = x.index_select(-2, hierarchy.clusters[fine]) + res
+        elif self.interpolation_mode == 'knn':
+            # knn interpolation: product with the cached interpolation matrix 
+            x = hierarchy.interpolate(fine+1, x, k = 4) 
+            x += res
+        elif self.interpolation_mode == 'learned':
 
-                    # 6) node update mlp
-                    for j in range(self.n_mlp_mp):
-                        x_t = self.node_up_mps[m][i][j](x_t)
-                        if j < self.n_mlp_mp - 1:
-                            x_t = self.act(x_t) 
-                        else:
-                            x_t = x_t
-                    # residual
-                    x = x + x_t
-                    
-                    # 7) node layer norm 
-                    x = self.node_up_norms[m][i](x)
-        return x, edge_attr 
+            # Get edge attributes 
+            edge_attr_c2f = -edge_attr_f2c
+
+            # coarse node attributes upsampled using pc interp 
+            x = x.index_select(-2, hierarchy.clusters[fine])
+
+            # concatenate, include residual from fine grid:  
+            x = torch.cat((edge_attr_c2f.expand(x.shape[:-1] + (-1,)), x, res), axis=-1)
+
+            # apply MLP: interpolation
+            for j in range(self.n_mlp_mp):
+                x = self.upsample_mlp[j](x)
+                if j < self.n_mlp_mp - 1:
+                    x = self.act(x)
+                else:
+                    x = x
+
+            x = self.upsample_norm(x)
+        else:
+            raise ValueError('Invalid input to interpolation_mode: %s' %(self.interpolation_mode)) 
+
+        # Message passing on new upsampled graph
+        return self.mp_steps(self.n_mp_up[m], self.n_repeat_mp_up, 
+                             self.edge_up_mps[m], self.edge_up_norms[m], 
+                             self.node_up_mps[m], self.node_up_norms[m], 
+                             x, edge_index, edge_attr)
+
+    def mp_steps(
+            self, 
+            n_mp: int, 
+            n_repeat: int, 
+            edge_mps: nn.ModuleList, 
+            edge_norms: nn.ModuleList, 
+            node_mps: nn.ModuleList, 
+            node_norms: nn.ModuleList, 
+            x: Tensor, 
+            edge_index: LongTensor, 
+            edge_attr: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        n_mp message passing steps on one level (each repeated n_repeat times), 
+        with the mlps/norms of step i in edge_mps[i], edge_norms[i], ... 
+        """
+        for i in range(n_mp):
+            for r in range(n_repeat):
+                x, edge_attr = self.run_checkpointed('step', self.mp_step, 
+                                                     edge_mps[i], edge_norms[i], node_mps[i], node_norms[i], 
+                                                     x, edge_index, edge_attr)
+        return x, edge_attr
+
+    def mp_step(
+            self, 
+            edge_mp: nn.ModuleList, 
+            edge_norm: nn.Module, 
+            node_mp: nn.ModuleList, 
+            node_norm: nn.Module, 
+            x: Tensor, 
+            edge_index: LongTensor, 
+            edge_attr: Tensor) -> Tuple[Tensor, Tensor]:
+        # 1-4) edge update: residual mlp on [owner, neighbor, edge] + layer norm
+        edge_attr = self.edge_block(edge_mp, edge_norm, self.act, x, edge_index, edge_attr)
+
+        # 5) get the aggregate edge features as node features: mean aggregation 
+        edge_agg = self.edge_aggregator(x, edge_index, edge_attr)
+
+        # 6-9) node update: residual mlp on [owner, aggregate edge] + layer norm
+        x = self.node_block(node_mp, node_norm, self.act, x, edge_agg)
+        return x, edge_attr
 
     def input_dict(self):
         a = { 'edge_aggregator' : self.edge_aggregator, 
@@ -1837,10 +1921,15 @@ class GNN_TopK_NoReduction(torch.nn.Module):
             edge_attr: Tensor,
             pos: Tensor,
             batch: Optional[LongTensor] = None) -> Tuple[Tensor, Tensor]:
+        # Shared-topology mode: x is a dense batch [B, N, F] of samples on one 
+        # mesh (edge_index, edge_attr, pos of the mesh, batch = None). The fine 
+        # level runs on the shared graph; the TopK levels keep different nodes 
+        # in each sample, so they run on the block-diagonal graph. 
+        dense = x.dim() == 3
         if batch is None:
-            batch = edge_index.new_zeros(x.size(0))
+            batch = edge_index.new_zeros(pos.size(0))
 
-        mask = x.new_zeros(x.size(0))
+        mask = x.new_zeros(x.shape[:-1])
 
         # ~~~~ Node Encoder: 
         for i in range(self.n_mlp_encode):
@@ -1860,14 +1949,21 @@ class GNN_TopK_NoReduction(torch.nn.Module):
                 edge_attr = edge_attr
         edge_attr = self.edge_encode_norm(edge_attr)
 
+        # ~~~~ Voxel clustering hierarchy of the fine graph for the MMP layers 
+        # -- the mesh is static, so this is memoized across forward passes 
+        hierarchy = get_hierarchy(edge_index, pos, batch, self.lengthscales_enc, self.bounding_box)
+
         # ~~~~ INITIAL MESSAGE PASSING ON FINE GRAPH (m = 0)
         m = 0 # level index 
         n_mp = self.n_mp_down_topk[m] # number of message passing blocks 
         for i in range(n_mp):
             if not self.param_sharing: 
-                x, edge_attr = self.down_mps[m][i](x, edge_index, edge_attr, pos, batch=batch)
+                x, edge_attr = self.down_mps[m][i](x, edge_index, edge_attr, pos, batch=batch, hierarchy=hierarchy)
             else:
-                x, edge_attr = self.down_mps(x, edge_index, edge_attr, pos, batch=batch)
+                x, edge_attr = self.down_mps(x, edge_index, edge_attr, pos, batch=batch, hierarchy=hierarchy)
+
+        if dense and edge_attr.dim() == 2:
+            edge_attr = edge_attr.expand(x.size(0), -1, -1)
 
         # ~~~~ Store level 0 embeddings in lists  
         xs = [x] 
@@ -1875,9 +1971,16 @@ class GNN_TopK_NoReduction(torch.nn.Module):
         edge_indices = [edge_index]
         edge_attrs = [edge_attr]
         batches = [batch]
+        hierarchies = [hierarchy]
         perms = []
         edge_masks = []
 
+        # ~~~~ Dense batch: leave the shared topology for the TopK levels 
+        if dense and self.depth > 0:
+            edge_index, pos, batch = get_batched_graph(edge_index, pos, x.size(0))
+            x = x.reshape(-1, x.size(-1))
+            edge_attr = edge_attr.reshape(-1, edge_attr.size(-1))
+
         # ~~~~ Downward message passing
         for m in range(1, self.depth + 1):
             # Pooling: returns new x and edge_index for coarser grid 
@@ -1896,12 +1999,17 @@ class GNN_TopK_NoReduction(torch.nn.Module):
             # append the batch list for upsampling
             batches += [batch]
 
+            # Voxel clustering hierarchy of the coarse graph: built once, and 
+            # shared by the MMP layers on this level 
+            hierarchy = MultiscaleHierarchy(edge_index, pos, batch, self.lengthscales_enc, self.bounding_box)
+            hierarchies += [hierarchy]
+
             # Do message passing on coarse graph
             for i in range(self.n_mp_down_topk[m]):
                 if not self.param_sharing:
-                    x, edge_attr = self.down_mps[m][i](x, edge_index, edge_attr, pos, batch=batch)
+                    x, edge_attr = self.down_mps[m][i](x, edge_index, edge_attr, pos, batch=batch, hierarchy=hierarchy)
                 else:
-                    x, edge_attr = self.down_mps(x, edge_index, edge_attr, pos, batch=batch)
+                    x, edge_attr = self.down_mps(x, edge_index, edge_attr, pos, batch=batch, hierarchy=hierarchy)
             
             # If there are coarser levels, append the fine-level lists
             if m < self.depth:
@@ -1911,11 +2019,12 @@ class GNN_TopK_NoReduction(torch.nn.Module):
 
         # ~~~~ populate mask 
         if self.depth > 0:
+            mask_flat = mask.view(-1)
             perm_global = perms[0]
-            mask[perm_global] = 1
+            mask_flat[perm_global] = 1
             for i in range(1,self.depth):
                 perm_global = perm_global[perms[i]]
-                mask[perm_global] = i+1
+                mask_flat[perm_global] = i+1
 
 
         # ~~~~ Upward message passing (decoder)
@@ -1943,26 +2052,36 @@ class GNN_TopK_NoReduction(torch.nn.Module):
             # Get edge index on fine level
             edge_index = edge_indices[fine]
 
-            # Upsample edge features
+            # Upsample edge features (on the block-diagonal graph for dense batches)
             edge_mask = edge_masks[fine]
-            up_edge = torch.zeros_like(res_edge)
+            up_edge = res_edge.new_zeros(res_edge.shape).view(-1, res_edge.size(-1))
             up_edge[edge_mask] = edge_attr
-            edge_attr = up_edge + res_edge 
+            edge_attr = up_edge.view(res_edge.shape) + res_edge 
 
             # Upsample node features
             # get node assignments on fine level
             perm = perms[fine]
-            up = torch.zeros_like(res)
+            up = res.new_zeros(res.shape).view(-1, res.size(-1))
             up[perm] = x
-            x = up + res
+            x = up.view(res.shape) + res
+
+            # Get the voxel clustering hierarchy on fine level 
+            # -- the TopK graphs change every forward: only the static fine 
+            # graph (fine = 0) goes through the memo 
+            if self.param_sharing or self.lengthscales_dec == self.lengthscales_enc:
+                hierarchy = hierarchies[fine]
+            elif fine == 0:
+                hierarchy = get_hierarchy(edge_index, pos, batch, self.lengthscales_dec, self.bounding_box)
+            else:
+                hierarchy = MultiscaleHierarchy(edge_index, pos, batch, self.lengthscales_dec, self.bounding_box)
 
             # Message passing on new upsampled graph
             for i in range(self.n_mp_up_topk[m]):
                 for r in range(1):
                     if not self.param_sharing:
-                        x, edge_attr = self.up_mps[m][i](x, edge_index, edge_attr, pos, batch=batch)
+                        x, edge_attr = self.up_mps[m][i](x, edge_index, edge_attr, pos, batch=batch, hierarchy=hierarchy)
                     else:
-                        x, edge_attr = self.down_mps(x, edge_index, edge_attr, pos, batch=batch) # re-use down_mps here 
+                        x, edge_attr = self.down_mps(x, edge_index, edge_attr, pos, batch=batch, hierarchy=hierarchy) # re-use down_mps here 
                         #x = self.up_mps(x, edge_index, edge_attr, pos, batch=batch)
 
             # for i in range(self.n_mp_up_topk[m+1]):
@@ -1974,23 +2093,11 @@ class GNN_TopK_NoReduction(torch.nn.Module):
 
 
         # ~~~~ Filtering layer -- use voxel clustering to do this 
+        # -- the clusters and knn weights are static: cached in a one-level hierarchy 
         if self.filter_lengthscale > 0: 
-            cluster = tgnn.voxel_grid(pos = pos,
-                                          size = self.filter_lengthscale,
-                                          batch = batch)
-            x, _, _, batch_coarse, pos_coarse, _, _ = avg_pool_mod(
-                                                                cluster, 
-                                                                x, 
-                                                                edge_index, 
-                                                                edge_attr,
-                                                                batch, 
-                                                                pos)
-            x = tgnn.knn_interpolate(x = x,
-                                     pos_x = pos_coarse,
-                                     pos_y = pos,
-                                     batch_x = batch_coarse,
-                                     batch_y = batch,
-                                     k = 4) 
+            filter_hierarchy = get_hierarchy(edge_index, pos, batch, [self.filter_lengthscale], [])
+            x = filter_hierarchy.pool_x(1, x)
+            x = filter_hierarchy.interpolate(1, x, k = 4) 
 
         # ~~~~ Node decoder
         for i in range(self.n_mlp_decode):
@@ -3254,13 +3361,24 @@ class EdgeAggregation(MessagePassing):
           edge features :math:`(|\mathcal{E}|, D)` *(optional)*
         - **output:** node features :math:`(|\mathcal{V}|, F_{out})` or
           :math:`(|\mathcal{V}_t|, F_{out})` if bipartite
+
+    backend selects the aggregation: 'scatter' (MessagePassing.propagate) or 
+    'csr' (deterministic reduction over a cached CSR index of edge_index, 
+    without atomics, see pooling.segment_aggregate). 
     """
 
-    def __init__(self, **kwargs):
+    def __init__(self, backend: Optional[str] = 'scatter', **kwargs):
         kwargs.setdefault('aggr', 'mean')
         super().__init__(**kwargs)
+        self.backend = backend
 
     def forward(self, x, edge_index, edge_attr):
+        if self.backend == 'csr':
+            num_nodes = x[1].size(-2) if isinstance(x, tuple) else x.size(-2)
+            return segment_aggregate(edge_attr, edge_index, num_nodes, self.aggr)
+        if edge_index.dtype != torch.long:
+            # the scatter aggregation of propagate needs int64 indices
+            edge_index = edge_index.long()
         out = self.propagate(edge_index, x=x, edge_attr=edge_attr)
         return out
 
@@ -6,7 +6,7 @@ import torch_geometric.nn as tgnn
 from torch_scatter import scatter_mean
 from torch_geometric.nn.conv import MessagePassing
 from torch_geometric.typing import Adj, OptTensor, PairTensor
-from pooling import TopKPooling_Mod, avg_pool_mod, avg_pool_mod_no_x
+from pooling import TopKPooling_Mod, segment_aggregate, avg_pool_mod, avg_pool_mod_no_x
 
 SPACEDIM = 2
 
@@ -80,9 +80,10 @@ class ConsGNN(torch.nn.Module):
             edge_attr: Tensor,
             nvec: Tensor,
             batch: Optional[LongTensor] = None) -> Tensor:
-
+        # x is [N, F], or a dense batch [B, N, F] of samples on the mesh of 
+        # edge_index/nvec (shared-topology mode, batch = None)
         if batch is None:
-            batch = edge_index.new_zeros(x.size(0))
+            batch = edge_index.new_zeros(x.size(-2))
 
         # ~~~~ Node encoder 
         x = self.node_encoder(x) 
@@ -226,15 +227,16 @@ class ConsMessagePassingLayer(torch.nn.Module):
             edge_index: LongTensor,
             batch: Optional[LongTensor] = None) -> Tensor:
         if batch is None:
-            batch = edge_index.new_zeros(x.size(0))
+            batch = edge_index.new_zeros(x.size(-2))
         
         # KT Flux = 0.5*{ [ (F(xi) + F(xj)) ] - a_ij*[ xi - xj ] }
-        x_send = x[edge_index[0,:]] # send
-        x_recv = x[edge_index[1,:]] # recv 
-        flux_send = torch.bmm(self.flux_mlp(x_send).view(-1,x.shape[1],SPACEDIM), 
-                              nvec.unsqueeze(-1)).squeeze()
-        flux_recv = torch.bmm(self.flux_mlp(x_recv).view(-1,x.shape[1],SPACEDIM), 
-                              nvec.unsqueeze(-1)).squeeze()
+        # -- gathers on the node dimension, so dense [B, N, F] batches share nvec 
+        x_send = x.index_select(-2, edge_index[0,:]) # send
+        x_recv = x.index_select(-2, edge_index[1,:]) # recv 
+        flux_send = torch.matmul(self.flux_mlp(x_send).view(x_send.shape + (SPACEDIM,)), 
+                                 nvec.unsqueeze(-1)).squeeze(-1)
+        flux_recv = torch.matmul(self.flux_mlp(x_recv).view(x_recv.shape + (SPACEDIM,)), 
+                                 nvec.unsqueeze(-1)).squeeze(-1)
 
         # wavespeed: 
         a_ws = self.a_mlp((x_send + x_recv)/2.0)
@@ -277,15 +279,26 @@ class EdgeAggregation(MessagePassing):
           edge features :math:`(|\mathcal{E}|, D)` *(optional)*
         - **output:** node features :math:`(|\mathcal{V}|, F_{out})` or
           :math:`(|\mathcal{V}_t|, F_{out})` if bipartite
+
+    backend selects the aggregation: 'scatter' (MessagePassing.propagate) or 
+    'csr' (deterministic reduction over a cached CSR index of edge_index, 
+    without atomics, see pooling.segment_aggregate). 
     """
 
     propagate_type = {'x': Tensor, 'edge_attr': Tensor}
 
-    def __init__(self, **kwargs):
+    def __init__(self, backend: Optional[str] = 'scatter', **kwargs):
         kwargs.setdefault('aggr', 'mean')
         super().__init__(**kwargs)
+        self.backend = backend
 
     def forward(self, x: Tensor, edge_index: Tensor, edge_attr: Tensor) -> Tensor:
+        if self.backend == 'csr':
+            num_nodes = x[1].size(-2) if isinstance(x, tuple) else x.size(-2)
+            return segment_aggregate(edge_attr, edge_index, num_nodes, self.aggr)
+        if edge_index.dtype != torch.long:
+            # the scatter aggregation of propagate needs int64 indices
+            edge_index = edge_index.long()
         out = self.propagate(edge_index, x=x, edge_attr=edge_attr, size=None)
         return out
 
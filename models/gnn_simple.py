@@ -6,7 +6,8 @@ import torch_geometric.nn as tgnn
 from torch_scatter import scatter_mean
 from torch_geometric.nn.conv import MessagePassing
 from torch_geometric.typing import Adj, OptTensor, PairTensor
-from pooling import TopKPooling_Mod, avg_pool_mod, avg_pool_mod_no_x
+from pooling import TopKPooling_Mod, segment_aggregate, avg_pool_mod, avg_pool_mod_no_x
+from models.gnn import factorized_edge_linear
 
 class SinglescaleGNN(torch.nn.Module):
     def __init__(self, 
@@ -72,9 +73,10 @@ class SinglescaleGNN(torch.nn.Module):
             pos: Tensor,
             edge_attr: Tensor,
             batch: Optional[LongTensor] = None) -> Tensor:
-
+        # x is [N, F], or a dense batch [B, N, F] of samples on the mesh of 
+        # edge_index/edge_attr (shared-topology mode, batch = None)
         if batch is None:
-            batch = edge_index.new_zeros(x.size(0))
+            batch = edge_index.new_zeros(x.size(-2))
 
         # ~~~~ Node encoder 
         x = self.node_encoder(x) 
@@ -148,8 +150,15 @@ class MLP(torch.nn.Module):
         return
 
     def forward(self, x: Tensor) -> Tensor:
+        return self.forward_from_first_layer(self.mlp[0](x))
+
+    def forward_from_first_layer(self, x: Tensor) -> Tensor:
+        """
+        Runs the MLP on x, the already computed output of the first layer. 
+        """
         for i in range(len(self.ic)):
-            x = self.mlp[i](x) 
+            if i > 0:
+                x = self.mlp[i](x) 
             if i < (len(self.ic) - 1):
                 x = self.activation_layer(x)
         x = self.norm_layer(x) if self.norm_layer else x
@@ -220,19 +229,21 @@ class MessagePassingLayer(torch.nn.Module):
             batch: Optional[LongTensor] = None) -> Tensor:
 
         if batch is None:
-            batch = edge_index.new_zeros(x.size(0))
+            batch = edge_index.new_zeros(x.size(-2))
         
         # ~~~~ Edge update 
-        e += self.edge_updater(
-                torch.cat((x[edge_index[0,:],:], x[edge_index[1,:],:], e), dim=1)
+        # -- the first layer acts on [owner, neighbor, edge]: it is factorized 
+        #    so the owner/neighbor blocks are applied per node, then gathered 
+        e = e + self.edge_updater.forward_from_first_layer(
+                factorized_edge_linear(self.edge_updater.mlp[0], x, edge_index, e)
                 )
         
         # ~~~~ Edge aggregation
         edge_agg = self.edge_aggregator(x, edge_index, e)
 
         # ~~~~ Node update 
-        x += self.node_updater(
-                torch.cat((x, edge_agg), dim=1)
+        x = x + self.node_updater(
+                torch.cat((x, edge_agg), dim=-1)
                 )
 
         return x,e  
@@ -269,15 +280,26 @@ class EdgeAggregation(MessagePassing):
           edge features :math:`(|\mathcal{E}|, D)` *(optional)*
         - **output:** node features :math:`(|\mathcal{V}|, F_{out})` or
           :math:`(|\mathcal{V}_t|, F_{out})` if bipartite
+
+    backend selects the aggregation: 'scatter' (MessagePassing.propagate) or 
+    'csr' (deterministic reduction over a cached CSR index of edge_index, 
+    without atomics, see pooling.segment_aggregate). 
     """
 
     propagate_type = {'x': Tensor, 'edge_attr': Tensor}
 
-    def __init__(self, **kwargs):
+    def __init__(self, backend: Optional[str] = 'scatter', **kwargs):
         kwargs.setdefault('aggr', 'mean')
         super().__init__(**kwargs)
+        self.backend = backend
 
     def forward(self, x: Tensor, edge_index: Tensor, edge_attr: Tensor) -> Tensor:
+        if self.backend == 'csr':
+            num_nodes = x[1].size(-2) if isinstance(x, tuple) else x.size(-2)
+            return segment_aggregate(edge_attr, edge_index, num_nodes, self.aggr)
+        if edge_index.dtype != torch.long:
+            # the scatter aggregation of propagate needs int64 indices
+            edge_index = edge_index.long()
         out = self.propagate(edge_index, x=x, edge_attr=edge_attr, size=None)
         return out
 
@@ -1,8 +1,11 @@
 from typing import Callable, Optional, Union
 
+import numpy as np
 import torch
 from torch.nn import Parameter
-from torch_scatter import scatter, scatter_add, scatter_max, scatter_mean
+from torch.utils.weak import WeakIdKeyDictionary
+from torch_scatter import scatter, scatter_add, scatter_max, scatter_mean, segment_csr
+from torch_geometric.nn.conv import MessagePassing
 from torch_geometric.data import Batch
 
 from torch_geometric.utils import softmax, remove_self_loops, coalesce
@@ -12,6 +15,35 @@ from torch_geometric.nn.inits import uniform
 
 
 from torch_geometric.nn.pool.consecutive import consecutive_cluster
+from torch_geometric.nn.pool import voxel_grid, knn
+
+
+_GRAPH_SIZES = {}
+
+@torch.compiler.disable
+def get_graph_sizes(batch):
+    r"""Returns (num_nodes, cum_num_nodes, batch_size, max_num_nodes,
+    equal_size) of the graphs of a batch vector. Memoized, like
+    get_csr_index: the batch vector of a shared mesh is the same every
+    forward, so the host syncs for the sizes are only paid once. The memo
+    lookups (this, get_csr_index, get_hierarchy, get_batched_graph) are
+    disabled for torch.compile: they are host-side caches, and tracing
+    their tensor comparisons would only add graph breaks."""
+    key = (batch.size(0), batch.dtype, str(batch.device))
+    entry = _GRAPH_SIZES.get(key)
+    if entry is not None and (entry[0] is batch or torch.equal(entry[0], batch)):
+        _GRAPH_SIZES[key] = (batch,) + entry[1:]
+        return entry[1]
+
+    with torch.no_grad():
+        num_nodes = torch.bincount(batch.long())
+        cum_num_nodes = torch.cat(
+            [num_nodes.new_zeros(1),
+             num_nodes.cumsum(dim=0)[:-1]], dim=0)
+        min_num_nodes, max_num_nodes = torch.stack([num_nodes.min(), num_nodes.max()]).tolist()
+    sizes = (num_nodes, cum_num_nodes, num_nodes.size(0), max_num_nodes, min_num_nodes == max_num_nodes)
+    _GRAPH_SIZES[key] = (batch, sizes)
+    return sizes
 
 
 def topk(x, ratio, batch, min_score=None, tol=1e-7):
@@ -22,57 +54,63 @@ def topk(x, ratio, batch, min_score=None, tol=1e-7):
 
         perm = (x > scores_min).nonzero(as_tuple=False).view(-1)
     else:
-        num_nodes = scatter_add(batch.new_ones(x.size(0)), batch, dim=0)
-        batch_size, max_num_nodes = num_nodes.size(0), num_nodes.max().item()
-
-        cum_num_nodes = torch.cat(
-            [num_nodes.new_zeros(1),
-             num_nodes.cumsum(dim=0)[:-1]], dim=0)
-
-        index = torch.arange(batch.size(0), dtype=torch.long, device=x.device)
-        index = (index - cum_num_nodes[batch]) + (batch * max_num_nodes)
-
-        dense_x = x.new_full((batch_size * max_num_nodes, ),
-                             torch.finfo(x.dtype).min)
-        dense_x[index] = x
-        dense_x = dense_x.view(batch_size, max_num_nodes)
-
-        _, perm = dense_x.sort(dim=-1, descending=True)
+        num_nodes, cum_num_nodes, batch_size, max_num_nodes, equal_size = get_graph_sizes(batch)
+
+        if equal_size:
+            # all graphs have max_num_nodes nodes (e.g. a batch of snapshots
+            # on one mesh): a [batch_size, max_num_nodes] view, no padding
+            if isinstance(ratio, int):
+                k = min(ratio, max_num_nodes)
+            else:
+                # same float32 rounding as below, on the host (no tensor sync)
+                k = int(np.ceil(np.float32(ratio) * np.float32(max_num_nodes)))
+            perm = x.view(batch_size, max_num_nodes).topk(k, dim=-1)[1]
+            perm = perm + cum_num_nodes.view(-1, 1)
+            perm = perm.view(-1)
+        else:
+            index = torch.arange(batch.size(0), dtype=torch.long, device=x.device)
+            index = (index - cum_num_nodes[batch]) + (batch * max_num_nodes)
 
-        perm = perm + cum_num_nodes.view(-1, 1)
-        perm = perm.view(-1)
+            dense_x = x.new_full((batch_size * max_num_nodes, ),
+                                 torch.finfo(x.dtype).min)
+            dense_x[index] = x
+            dense_x = dense_x.view(batch_size, max_num_nodes)
 
-        if isinstance(ratio, int):
-            k = num_nodes.new_full((num_nodes.size(0), ), ratio)
-            k = torch.min(k, num_nodes)
-        else:
-            k = (ratio * num_nodes.to(torch.float)).ceil().to(torch.long)
+            if isinstance(ratio, int):
+                k = num_nodes.new_full((num_nodes.size(0), ), ratio)
+                k = torch.min(k, num_nodes)
+            else:
+                k = (ratio * num_nodes.to(torch.float)).ceil().to(torch.long)
 
-        mask = [
-            torch.arange(k[i], dtype=torch.long, device=x.device) +
-            i * max_num_nodes for i in range(batch_size)
-        ]
-        mask = torch.cat(mask, dim=0)
+            # partial selection of the largest k of any graph, then the
+            # first k[i] of graph i
+            _, perm = dense_x.topk(min(int(k.max()), max_num_nodes), dim=-1)
+            mask = torch.arange(perm.size(1), device=x.device) < k.view(-1, 1)
 
-        perm = perm[mask]
+            perm = perm + cum_num_nodes.view(-1, 1)
+            perm = perm[mask]
 
-    return perm
+    # perm has the index dtype of batch (int32 in int32 index mode)
+    return perm.to(batch.dtype)
 
 
 def filter_adj(edge_index, edge_attr, perm, num_nodes=None):
     num_nodes = maybe_num_nodes(edge_index, num_nodes)
 
+    # old --> new node ids, -1 for dropped nodes
     mask = perm.new_full((num_nodes, ), -1)
-    i = torch.arange(perm.size(0), dtype=torch.long, device=perm.device)
-    mask[perm] = i
+    mask[perm] = torch.arange(perm.size(0), dtype=perm.dtype, device=perm.device)
 
+    # index_select gathers, and one nonzero for the kept edges shared by
+    # all of them (boolean indexing runs a nonzero per tensor)
     row, col = edge_index
-    row, col = mask[row], mask[col]
+    row, col = mask.index_select(0, row), mask.index_select(0, col)
     mask = (row >= 0) & (col >= 0)
-    row, col = row[mask], col[mask]
+    keep = mask.nonzero().view(-1)
+    row, col = row.index_select(0, keep), col.index_select(0, keep)
 
     if edge_attr is not None:
-        edge_attr = edge_attr[mask]
+        edge_attr = edge_attr.index_select(0, keep)
 
     return torch.stack([row, col], dim=0), edge_attr, mask
 
@@ -187,11 +225,13 @@ class TopKPooling_Mod(torch.nn.Module):
 # Edge pooling
 def pool_edge_mean(cluster, edge_index, edge_attr: Optional[torch.Tensor] = None):
     num_nodes = cluster.size(0)
-    edge_index = cluster[edge_index.view(-1)].view(2, -1) 
+    index_dtype = edge_index.dtype
+    # coalesce sorts by row * num_nodes + col: int64 
+    edge_index = cluster.long()[edge_index.view(-1)].view(2, -1) 
     edge_index, edge_attr = remove_self_loops(edge_index, edge_attr)
     if edge_index.numel() > 0:
         edge_index, edge_attr = coalesce(edge_index, edge_attr, reduce='mean')
-    return edge_index, edge_attr
+    return edge_index.to(index_dtype), edge_attr
 
 
 
@@ -216,6 +256,9 @@ def avg_pool_mod(cluster, x, edge_index, edge_attr, batch, pos):
     # Pool node positions 
     pos_pool = None if pos is None else scatter_mean(pos, cluster, dim=0)
 
+    # consecutive_cluster returns int64: back to the index dtype of edge_index
+    cluster, perm = cluster.to(edge_index.dtype), perm.to(edge_index.dtype)
+
     return x_pool, edge_index_pool, edge_attr_pool, batch_pool, pos_pool, cluster, perm
 
 
@@ -236,9 +279,330 @@ def avg_pool_mod_no_x(cluster, edge_index, edge_attr, batch, pos):
     # Pool node positions 
     pos_pool = None if pos is None else scatter_mean(pos, cluster, dim=0)
 
+    # consecutive_cluster returns int64: back to the index dtype of edge_index
+    cluster, perm = cluster.to(edge_index.dtype), perm.to(edge_index.dtype)
+
     return edge_index_pool, edge_attr_pool, batch_pool, pos_pool, cluster, perm
 
 
 
 
 
+
+
+
+# Multiscale hierarchy 
+class MultiscaleHierarchy:
+    r"""Voxel clustering hierarchy of a static graph, as used by
+    Multiscale_MessagePassing_Layer. Level 0 is the input graph, and level m
+    is obtained by voxel clustering the node positions of level m-1 with
+    lengthscales[m-1] and pooling with avg_pool_mod. Everything that only
+    depends on the mesh is computed once, so that pooling in the forward pass
+    reduces to segment means of the features:
+
+        clusters[m-1]         -- consecutive cluster (level m node) of each level m-1 node
+        perms[m-1]            -- a level m-1 node of each cluster
+        node_counts[m-1]      -- number of level m-1 nodes per cluster
+        edge_maps[m-1]        -- level m edge of each level m-1 edge (self-loops: n_edges)
+        edge_counts[m-1]      -- number of level m-1 edges per level m edge
+        edge_indices[m]       -- coalesced edge_index of level m
+        positions[m]          -- node positions of level m (cluster means)
+        batches[m]            -- batch vector of level m
+        edge_indices_f2c[m-1] -- fine-to-coarse edges from level m-1 to level m
+        distances_f2c[m-1]    -- coarse minus fine node position of each f2c edge
+
+    The knn interpolation matrices from level m to level m-1 are built on
+    first use (see interpolate). All index tensors have the dtype of
+    edge_index (int32 in int32 index mode); the cluster keys are computed in
+    int64.
+
+    The features may also be dense batches [B, N, F] of B samples on the
+    graph of the hierarchy (shared-topology mode): pooling and interpolation
+    then act on the node dimension of all samples at once.
+    """
+    def __init__(self, edge_index, pos, batch, lengthscales, bounding_box):
+        self.lengthscales = list(lengthscales)
+        self.bounding_box = list(bounding_box) if bounding_box else [None]*4
+        self.edge_indices = [edge_index]
+        self.positions = [pos]
+        self.batches = [batch]
+        self.clusters = []
+        self.perms = []
+        self.node_counts = []
+        self.edge_maps = []
+        self.edge_counts = []
+        self.edge_indices_f2c = []
+        self.distances_f2c = []
+        self.interpolations = {} # (m, k) --> sparse interpolation matrix
+        self.index_dtype = edge_index.dtype
+
+        x_lo, x_hi, y_lo, y_hi = self.bounding_box
+        start = None if x_lo is None else [x_lo, y_lo]
+        end = None if x_hi is None else [x_hi, y_hi]
+        with torch.no_grad():
+            for lengthscale in self.lengthscales:
+                cluster = voxel_grid(pos = pos,
+                                     size = lengthscale,
+                                     batch = batch,
+                                     start = start, 
+                                     end = end)
+                cluster, perm = consecutive_cluster(cluster)
+                num_clusters = perm.size(0)
+
+                # Pooled edges: same ordering as coalesce in pool_edge_mean
+                row, col = cluster[edge_index[0]], cluster[edge_index[1]]
+                keep = row != col
+                edge_id, edge_map_keep = torch.unique(row[keep] * num_clusters + col[keep], 
+                                                      sorted=True, return_inverse=True)
+                edge_map = edge_index.new_full((edge_index.size(1),), edge_id.size(0))
+                edge_map[keep] = edge_map_keep.to(self.index_dtype)
+                edge_index_pool = torch.stack([edge_id // num_clusters, edge_id % num_clusters], dim=0).to(self.index_dtype)
+
+                pos_pool = scatter_mean(pos, cluster, dim=0)
+                batch_pool = batch[perm]
+
+                n_nodes = pos.size(0)
+                self.clusters.append(cluster.to(self.index_dtype))
+                self.perms.append(perm.to(self.index_dtype))
+                self.node_counts.append(torch.bincount(cluster, minlength=num_clusters).view(-1, 1))
+                self.edge_maps.append(edge_map)
+                self.edge_counts.append(torch.bincount(edge_map_keep, minlength=edge_id.size(0)).view(-1, 1))
+                self.edge_indices_f2c.append(torch.stack([torch.arange(n_nodes, dtype=self.index_dtype, device=pos.device), 
+                                                          self.clusters[-1]], dim=0))
+                self.distances_f2c.append(pos_pool[cluster] - pos)
+                self.edge_indices.append(edge_index_pool)
+                self.positions.append(pos_pool)
+                self.batches.append(batch_pool)
+
+                edge_index, pos, batch = edge_index_pool, pos_pool, batch_pool
+
+    @property
+    def depth(self) -> int:
+        return len(self.lengthscales)
+
+    def pool_x(self, m, x):
+        """Mean of the level m-1 node features x over the clusters of level m."""
+        cluster = self.clusters[m-1]
+        count = self.node_counts[m-1]
+        x_pool = x.new_zeros(x.shape[:-2] + (count.size(0), x.size(-1))).index_add_(-2, cluster, x)
+        return x_pool / count
+
+    def pool_edge_attr(self, m, edge_attr):
+        """Mean of the level m-1 edge features over the edges of level m."""
+        edge_map = self.edge_maps[m-1]
+        count = self.edge_counts[m-1]
+        n_edges = count.size(0)
+        edge_attr_pool = edge_attr.new_zeros(edge_attr.shape[:-2] + (n_edges + 1, edge_attr.size(-1))).index_add_(-2, edge_map, edge_attr)
+        return edge_attr_pool[..., :n_edges, :] / count
+
+    def interpolate(self, m, x, k=4):
+        """knn_interpolate of the level m node features x to the nodes of
+        level m-1, as a product with a cached sparse matrix."""
+        if (m, k) not in self.interpolations:
+            self.interpolations[(m, k)] = knn_interpolation_matrix(self.positions[m], 
+                                                                   self.positions[m-1],
+                                                                   self.batches[m], 
+                                                                   self.batches[m-1],
+                                                                   k = k,
+                                                                   index_dtype = self.index_dtype)
+        matrix = self.interpolations[(m, k)]
+        if x.dim() == 3:
+            out = torch.sparse.mm(matrix, _to_columns(x).to(matrix.dtype))
+            return _from_columns(out, x.size(0)).to(x.dtype)
+        return torch.sparse.mm(matrix, x.to(matrix.dtype)).to(x.dtype)
+
+
+def _to_columns(x):
+    r"""[B, N, F] --> [N, B*F]: a dense batch on a shared graph as one matrix,
+    so that a sparse product over the node dimension covers all samples."""
+    return x.transpose(0, 1).reshape(x.size(1), -1)
+
+
+def _from_columns(x, batch_size):
+    r"""Inverse of _to_columns: [N, B*F] --> [B, N, F]."""
+    return x.view(x.size(0), batch_size, -1).transpose(0, 1)
+
+
+def knn_interpolation_matrix(pos_x, pos_y, batch_x=None, batch_y=None, k=3, index_dtype=torch.long):
+    r"""Sparse (CSR) matrix of shape [pos_y.size(0), pos_x.size(0)] holding the
+    normalized inverse squared distance weights of knn_interpolate, so that
+    knn_interpolate(x, pos_x, pos_y, batch_x, batch_y, k) = matrix @ x. The
+    CSR indices have index_dtype."""
+    with torch.no_grad():
+        # torch_cluster needs int64 batch vectors
+        batch_x = None if batch_x is None else batch_x.long()
+        batch_y = None if batch_y is None else batch_y.long()
+        y_idx, x_idx = knn(pos_x, pos_y, k, batch_x=batch_x, batch_y=batch_y)
+        diff = pos_x[x_idx] - pos_y[y_idx]
+        squared_distance = (diff * diff).sum(dim=-1)
+        weights = 1.0 / torch.clamp(squared_distance, min=1e-16)
+        weights = weights / scatter_add(weights, y_idx, dim=0, dim_size=pos_y.size(0))[y_idx]
+        matrix = torch.sparse_coo_tensor(torch.stack([y_idx, x_idx], dim=0), 
+                                         weights, 
+                                         (pos_y.size(0), pos_x.size(0)),
+                                         check_invariants = False)
+        matrix = matrix.coalesce().to_sparse_csr()
+        if index_dtype != torch.long:
+            matrix = torch.sparse_csr_tensor(matrix.crow_indices().to(index_dtype),
+                                             matrix.col_indices().to(index_dtype),
+                                             matrix.values(),
+                                             matrix.shape,
+                                             check_invariants = False)
+        return matrix
+
+
+_HIERARCHIES = {}
+
+@torch.compiler.disable
+def get_hierarchy(edge_index, pos, batch, lengthscales, bounding_box):
+    r"""Returns the MultiscaleHierarchy of a graph, memoized across calls. The
+    memo holds one hierarchy per graph size, lengthscales, bounding box and
+    device, and is rebuilt when the graph (edge_index, pos, batch) changes."""
+    bounding_box = list(bounding_box) if bounding_box else [None]*4
+    key = (tuple(lengthscales), tuple(bounding_box), pos.size(0), edge_index.size(1), edge_index.dtype, str(pos.device))
+    hierarchy = _HIERARCHIES.get(key)
+    if hierarchy is not None:
+        same = all(a is b or torch.equal(a, b) for a, b in zip(
+            (hierarchy.edge_indices[0], hierarchy.positions[0], hierarchy.batches[0]), 
+            (edge_index, pos, batch)))
+        if same:
+            return hierarchy
+    hierarchy = MultiscaleHierarchy(edge_index, pos, batch, lengthscales, bounding_box)
+    _HIERARCHIES[key] = hierarchy
+    return hierarchy
+
+
+
+# Block-diagonal batched graph of a shared topology (dense [B, N, F] batches)
+_BATCHED_GRAPHS = {}
+
+@torch.compiler.disable
+def get_batched_graph(edge_index, pos, batch_size):
+    r"""Block-diagonal (PyG Batch) form of batch_size copies of a graph: the
+    edge_index with node offsets, the repeated positions and the batch vector,
+    in the index dtype of edge_index. Used where a dense [B, N, F] batch on a
+    shared graph leaves the shared topology (TopK pooling keeps different
+    nodes in each sample). Memoized like get_hierarchy."""
+    key = (batch_size, pos.size(0), edge_index.size(1), edge_index.dtype, str(pos.device))
+    entry = _BATCHED_GRAPHS.get(key)
+    if entry is not None and all(a is b or torch.equal(a, b) for a, b in zip(entry[0], (edge_index, pos))):
+        return entry[1]
+    num_nodes, num_edges = pos.size(0), edge_index.size(1)
+    if batch_size * num_nodes > torch.iinfo(edge_index.dtype).max:
+        raise ValueError('%d nodes per batch do not fit in %s indices' %(batch_size * num_nodes, edge_index.dtype))
+    with torch.no_grad():
+        offset = torch.arange(batch_size, dtype=edge_index.dtype, device=edge_index.device) * num_nodes
+        graph = (edge_index.repeat(1, batch_size) + offset.repeat_interleave(num_edges),
+                 pos.repeat(batch_size, 1),
+                 torch.arange(batch_size, dtype=edge_index.dtype, device=edge_index.device).repeat_interleave(num_nodes))
+    _BATCHED_GRAPHS[key] = ((edge_index, pos), graph)
+    return graph
+
+
+# Edge aggregation with CSR segment reductions 
+# Weakly keyed by edge_index: an entry lives as long as its graph. The static
+# mesh graphs are held by the collater and the hierarchy memo, so their CSR
+# indices are reused across forwards; the TopK graphs of a forward (and the
+# levels of their hierarchies) are dropped with it.
+_CSR_INDICES = WeakIdKeyDictionary()
+
+@torch.compiler.disable
+def _get_csr_entry(edge_index, num_nodes):
+    r"""Returns the memo entry [(perm, rowptr, count), matrices] of edge_index
+    for num_nodes target nodes. A new edge_index tensor with the values of a
+    live one (e.g. the mesh graph copied to the device every batch) shares
+    its entry."""
+    entries = _CSR_INDICES.get(edge_index)
+    if entries is None:
+        for other, other_entries in list(_CSR_INDICES.items()):
+            if other.shape == edge_index.shape and other.dtype == edge_index.dtype and \
+               other.device == edge_index.device and torch.equal(other, edge_index):
+                entries = other_entries
+                break
+        else:
+            entries = {}
+        _CSR_INDICES[edge_index] = entries
+    if num_nodes not in entries:
+        with torch.no_grad():
+            index = edge_index[1]
+            perm = torch.sort(index, stable=True)[1].to(index.dtype)
+            count = torch.bincount(index, minlength=num_nodes).to(index.dtype)
+            rowptr = index.new_zeros(num_nodes + 1)
+            rowptr[1:] = torch.cumsum(count, dim=0)
+        entries[num_nodes] = [(perm, rowptr, count), {}]
+    return entries[num_nodes]
+
+
+def get_csr_index(edge_index, num_nodes):
+    r"""Returns (perm, rowptr, count) such that the edges edge_index[:, perm]
+    are sorted by target node edge_index[1], the edges of target node i are
+    rowptr[i]:rowptr[i+1] in that order, and count holds the in-degrees.
+    All three have the index dtype of edge_index. Memoized for as long as
+    edge_index (or a tensor with the same values) is alive."""
+    return _get_csr_entry(edge_index, num_nodes)[0]
+
+
+def _get_aggregation_matrix(edge_index, num_nodes, aggr, dtype):
+    r"""[num_nodes, E] CSR matrix that sums (aggr='add') or averages
+    (aggr='mean') the edges at their target nodes, and the weight of each
+    edge. Cached with the CSR index of edge_index."""
+    (perm, rowptr, count), matrices = _get_csr_entry(edge_index, num_nodes)
+    if (aggr, dtype) not in matrices:
+        index = edge_index[1]
+        if aggr == 'mean':
+            weight = (1.0 / count.clamp(min=1).to(dtype))[index]
+        else:
+            weight = torch.ones(index.numel(), dtype=dtype, device=index.device)
+        matrix = torch.sparse_csr_tensor(rowptr, perm, weight[perm], (num_nodes, index.numel()),
+                                         check_invariants=False)
+        matrices[(aggr, dtype)] = (matrix, weight)
+    return matrices[(aggr, dtype)]
+
+
+class _SegmentSum(torch.autograd.Function):
+    r"""matrix @ edge_attr for an aggregation matrix; the backward pass is a
+    gather of the node gradients, so neither direction needs atomics."""
+    @staticmethod
+    def forward(ctx, edge_attr, matrix, weight, index):
+        ctx.save_for_backward(weight, index)
+        return torch.sparse.mm(matrix, edge_attr)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        weight, index = ctx.saved_tensors
+        grad_edge_attr = None
+        if ctx.needs_input_grad[0]:
+            grad_edge_attr = grad_out.index_select(0, index) * weight.unsqueeze(1)
+        return grad_edge_attr, None, None, None
+
+
+def segment_aggregate(edge_attr, edge_index, num_nodes, aggr='mean'):
+    r"""Aggregates edge_attr at the target nodes edge_index[1] over the
+    memoized CSR index (see get_csr_index). Same result as
+    scatter(edge_attr, edge_index[1], dim=0, dim_size=num_nodes, reduce=aggr),
+    but deterministic and without atomics: each node reduces its own edges in
+    edge order. 'add' and 'mean' are a CSR sparse-dense product with a gather
+    in the backward pass; other reductions use segment_csr. Dense edge
+    features [B, E, F] of a shared graph are reduced in one pass over
+    [E, B*F], giving [B, num_nodes, F]."""
+    if edge_attr.dim() == 3:
+        out = segment_aggregate(_to_columns(edge_attr), edge_index, num_nodes, aggr)
+        return _from_columns(out, edge_attr.size(0))
+    if aggr in ['add', 'sum', 'mean']:
+        matrix, weight = _get_aggregation_matrix(edge_index, num_nodes,
+                                                 'mean' if aggr == 'mean' else 'add', edge_attr.dtype)
+        return _SegmentSum.apply(edge_attr, matrix, weight, edge_index[1])
+    perm, rowptr, _ = get_csr_index(edge_index, num_nodes)
+    # segment_csr needs an int64 rowptr
+    return segment_csr(edge_attr[perm], rowptr.long(), reduce=aggr)
+
+
+def set_aggregation_backend(model, backend):
+    r"""Selects the backend of every EdgeAggregation in model: 'scatter'
+    (MessagePassing.propagate) or 'csr' (segment_aggregate)."""
+    if backend not in ['scatter', 'csr']:
+        raise ValueError('Invalid aggregation backend: %s' %(backend))
+    for module in model.modules():
+        if isinstance(module, MessagePassing) and hasattr(module, 'backend'):
+            module.backend = backend
+    return
@@ -36,8 +36,11 @@ import models.gnn_topk_relu as gnn
 import dataprep.unstructured_mnist as umnist
 import dataprep.backward_facing_step as bfs
 
-def scalar2openfoam(image_vec, filename, objectname, time_value):
+def scalar2openfoam(image_vec, filename, objectname, time_value, inv_perm=None):
     time_write = time.time()
+    # nodes renumbered in dataprep (reorder): back to the OpenFOAM cell order
+    if inv_perm is not None:
+        image_vec = image_vec[np.asarray(inv_perm)]
     with open(filename, 'w') as f:
         # Openfoam header:
         f.write('/*--------------------------------*- C++ -*----------------------------------*\\\n')
@@ -995,6 +998,7 @@ if 1 == 1:
                 device_for_loading = device
                 use_radius = False
                 gnn_dt = 10
+                node_reorder = None # must match the node_reorder used in training
 
                 rollout_steps = 50
                 #rollout_steps = 300
@@ -1010,7 +1014,9 @@ if 1 == 1:
                     scaling = [data_mean, data_std],
                     features_to_keep = [1,2], 
                     fraction_valid = 0, 
-                    multiple_cases = False)
+                    multiple_cases = False,
+                    reorder = node_reorder)
+                inv_perm = bfs.get_mesh_topology(path_to_ei, path_to_pos, use_radius, reorder = node_reorder)['inv_perm']
 
                 # Setup instantaneous budget computation 
                 mse_full = np.zeros((rollout_steps,2))
@@ -1095,50 +1101,50 @@ if 1 == 1:
                             # input 
                             field_name = '%s_input' %(field_names[f])
                             scalar2openfoam(x_old_unscaled[:,f].cpu().numpy(), 
-                                            time_folder+'/%s' %(field_name), field_name, time_value)
+                                            time_folder+'/%s' %(field_name), field_name, time_value, inv_perm)
 
                             # Prediction rollout
                             field_name = '%s_pred' %(field_names[f])
                             scalar2openfoam(x_new_unscaled[:,f].cpu().numpy(), 
-                                            time_folder+'/%s' %(field_name), field_name, time_value)
+                                            time_folder+'/%s' %(field_name), field_name, time_value, inv_perm)
 
                             # Prediction single step 
                             field_name = '%s_pred_ss' %(field_names[f])
                             scalar2openfoam(x_new_ss_unscaled[:,f].cpu().numpy(), 
-                                            time_folder+'/%s' %(field_name), field_name, time_value)
+                                            time_folder+'/%s' %(field_name), field_name, time_value, inv_perm)
 
                             # Target 
                             field_name = '%s_target' %(field_names[f])
                             scalar2openfoam(target_unscaled[:,f].cpu().numpy(), 
-                                            time_folder+'/%s' %(field_name), field_name, time_value)
+                                            time_folder+'/%s' %(field_name), field_name, time_value, inv_perm)
 
                             # Error -- rollout  
                             field_name = '%s_error' %(field_names[f])
                             scalar2openfoam(error[:,f].cpu().numpy(), 
-                                            time_folder+'/%s' %(field_name), field_name, time_value)
+                                            time_folder+'/%s' %(field_name), field_name, time_value, inv_perm)
 
                             # Error -- single step 
                             field_name = '%s_error_ss' %(field_names[f])
                             scalar2openfoam(error_ss[:,f].cpu().numpy(), 
-                                            time_folder+'/%s' %(field_name), field_name, time_value)
+                                            time_folder+'/%s' %(field_name), field_name, time_value, inv_perm)
                             
                             # Error norm -- rollout 
                             field_name = '%s_error_norm' %(field_names[f])
                             scalar2openfoam(error_norm[:,f].cpu().numpy(), 
-                                            time_folder+'/%s' %(field_name), field_name, time_value)
+                                            time_folder+'/%s' %(field_name), field_name, time_value, inv_perm)
                             
                             # Error norm -- single step
                             field_name = '%s_error_norm_ss' %(field_names[f])
                             scalar2openfoam(error_norm_ss[:,f].cpu().numpy(), 
-                                            time_folder+'/%s' %(field_name), field_name, time_value)
+                                            time_folder+'/%s' %(field_name), field_name, time_value, inv_perm)
 
 
                         # mask -- rollout
                         field_name = 'mask'
-                        scalar2openfoam(mask.cpu().numpy().squeeze(), time_folder+'/%s' %(field_name), field_name, time_value)
+                        scalar2openfoam(mask.cpu().numpy().squeeze(), time_folder+'/%s' %(field_name), field_name, time_value, inv_perm)
                         # mask -- single step 
                         field_name = 'mask_ss'
-                        scalar2openfoam(mask_ss.cpu().numpy().squeeze(), time_folder+'/%s' %(field_name), field_name, time_value)
+                        scalar2openfoam(mask_ss.cpu().numpy().squeeze(), time_folder+'/%s' %(field_name), field_name, time_value, inv_perm)
 
                         
                     # Create budget folder 